@@ -0,0 +1,105 @@
+"""Recall@k / latency report for the index types utils.vector_index can build.
+
+Ground truth comes from exact float32 inner-product search. By default the
+corpus is synthetic clustered unit vectors shaped like MiniLM output (384
+dims); pass --vectors path.npy to use real chunk embeddings instead (queries
+are then drawn from the corpus with noise added). Every index type is built
+once per vector encoding (float32, float16, int8), so the recall cost of the
+compact encodings can be read off against float32.
+
+    python -m benchmarks.ann_benchmark
+    python -m benchmarks.ann_benchmark --num-vectors 200000 --k 10
+    python -m benchmarks.ann_benchmark --encodings float32,int8
+"""
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import vector_index
+
+
+def synthetic_corpus(num_vectors, dimension, num_clusters=200, latent_dims=32, seed=0):
+    """Clustered vectors with low intrinsic dimensionality, like sentence embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dimension)).astype("float32")
+    basis = rng.standard_normal((latent_dims, dimension)).astype("float32") / np.sqrt(latent_dims)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    latent = rng.standard_normal((num_vectors, latent_dims)).astype("float32")
+    vectors = centers[labels] + latent @ basis * 2.0
+    vectors += 0.1 * rng.standard_normal(vectors.shape).astype("float32")
+    return vector_index.normalize(vectors)
+
+
+def noisy_queries(corpus, num_queries, seed=1):
+    rng = np.random.default_rng(seed)
+    picks = corpus[rng.integers(0, len(corpus), num_queries)]
+    return vector_index.normalize(picks + 0.05 * rng.standard_normal(picks.shape).astype("float32"))
+
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-vectors", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--vectors", help="optional .npy file of real embeddings")
+    parser.add_argument("--encodings", default=",".join(vector_index.ENCODINGS),
+                        help="comma-separated vector encodings to compare")
+    args = parser.parse_args()
+
+    if args.vectors:
+        corpus = vector_index.normalize(np.load(args.vectors))
+    else:
+        corpus = synthetic_corpus(args.num_vectors, args.dimension)
+    queries = noisy_queries(corpus, args.queries)
+
+    exact = vector_index.build_index(corpus, "flat")
+    start = time.perf_counter()
+    _, truth = exact.search(queries, args.k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    encodings = args.encodings.split(",")
+
+    print(f"{len(corpus)} vectors x {corpus.shape[1]} dims, {len(queries)} queries, k={args.k}")
+    print(f"{'index':<8} {'encoding':<9} {'setting':<14} {'recall@k':>9} {'ms/query':>9} {'build s':>8} "
+          f"{'size MB':>8} {'B/vector':>9}")
+    print(f"{'flat':<8} {'float32':<9} {'exact':<14} {1.0:>9.3f} {exact_ms:>9.3f} {'-':>8} "
+          f"{faiss.serialize_index(exact).nbytes / 1e6:>8.1f} {corpus.shape[1] * 4:>9}")
+
+    sweeps = {
+        "flat": (None, [None]),
+        "hnsw": ("ef_search", [16, 32, 64, 128, 256]),
+        "ivf": ("nprobe", [1, 4, 16, 64]),
+        "ivfpq": ("nprobe", [1, 4, 16, 64]),
+    }
+    for index_type, (knob, values) in sweeps.items():
+        # IVFPQ has its own compression, so it is only built once
+        for encoding in (encodings[:1] if index_type == "ivfpq" else encodings):
+            if index_type == "flat" and encoding == "float32":
+                continue
+            start = time.perf_counter()
+            index = vector_index.build_index(corpus, index_type, encoding)
+            build_seconds = time.perf_counter() - start
+            size = faiss.serialize_index(index).nbytes
+            label = vector_index.encoding_of(index)
+            for value in values:
+                kwargs = {knob: value} if knob else {}
+                start = time.perf_counter()
+                _, found = vector_index.search(index, queries, args.k, **kwargs)
+                ms = (time.perf_counter() - start) * 1000 / len(queries)
+                setting = f"{knob}={value}" if knob else "exact"
+                print(f"{index_type:<8} {label:<9} {setting:<14} {recall_at_k(found, truth):>9.3f} "
+                      f"{ms:>9.3f} {build_seconds:>8.1f} {size / 1e6:>8.1f} {size / len(corpus):>9.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Chunker benchmark: word windows vs sentence/token-aware chunks.
+
+For each chunker reports chunks/sec (chunking alone), how many chunks exceed
+the model's token limit and what share of tokens the model never sees, the
+embedding time, and retrieval quality. Queries are sentences sampled from
+the book with a third of their words dropped; a query is a hit@k when one of
+the top k chunks contains the middle of its source sentence.
+
+Needs the real embedding model (EMBEDDING_MODEL_NAME) for its tokenizer.
+
+    python -m benchmarks.chunking_benchmark --pdf book.pdf
+    python -m benchmarks.chunking_benchmark --pages 300 --queries 500
+"""
+import argparse
+import os
+import sys
+import time
+
+import fitz
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import vector_index
+from utils.chunking import SentenceChunker, WordChunker, get_chunker, split_sentences
+from utils.embedding import get_embedding_model
+
+TOPICS = {
+    "biology": "cell membrane enzyme protein photosynthesis chlorophyll mitochondria respiration dna gene",
+    "physics": "force mass velocity acceleration momentum energy friction gravity circuit voltage",
+    "chemistry": "acid base salt molecule reaction bond electron oxidation catalyst solution",
+    "mathematics": "theorem proof equation integral derivative matrix vector function limit series",
+}
+
+
+def synthetic_pages(num_pages, sentences_per_page=30, seed=0):
+    """Topic-coherent pages of varied-length sentences, some running across page breaks"""
+    rng = np.random.default_rng(seed)
+    vocab = {topic: words.split() for topic, words in TOPICS.items()}
+    filler = "the of a in is and to with by which that from".split()
+    topics = list(vocab)
+    for page_number in range(1, num_pages + 1):
+        topic = topics[(page_number // 10) % len(topics)]
+        sentences = []
+        for _ in range(sentences_per_page):
+            length = int(rng.integers(6, 40))
+            words = [rng.choice(vocab[topic]) if rng.random() < 0.5 else rng.choice(filler)
+                     for _ in range(length)]
+            sentences.append(" ".join(words).capitalize() + ".")
+        text = " ".join(sentences)
+        if page_number % 5 == 0:
+            text += " and the " + " ".join(rng.choice(vocab[topic], size=8))
+        yield page_number, text
+
+
+def pdf_pages(path):
+    with fitz.open(path) as doc:
+        for page_number, page in enumerate(doc, start=1):
+            yield page_number, page.get_text()
+
+
+def make_queries(pages, num_queries, seed=1):
+    """(query, needle) pairs; needle is the middle six words of the source sentence"""
+    rng = np.random.default_rng(seed)
+    sentences = [s for _, text in pages for s in split_sentences(text) if len(s.split()) >= 12]
+    queries = []
+    for i in rng.choice(len(sentences), size=min(num_queries, len(sentences)), replace=False):
+        words = sentences[i].split()
+        kept = [w for w in words if rng.random() > 0.33]
+        middle = len(words) // 2
+        queries.append((" ".join(kept), " ".join(words[middle - 3:middle + 3])))
+    return queries
+
+
+def evaluate(model, chunker, pages, queries, ks):
+    start = time.perf_counter()
+    chunks = [text for text, _, _ in chunker.iter_chunks(iter(pages))]
+    chunk_seconds = time.perf_counter() - start
+
+    lengths = [len(ids) + 2 for ids in model.tokenize(chunks, add_special_tokens=False)["input_ids"]]
+    limit = model.max_seq_length
+    over = sum(length > limit for length in lengths)
+    unseen = sum(max(0, length - limit) for length in lengths) / max(1, sum(lengths))
+
+    start = time.perf_counter()
+    vectors = vector_index.normalize(model.encode(chunks, batch_size=64))
+    embed_seconds = time.perf_counter() - start
+
+    index = vector_index.build_index(vectors, "flat")
+    query_vectors = vector_index.normalize(model.encode([q for q, _ in queries], batch_size=64))
+    _, found = index.search(query_vectors, max(ks))
+    normalized = [" ".join(chunk.split()) for chunk in chunks]
+    hits = {k: 0 for k in ks}
+    for ids, (_, needle) in zip(found, queries):
+        ranks = [rank for rank, i in enumerate(ids) if i >= 0 and needle in normalized[i]]
+        for k in ks:
+            hits[k] += bool(ranks) and ranks[0] < k
+    return {
+        "chunks": len(chunks),
+        "chunks_per_sec": len(chunks) / chunk_seconds if chunk_seconds else float("inf"),
+        "over_limit": over,
+        "unseen_tokens": unseen,
+        "embed_seconds": embed_seconds,
+        **{f"hit@{k}": hits[k] / len(queries) for k in ks},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", help="book to chunk; a synthetic book is generated otherwise")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--overlap-tokens", type=int, default=32)
+    args = parser.parse_args()
+
+    pages = list(pdf_pages(args.pdf) if args.pdf else synthetic_pages(args.pages))
+    queries = make_queries(pages, args.queries)
+    model = get_embedding_model()
+    sentence_chunker = get_chunker(model, "sentences")
+    chunkers = {
+        "words 300/50": WordChunker(),
+        "sentences": SentenceChunker(model.tokenize, sentence_chunker.max_tokens, args.overlap_tokens),
+    }
+
+    ks = (1, 5, 10)
+    print(f"{len(pages)} pages, {len(queries)} queries, model {model.name} "
+          f"(max_seq_length {model.max_seq_length})")
+    print(f"{'chunker':<14} {'chunks':>7} {'chunks/s':>9} {'>limit':>7} {'unseen':>7} {'embed s':>8} "
+          + " ".join(f"{f'hit@{k}':>7}" for k in ks))
+    for name, chunker in chunkers.items():
+        r = evaluate(model, chunker, pages, queries, ks)
+        print(f"{name:<14} {r['chunks']:>7} {r['chunks_per_sec']:>9.0f} {r['over_limit']:>7} "
+              f"{r['unseen_tokens']:>7.1%} {r['embed_seconds']:>8.1f} "
+              + " ".join(f"{r[f'hit@{k}']:>7.3f}" for k in ks))
+
+
+if __name__ == "__main__":
+    main()
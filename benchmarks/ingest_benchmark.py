@@ -0,0 +1,140 @@
+"""Ingestion benchmark: pages/sec and peak RSS for the PDF -> index pipeline.
+
+Builds a synthetic PDF (1000 pages by default) and ingests it with either the
+streaming pipeline (RAGProcessor.ingest_pages) or the previous whole-book
+pipeline. Each mode runs in its own subprocess so peak RSS is not shared.
+
+    python -m benchmarks.ingest_benchmark
+    python -m benchmarks.ingest_benchmark --pages 2000 --fake-embeddings
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import fitz
+import numpy as np
+
+WORDS = ("cell energy photosynthesis equation force mass velocity circuit resistance "
+         "current voltage enzyme protein molecule reaction acid base salt theorem proof").split()
+
+
+class FakeEmbeddingModel:
+    """Deterministic stand-in for the shared model, to isolate parsing/chunking/indexing cost"""
+    name = "fake-embeddings"
+    dimension = 384
+
+    def encode(self, sentences, **kwargs):
+        vectors = np.empty((len(sentences), self.dimension), dtype="float32")
+        for i, sentence in enumerate(sentences):
+            seed = int.from_bytes(hashlib.md5(sentence.encode("utf-8")).digest()[:4], "little")
+            vectors[i] = np.random.default_rng(seed).standard_normal(self.dimension)
+        return vectors
+
+
+def build_pdf(path, pages, words_per_page=450):
+    rng = np.random.default_rng(0)
+    doc = fitz.open()
+    for page_number in range(pages):
+        words = rng.choice(WORDS, size=words_per_page)
+        text = f"Page {page_number + 1}. " + " ".join(words)
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=7)
+    doc.save(path)
+    doc.close()
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_legacy(processor, pdf_path):
+    """The pre-streaming pipeline: whole file, text +=, one word list, one encode"""
+    with open(pdf_path, "rb") as f:
+        doc = fitz.open(stream=f.read(), filetype="pdf")
+    text = ""
+    for page in doc:
+        text += page.get_text()
+    pages = doc.page_count
+    from utils.chunking import WordChunker
+    chunks = [chunk for chunk, _, _ in WordChunker().iter_chunks([(1, text)])]
+    vectors = np.asarray(processor.model.encode(chunks), dtype="float32")
+    processor.create_faiss_index(vectors)
+    return pages, len(chunks)
+
+
+def run_stream(processor, pdf_path):
+    pages = 0
+
+    def counted(page_iter):
+        nonlocal pages
+        for item in page_iter:
+            pages += 1
+            yield item
+
+    with open(pdf_path, "rb") as f:
+        _, num_chunks = processor.ingest_pages(counted(processor.iter_pages(f)), lambda *chunk: None)
+    return pages, num_chunks
+
+
+def run_mode(mode, pdf_path, fake_embeddings):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.rag import RAGProcessor
+
+    model = FakeEmbeddingModel() if fake_embeddings else None
+    processor = RAGProcessor(model=model)
+    baseline_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    pages, num_chunks = (run_stream if mode == "stream" else run_legacy)(processor, pdf_path)
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "mode": mode,
+        "pages": pages,
+        "chunks": num_chunks,
+        "seconds": round(elapsed, 2),
+        "pages_per_sec": round(pages / elapsed, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "rss_growth_mb": round(peak_rss_mb() - baseline_rss, 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--modes", default="stream,legacy")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="skip the transformer to measure parsing, chunking and indexing only")
+    parser.add_argument("--run-mode", help=argparse.SUPPRESS)
+    parser.add_argument("--pdf", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        run_mode(args.run_mode, args.pdf, args.fake_embeddings)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "synthetic.pdf")
+        build_pdf(pdf_path, args.pages)
+        print(f"Synthetic PDF: {args.pages} pages, {os.path.getsize(pdf_path) / 1e6:.1f} MB")
+        for mode in args.modes.split(","):
+            command = [sys.executable, os.path.abspath(__file__), "--run-mode", mode, "--pdf", pdf_path]
+            if args.fake_embeddings:
+                command.append("--fake-embeddings")
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(result.stderr, file=sys.stderr)
+                continue
+            print(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""LLM call benchmark: blocking calls in async handlers vs the async gateway.
+
+Simulates N concurrent requests against a model with a fixed latency. The
+"blocking" mode sleeps synchronously inside the coroutine, as the old
+generate_content calls did; "gateway" awaits llm_gateway with the fake
+backend. Reports wall time, requests/sec and the worst event-loop stall seen
+by a heartbeat task (how long any other request would have been frozen).
+
+    python -m benchmarks.llm_gateway_benchmark --requests 200 --latency 0.2
+    python -m benchmarks.llm_gateway_benchmark --max-concurrency 16 --route-limit 8
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.llm_gateway import FakeBackend, LLMGateway
+
+
+async def heartbeat(stop: asyncio.Event, interval: float, stalls: list):
+    """Record how late each tick wakes up"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stalls.append(time.perf_counter() - start - interval)
+
+
+async def run(mode: str, requests: int, latency: float, gateway: LLMGateway):
+    stop, stalls = asyncio.Event(), []
+    ticker = asyncio.create_task(heartbeat(stop, 0.01, stalls))
+
+    async def blocking_call(i):
+        time.sleep(latency)
+        return f"answer {i}"
+
+    async def gateway_call(i):
+        return await gateway.generate(f"prompt {i}", "fake-model", route="exercise")
+
+    call = blocking_call if mode == "blocking" else gateway_call
+    start = time.perf_counter()
+    await asyncio.gather(*(call(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+    return elapsed, max(stalls, default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per simulated model call")
+    parser.add_argument("--max-concurrency", type=int, default=32)
+    parser.add_argument("--route-limit", type=int, default=24)
+    parser.add_argument("--skip-blocking", action="store_true", help="the blocking mode takes requests * latency")
+    args = parser.parse_args()
+
+    gateway = LLMGateway(FakeBackend(args.latency), max_concurrency=args.max_concurrency,
+                         route_limits={"exercise": args.route_limit}, timeout=3600)
+    print(f"{'mode':<10} {'seconds':>9} {'req/s':>9} {'max stall ms':>13}")
+    for mode in ("blocking", "gateway"):
+        if mode == "blocking" and args.skip_blocking:
+            continue
+        elapsed, stall = asyncio.run(run(mode, args.requests, args.latency, gateway))
+        print(f"{mode:<10} {elapsed:>9.2f} {args.requests / elapsed:>9.1f} {1000 * stall:>13.1f}")
+    print(gateway.stats()["routes"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
-import google.generativeai as genai
-from google.generativeai import types
 import os
 import dotenv
+from starlette.concurrency import run_in_threadpool
 from utils.rag import RAGProcessor
-from utils.helper import clean_content
+from utils.helper import clean_content, is_notes_type, parse_exercise_text
+from utils.llm_gateway import llm_gateway
+from utils.response_cache import response_cache, response_key
+from utils.single_flight import generation_flights
 import logging
 
 dotenv.load_dotenv()
@@ -12,33 +14,101 @@ dotenv.load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Prompt token budgets for retrieved book context
+EXERCISE_CONTEXT_TOKENS = int(os.getenv("EXERCISE_CONTEXT_TOKENS", "3000"))
+NOTES_CONTEXT_TOKENS = int(os.getenv("NOTES_CONTEXT_TOKENS", "4500"))
+QUESTION_CONTEXT_TOKENS = int(os.getenv("QUESTION_CONTEXT_TOKENS", "2000"))
+
+EXERCISE_MODEL = os.getenv("EXERCISE_MODEL", "gemini-2.0-flash")
+
+NO_BOOK_CONTENT_ANSWER = "No relevant content found in the uploaded book for your question."
+
 class GenerateExercise:
-    def __init__(self, userId):
+    def __init__(self, userId, document_id=None, book_ids=None, route="exercise", use_response_cache=True):
         self.userId = userId
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-        self.model = genai.GenerativeModel("gemini-2.0-flash")
+        # Gateway route whose concurrency limit the model calls count against
+        self.route = route
+        # Off for pool generation: its sets must neither come from nor land in the response cache
+        self.use_response_cache = use_response_cache
         self.rag_processor = RAGProcessor()
+        # Attach the user's whole library; retrieval is limited to book_ids when given
+        if userId:
+            self.rag_processor.load_library(userId)
+        self.book_ids = list(book_ids or []) + ([document_id] if document_id else []) or None
+        # Compaction report of the last retrieved context (tokens saved etc.)
+        self.context_report = None
+
+    def retrieve_context(self, query, k, token_budget):
+        """Compacted book context for a prompt, recording its compaction report"""
+        context_chunks, self.context_report = self.rag_processor.retrieve_context(
+            query, k=k, token_budget=token_budget, book_ids=self.book_ids
+        )
+        logger.info(f"Context compaction for {query!r}: {self.context_report}")
+        return context_chunks
+
+    async def generate(self, prompt, cached=False, fresh=False):
+        """Model answer to a prompt through the shared LLM gateway
+
+        cached serves context-free prompts from the response cache; fresh skips
+        the lookup and replaces the cached answer with a new one. Identical
+        prompts generated at the same time share one model call, except fresh
+        ones, which ask for a different answer. Without use_response_cache the
+        cache is neither read nor written.
+        """
+        cached = cached and self.use_response_cache
+        if cached and fresh:
+            response_cache.record_bypass()
+        elif cached:
+            answer = await run_in_threadpool(response_cache.get, EXERCISE_MODEL, prompt)
+            if answer is not None:
+                return answer
+
+        async def call():
+            answer = await llm_gateway.generate(prompt, EXERCISE_MODEL, route=self.route)
+            if cached:
+                await run_in_threadpool(response_cache.put, EXERCISE_MODEL, prompt, answer)
+            return answer
+
+        if fresh:
+            return await call()
+        return await generation_flights.do((cached, response_key(EXERCISE_MODEL, prompt)), call)
         
-    def upload_and_process_book(self, pdf_file):
+    def upload_and_process_book(self, pdf_file, filename=None):
         """Upload and process a PDF book for RAG"""
         try:
-            success = self.rag_processor.process_document(pdf_file)
+            success = self.rag_processor.process_document(
+                pdf_file, user_id=self.userId, metadata={"filename": filename}
+            )
             if success:
-                return {"status": "success", "message": "Book uploaded and indexed successfully"}
+                message = ("Book already indexed, attached existing index"
+                           if self.rag_processor.deduplicated
+                           else "Book uploaded and indexed successfully")
+                return {
+                    "status": "success",
+                    "message": message,
+                    "document_id": self.rag_processor.document_id
+                }
             else:
                 return {"status": "error", "message": "Failed to process the book"}
         except Exception as e:
             print(f"Error uploading book: {e}")
             return {"status": "error", "message": str(e)}
     
-    def generate_exercise_with_context(self, topic, exercise_type="mcq", num_questions=5, difficulty_level="medium"):
-        """Generate exercises based on uploaded book content"""
+    async def generate_exercise_with_context(self, topic, exercise_type="mcq", num_questions=5, difficulty_level="medium",
+                                       context_chunks=None, raise_errors=False, fresh=False):
+        """Generate exercises based on uploaded book content
+
+        context_chunks skips retrieval when the caller already has them (batch generation);
+        raise_errors propagates failures instead of returning an apology message.
+        """
         try:
             # Retrieve relevant context from the book
-            context_chunks = self.rag_processor.retrieve_top_chunks(topic, k=10)
+            if context_chunks is None:
+                context_chunks = await run_in_threadpool(self.retrieve_context, topic, 10, EXERCISE_CONTEXT_TOKENS)
             
             if not context_chunks:
-                return self.generate_exercise_without_context(topic, exercise_type, num_questions)
+                return await self.generate_exercise_without_context(topic, exercise_type, num_questions,
+                                                                    raise_errors=raise_errors, fresh=fresh)
             
             # Prepare context for the AI
             context = "\n\n".join(context_chunks)
@@ -86,93 +156,102 @@ class GenerateExercise:
 
             # Generate AI response with context
             system_instruction = os.getenv("EXERCISE_SYSTEM_INSTRUCTION")
-            response = self.model.generate_content(
-                contents=mcq_prompt if exercise_type == "mcq" else normal_prompt,
-                generation_config=types.GenerationConfig(
-                    system_instruction=system_instruction
-                )
-            )
-            logger.info(f"Raw AI response: {getattr(response, 'text', repr(response))}")
-            cleaned = clean_content(response.text)
+            prompt = mcq_prompt if exercise_type == "mcq" else normal_prompt
+            full_prompt = f"{system_instruction}\n\n{prompt}" if system_instruction else prompt
+            answer = await self.generate(full_prompt)
+            logger.info(f"Raw AI response: {answer}")
+            cleaned = clean_content(answer)
             logger.info(f"Cleaned content: {cleaned}")
             return cleaned
 
         except Exception as e:
+            if raise_errors:
+                raise
             logger.error(f"Error generating exercise with context: {e}")
             return "Sorry, there was an error generating the exercise with book context."
     
-    def generate_exercise_without_context(self, topic, exercise_type="mcq", num_questions=5):
-        """Generate exercises without book context (fallback)"""
+    async def generate_exercise_without_context(self, topic, exercise_type="mcq", num_questions=5, raise_errors=False,
+                                                fresh=False):
+        """Generate exercises without book context (fallback)
+
+        The answer is cached per prompt; fresh forces a new generation.
+        """
         try:
             prompt = f"Create {num_questions} {exercise_type} questions about: {topic}. For each question, provide four options labeled a), b), c), d). At the end, include an 'Answer Key' section in the following format:\nAnswer Key:\n1. b\n2. c\n..."
             
             system_instruction = os.getenv("EXERCISE_SYSTEM_INSTRUCTION")
             full_prompt = f"{system_instruction}\n\n{prompt}" if system_instruction else prompt
-            response = self.model.generate_content(
-                contents=full_prompt,
-                generation_config=types.GenerationConfig(
-                    # Add other config params here if needed
-                )
-            )
-            logger.info(f"Raw AI response (no context): {getattr(response, 'text', repr(response))}")
-            cleaned = clean_content(response.text)
+            answer = await self.generate(full_prompt, cached=True, fresh=fresh)
+            logger.info(f"Raw AI response (no context): {answer}")
+            cleaned = clean_content(answer)
             logger.info(f"Cleaned content (no context): {cleaned}")
             return cleaned
  
         except Exception as e:
+            if raise_errors:
+                raise
             logger.error(f"Error generating exercise: {e}")
             return "Sorry, there was an error generating the exercise."
     
-    def chat_with_mentor(self, topic):
+    async def chat_with_mentor(self, topic):
         """Original method for backward compatibility"""
-        return self.generate_exercise_with_context(topic)
+        return await self.generate_exercise_with_context(topic)
     
-    def ask_question_about_book(self, question):
+    async def question_prompt(self, question):
+        """Prompt answering a question from the book, or None if no relevant content was found"""
+        # Retrieve relevant context
+        context_chunks = await run_in_threadpool(self.retrieve_context, question, 5, QUESTION_CONTEXT_TOKENS)
+        
+        if not context_chunks:
+            return None
+        
+        context = "\n\n".join(context_chunks)
+        
+        # Create prompt for Q&A
+        qa_prompt = f"""
+        Based on the following book content, answer the question:
+        
+        Book Content:
+        {context}
+        
+        Question: {question}
+        
+        Please provide a comprehensive answer based on the book content.
+        """
+        
+        system_instruction = "You are a helpful assistant that answers questions based on provided book content. Be accurate and cite the relevant parts of the content when possible."
+        return f"{system_instruction}\n\n{qa_prompt}"
+
+    async def ask_question_about_book(self, question):
         """Ask a specific question about the uploaded book"""
         try:
-            # Retrieve relevant context
-            context_chunks = self.rag_processor.retrieve_top_chunks(question, k=5)
-            
-            if not context_chunks:
-                return "No relevant content found in the uploaded book for your question."
-            
-            context = "\n\n".join(context_chunks)
-            
-            # Create prompt for Q&A
-            qa_prompt = f"""
-            Based on the following book content, answer the question:
-            
-            Book Content:
-            {context}
+            full_prompt = await self.question_prompt(question)
+            if full_prompt is None:
+                return NO_BOOK_CONTENT_ANSWER
             
-            Question: {question}
+            answer = await self.generate(full_prompt)
             
-            Please provide a comprehensive answer based on the book content.
-            """
-            
-            system_instruction = "You are a helpful assistant that answers questions based on provided book content. Be accurate and cite the relevant parts of the content when possible."
-            full_prompt = f"{system_instruction}\n\n{qa_prompt}"
-            response = self.model.generate_content(
-                contents=full_prompt,
-                generation_config=types.GenerationConfig(
-                    # Add other config params here if needed
-                )
-            )
-            
-            return response.text
+            return answer
             
         except Exception as e:
             print(f"Error answering question: {e}")
             return "Sorry, there was an error processing your question."
+
+    def stream_answer(self, full_prompt):
+        """Pieces of the answer to a question_prompt as the model produces them"""
+        return llm_gateway.stream(full_prompt, EXERCISE_MODEL, route=self.route)
     
-    def generate_notes_with_context(self, topic, num_notes=5, difficulty_level="medium"):
+    async def generate_notes_with_context(self, topic, num_notes=5, difficulty_level="medium",
+                                    context_chunks=None, raise_errors=False, fresh=False):
         """Generate important notes based on uploaded book content"""
         try:
             # Retrieve relevant context from the book
-            context_chunks = self.rag_processor.retrieve_top_chunks(topic, k=15)
+            if context_chunks is None:
+                context_chunks = await run_in_threadpool(self.retrieve_context, topic, 15, NOTES_CONTEXT_TOKENS)
             
             if not context_chunks:
-                return self.generate_notes_without_context(topic, num_notes)
+                return await self.generate_notes_without_context(topic, num_notes, raise_errors=raise_errors,
+                                                                 fresh=fresh)
             
             # Prepare context for the AI
             context = "\n\n".join(context_chunks)
@@ -212,14 +291,10 @@ class GenerateExercise:
             
             # Generate AI response with context
             system_instruction = "You are an expert educational content creator. Generate well-structured, comprehensive notes that capture the most important information from the provided book content. Focus on clarity, accuracy, and educational value."
-            response = self.model.generate_content(
-                contents=notes_prompt,
-                generation_config=types.GenerationConfig(
-                    system_instruction=system_instruction
-                )
-            )
+            full_prompt = f"{system_instruction}\n\n{notes_prompt}"
+            answer = await self.generate(full_prompt)
             
-            logger.info(f"Raw AI response for notes: {getattr(response, 'text', repr(response))}")
+            logger.info(f"Raw AI response for notes: {answer}")
             
             # Try to parse JSON response
             try:
@@ -227,7 +302,7 @@ class GenerateExercise:
                 import re
                 
                 # Clean the response text to extract JSON
-                response_text = response.text.strip()
+                response_text = answer.strip()
                 
                 # Remove markdown code blocks if present
                 if response_text.startswith('```json'):
@@ -255,15 +330,20 @@ class GenerateExercise:
             except (json.JSONDecodeError, AttributeError) as e:
                 logger.error(f"JSON parsing failed: {e}")
                 # If JSON parsing fails, return as text format
-                cleaned = clean_content(response.text)
+                cleaned = clean_content(answer)
                 return [{"id": 1, "type": "Text", "content": cleaned}]
 
         except Exception as e:
+            if raise_errors:
+                raise
             logger.error(f"Error generating notes with context: {e}")
-            return self.generate_notes_without_context(topic, num_notes)
+            return await self.generate_notes_without_context(topic, num_notes, fresh=fresh)
     
-    def generate_notes_without_context(self, topic, num_notes=5):
-        """Generate notes without book context (fallback)"""
+    async def generate_notes_without_context(self, topic, num_notes=5, raise_errors=False, fresh=False):
+        """Generate notes without book context (fallback)
+
+        The answer is cached per prompt; fresh forces a new generation.
+        """
         try:
             prompt = f"""
             Create {num_notes} important section notes about: {topic}.
@@ -287,14 +367,9 @@ class GenerateExercise:
             
             system_instruction = "You are an expert educational content creator. Generate well-structured, comprehensive notes on the given topic. Focus on clarity, accuracy, and educational value."
             full_prompt = f"{system_instruction}\n\n{prompt}"
-            response = self.model.generate_content(
-                contents=full_prompt,
-                generation_config=types.GenerationConfig(
-                    # Add other config params here if needed
-                )
-            )
+            answer = await self.generate(full_prompt, cached=True, fresh=fresh)
             
-            logger.info(f"Raw AI response for notes (no context): {getattr(response, 'text', repr(response))}")
+            logger.info(f"Raw AI response for notes (no context): {answer}")
             
             # Try to parse JSON response
             try:
@@ -302,7 +377,7 @@ class GenerateExercise:
                 import re
                 
                 # Clean the response text to extract JSON
-                response_text = response.text.strip()
+                response_text = answer.strip()
                 
                 # Remove markdown code blocks if present
                 if response_text.startswith('```json'):
@@ -330,9 +405,21 @@ class GenerateExercise:
             except (json.JSONDecodeError, AttributeError) as e:
                 logger.error(f"JSON parsing failed (no context): {e}")
                 # If JSON parsing fails, return as text format
-                cleaned = clean_content(response.text)
+                cleaned = clean_content(answer)
                 return [{"id": 1, "type": "Text", "content": cleaned}]
  
         except Exception as e:
+            if raise_errors:
+                raise
             logger.error(f"Error generating notes: {e}")
-            return [{"id": 1, "type": "Text", "content": "Sorry, there was an error generating the notes."}]
\ No newline at end of file
+            return [{"id": 1, "type": "Text", "content": "Sorry, there was an error generating the notes."}]
+
+
+async def pregenerate_exercises(topic, exercise_type, num_questions):
+    """A new parsed exercise set for the pre-generation pool (no book context, no user)"""
+    generator = GenerateExercise(None, route="pregen", use_response_cache=False)
+    if is_notes_type(exercise_type):
+        return await generator.generate_notes_without_context(topic, num_questions, raise_errors=True, fresh=True)
+    exercises = await generator.generate_exercise_without_context(topic, exercise_type, num_questions,
+                                                                  raise_errors=True, fresh=True)
+    return parse_exercise_text(exercise_type, exercises)
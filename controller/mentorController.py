@@ -1,90 +1,141 @@
-import google.generativeai as genai
-from google.generativeai import types
+import anyio
+import asyncio
 import os
 import dotenv 
 import uuid
 from datetime import datetime
+from starlette.concurrency import run_in_threadpool
 from . import supabase  # Import the supabase client from __init__.py
 from model.mentor_chats import MentorChatModel
+from utils.llm_gateway import llm_gateway
+from utils.prompt_builder import mentor_prompt_builder, MENTOR_HISTORY_MAX_EXCHANGES
+import logging
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+MENTOR_MODEL = os.getenv("MENTOR_MODEL", "gemini-2.5-flash")
+
+# Background re-check of the Supabase connection; it never runs on the request path
+MENTOR_DB_CHECK_INTERVAL_SECONDS = float(os.getenv("MENTOR_DB_CHECK_INTERVAL_SECONDS", "300"))
+
 class Mentor:
-    def __init__(self, userId):
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-        self.model = genai.GenerativeModel("gemini-2.5-flash")
-        self.supabase = supabase  # Use the configured supabase client
-        
-        # Initialize the chat model and ensure table exists
-        self.chat_model = MentorChatModel(self.supabase)
+    """Process-wide mentor; everything per user is passed to its methods
+
+    One instance is created in the app lifespan and injected into the routes.
+    With an outbox (utils/write_behind.py) exchanges are saved write-behind.
+    """
+
+    def __init__(self, chat_model=None, outbox=None):
+        self.chat_model = chat_model or MentorChatModel(supabase)
+        self.supabase = self.chat_model.supabase
+        self.outbox = outbox
     
-    def chat_with_mentor(self, userId, message, chat_id=None):
-        try:
-            # Get or create chat session
-            if chat_id: 
-                # Use specific chat if provided
-                chat = self.chat_model.get_chat_by_id(chat_id)
-                if not chat:
-                    return "Sorry, the specified chat session was not found."
+    async def prepare_chat(self, userId, message, chat_id=None):
+        """(chat id, prompt) for a new message, or (None, error message) if the chat is unavailable"""
+        # Get or create chat session
+        if chat_id: 
+            # Use specific chat if provided
+            chat = await run_in_threadpool(self.chat_model.get_chat_by_id, chat_id)
+            if not chat:
+                return None, "Sorry, the specified chat session was not found."
+        else:
+            # Get or create new chat session
+            chat = await run_in_threadpool(self.chat_model.get_or_create_chat, userId)
+            if not chat:
+                print(chat)
+                return None, "Sorry, there was an error creating chat session."
+        
+        current_chat_id = chat['id']
+        
+        # Get conversation history to provide context
+        conversation_history = await run_in_threadpool(
+            self.chat_model.get_conversation_history, userId, current_chat_id, MENTOR_HISTORY_MAX_EXCHANGES
+        )
+        
+        # Fill the prompt's token budget with the most recent exchanges
+        system_instruction = os.getenv("MENTOR_SYSTEM_INSTRUCTION", "You are a helpful AI mentor.")
+        full_message, report = mentor_prompt_builder.build(system_instruction, conversation_history, message)
+        logger.info(f"Mentor prompt for chat {current_chat_id}: {report}")
+        return current_chat_id, full_message
+
+    async def save_exchange(self, chat_id, message, ai_response):
+        """Save the new message exchange to conversation
+
+        With a running outbox the exchange is only appended to its local log
+        and written to the database in the background.
+        """
+        if self.outbox is not None and self.outbox.running:
+            exchange = self.chat_model.new_exchange(message, ai_response)
+            try:
+                await self.outbox.enqueue(chat_id, exchange)
+            except OSError as e:
+                logger.warning(f"Could not queue exchange for chat {chat_id}, saving it directly: {e}")
             else:
-                # Get or create new chat session
-                chat = self.chat_model.get_or_create_chat(userId)
-                if not chat:
-                    print(chat)
-                    return "Sorry, there was an error creating chat session."
-            
-            current_chat_id = chat['id']
-            
-            # Get conversation history to provide context
-            conversation_history = self.chat_model.get_conversation_history(userId, current_chat_id)
-            
-            # Build context from previous messages (last 10 exchanges for context)
-            context_messages = []
-            for exchange in conversation_history[-10:]:  # Last 10 exchanges
-                context_messages.append(f"User: {exchange.get('user_message', '')}")
-                context_messages.append(f"Assistant: {exchange.get('mentor_response', '')}")
-            
-            # Prepare the full prompt with context
-            system_instruction = os.getenv("MENTOR_SYSTEM_INSTRUCTION", "You are a helpful AI mentor.")
-            context_text = "\n".join(context_messages) if context_messages else ""
-            
-            full_message = f"{system_instruction}\n\nPrevious conversation:\n{context_text}\n\nUser: {message}"
+                self.chat_model.cache.append(chat_id, exchange)
+                return True
+
+        print(f"Attempting to save conversation to chat ID: {chat_id}")
+        saved_conversation = await run_in_threadpool(
+            self.chat_model.add_message_to_conversation,
+            chat_id=chat_id,
+            user_message=message,
+            mentor_response=ai_response
+        )
+        
+        if saved_conversation:
+            print("Conversation saved successfully")
+        else:
+            print("Failed to save conversation, but continuing...")
+            # Let's also try to verify the chat exists
+            existing_chat = await run_in_threadpool(self.chat_model.get_chat_by_id, chat_id)
+            if existing_chat:
+                print(f"Chat exists in database: {existing_chat['id']}")
+            else:
+                print("Chat does not exist in database!")
+        return saved_conversation
+
+    async def chat_with_mentor(self, userId, message, chat_id=None):
+        try:
+            current_chat_id, full_message = await self.prepare_chat(userId, message, chat_id)
+            if current_chat_id is None:
+                return full_message
             
             # Generate AI response
-            response = self.model.generate_content(
-                contents=full_message,
-                generation_config=types.GenerationConfig(
-                    # Add other config params here if needed
-                )
-            )
-            
-            ai_response = response.text
-            
-            # Save the new message exchange to conversation
-            print(f"Attempting to save conversation to chat ID: {current_chat_id}")
-            saved_conversation = self.chat_model.add_message_to_conversation(
-                chat_id=current_chat_id,
-                user_message=message,
-                mentor_response=ai_response
-            )
-            
-            if saved_conversation:
-                print("Conversation saved successfully")
-            else:
-                print("Failed to save conversation, but continuing...")
-                # Let's also try to verify the chat exists
-                existing_chat = self.chat_model.get_chat_by_id(current_chat_id)
-                if existing_chat:
-                    print(f"Chat exists in database: {existing_chat['id']}")
-                else:
-                    print("Chat does not exist in database!")
+            ai_response = await llm_gateway.generate(full_message, MENTOR_MODEL, route="mentor")
             
+            await self.save_exchange(current_chat_id, message, ai_response)
             return ai_response
             
         except Exception as e:
             print(f"Error in chat_with_mentor: {e}")
             return "Sorry, there was an error processing your request."
+
+    async def stream_chat(self, chat_id, message, full_message):
+        """Stream the mentor's answer piece by piece
+
+        Whatever was generated is saved once the stream ends, fails or is
+        closed because the client disconnected. The save is shielded from the
+        cancellation that a disconnect delivers.
+        """
+        pieces = []
+        try:
+            async for piece in llm_gateway.stream(full_message, MENTOR_MODEL, route="mentor"):
+                pieces.append(piece)
+                yield piece
+        finally:
+            if pieces:
+                with anyio.CancelScope(shield=True):
+                    await self.save_exchange(chat_id, message, "".join(pieces))
     
     def get_chat_history(self, userId, limit=50):
         """Retrieve chat history for a user"""
         return self.chat_model.get_conversation_history(userId)
+
+
+async def check_connection_periodically(chat_model, interval=MENTOR_DB_CHECK_INTERVAL_SECONDS):
+    """Re-run the chat table connection check every interval seconds until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        await run_in_threadpool(chat_model.test_connection)
@@ -0,0 +1,53 @@
+-- Append-only storage for mentor conversations (MENTOR_MESSAGE_STORAGE=rows or rpc).
+-- Safe to run more than once.
+
+-- 1. One row per exchange. Adding a message is a single insert, and
+--    concurrent messages on the same chat can no longer overwrite each other.
+CREATE TABLE IF NOT EXISTS public.mentor_messages (
+  id UUID NOT NULL DEFAULT gen_random_uuid(),
+  chat_id UUID NOT NULL,
+  user_message TEXT NOT NULL,
+  mentor_response TEXT NOT NULL,
+  created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+  CONSTRAINT mentor_messages_pkey PRIMARY KEY (id),
+  CONSTRAINT mentor_messages_chat_id_fkey FOREIGN KEY (chat_id)
+    REFERENCES mentor_chats (id) ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS mentor_messages_chat_id_created_at_idx
+  ON public.mentor_messages (chat_id, created_at, id);
+
+-- 2. Atomic server-side append for deployments that keep the conversation
+--    array. The array is extended in one UPDATE, so no exchange is lost.
+CREATE OR REPLACE FUNCTION public.append_mentor_exchange(p_chat_id UUID, p_exchange JSONB)
+RETURNS BOOLEAN
+LANGUAGE sql
+AS $$
+  UPDATE public.mentor_chats
+     SET conversation = (COALESCE(conversation::jsonb, '[]'::jsonb) || jsonb_build_array(p_exchange))::json
+   WHERE id = p_chat_id
+  RETURNING true;
+$$;
+
+-- 3. Backfill: copy existing conversation arrays into mentor_messages.
+--    Run it after switching the server to MENTOR_MESSAGE_STORAGE=rows, so
+--    arrays are no longer written. Exchange ids are kept and duplicates are
+--    skipped, so running it again is harmless. Older exchanges have naive
+--    timestamps in the server's local time; they are read as UTC here, like
+--    the server does on a UTC host. Change 'UTC' if the servers ran elsewhere.
+INSERT INTO public.mentor_messages (id, chat_id, user_message, mentor_response, created_at)
+SELECT COALESCE((exchange->>'id')::uuid, gen_random_uuid()),
+       chat.id,
+       COALESCE(exchange->>'user_message', ''),
+       COALESCE(exchange->>'mentor_response', ''),
+       COALESCE(CASE WHEN exchange->>'timestamp' ~ '(Z|[+-]\d\d(:?\d\d)?)$'
+                     THEN (exchange->>'timestamp')::timestamptz
+                     ELSE (exchange->>'timestamp')::timestamp AT TIME ZONE 'UTC'
+                END,
+                chat.created_at)
+  FROM public.mentor_chats AS chat,
+       json_array_elements(COALESCE(chat.conversation, '[]'::json)) AS exchange
+ON CONFLICT (id) DO NOTHING;
+
+-- 4. Optional, once every server runs in rows mode and the backfill is verified:
+-- UPDATE public.mentor_chats SET conversation = '[]'::json;
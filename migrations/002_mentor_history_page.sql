@@ -0,0 +1,50 @@
+-- One page of a chat's conversation array for GET /mentor/history/{user_id}/page
+-- in MENTOR_MESSAGE_STORAGE=rpc mode. The array is unpacked and sliced in
+-- the database, so only the requested exchanges are sent to the server.
+-- Exchanges are ordered by when they happened, not by their timestamp
+-- strings: older exchanges have naive timestamps (read as UTC, as in
+-- 001_mentor_messages.sql) and newer ones carry an offset.
+-- Safe to run more than once.
+CREATE OR REPLACE FUNCTION public.mentor_exchange_time(p_timestamp TEXT)
+RETURNS TIMESTAMPTZ
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT CASE WHEN COALESCE(p_timestamp, '') = '' THEN '-infinity'::timestamptz
+              WHEN p_timestamp ~ '(Z|[+-]\d\d(:?\d\d)?)$' THEN p_timestamp::timestamptz
+              ELSE p_timestamp::timestamp AT TIME ZONE 'UTC'
+         END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.mentor_history_page(
+  p_chat_id UUID,
+  p_limit INTEGER,
+  p_newest_first BOOLEAN DEFAULT true,
+  p_cursor_time TEXT DEFAULT NULL,
+  p_cursor_id TEXT DEFAULT NULL
+)
+RETURNS SETOF JSONB
+LANGUAGE sql
+STABLE
+AS $$
+  WITH exchanges AS (
+    SELECT exchange,
+           public.mentor_exchange_time(exchange->>'timestamp') AS at,
+           COALESCE(exchange->>'id', '') AS exchange_id
+      FROM public.mentor_chats AS chat,
+           jsonb_array_elements(COALESCE(chat.conversation::jsonb, '[]'::jsonb)) AS exchange
+     WHERE chat.id = p_chat_id
+  )
+  SELECT exchange
+    FROM exchanges
+   WHERE p_cursor_time IS NULL
+      OR (p_newest_first
+          AND (at, exchange_id) < (public.mentor_exchange_time(p_cursor_time), COALESCE(p_cursor_id, '')))
+      OR (NOT p_newest_first
+          AND (at, exchange_id) > (public.mentor_exchange_time(p_cursor_time), COALESCE(p_cursor_id, '')))
+   ORDER BY CASE WHEN p_newest_first THEN at END DESC,
+            CASE WHEN p_newest_first THEN exchange_id END DESC,
+            CASE WHEN NOT p_newest_first THEN at END ASC,
+            CASE WHEN NOT p_newest_first THEN exchange_id END ASC
+   LIMIT p_limit;
+$$;
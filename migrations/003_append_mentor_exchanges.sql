@@ -0,0 +1,22 @@
+-- Batched, idempotent append used by the write-behind queue in
+-- MENTOR_MESSAGE_STORAGE=rpc mode. Exchanges whose id is already in the
+-- conversation are skipped, so a retried batch is not stored twice.
+-- Safe to run more than once.
+CREATE OR REPLACE FUNCTION public.append_mentor_exchanges(p_chat_id UUID, p_exchanges JSONB)
+RETURNS BOOLEAN
+LANGUAGE sql
+AS $$
+  UPDATE public.mentor_chats
+     SET conversation = (
+           COALESCE(conversation::jsonb, '[]'::jsonb)
+           || COALESCE((SELECT jsonb_agg(incoming.exchange ORDER BY incoming.ord)
+                          FROM jsonb_array_elements(p_exchanges) WITH ORDINALITY AS incoming(exchange, ord)
+                         WHERE NOT EXISTS (
+                           SELECT 1
+                             FROM jsonb_array_elements(COALESCE(conversation::jsonb, '[]'::jsonb)) AS stored
+                            WHERE stored->>'id' = incoming.exchange->>'id')),
+                       '[]'::jsonb)
+         )::json
+   WHERE id = p_chat_id
+  RETURNING true;
+$$;
@@ -1,41 +1,116 @@
 from supabase import Client
+import base64
 import logging
 import json
-from typing import List, Dict, Optional
+import os
+from typing import List, Dict, Optional, Tuple
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
+from utils.chat_cache import ChatCache
+
+# Where exchanges are stored (see migrations/001_mentor_messages.sql):
+#   array - the mentor_chats.conversation array, read and rewritten on every message;
+#           simultaneous saves to one chat can overwrite each other
+#   rows  - one mentor_messages row per exchange (append-only)
+#   rpc   - the conversation array, extended atomically by append_mentor_exchange
+MENTOR_MESSAGE_STORAGE = os.getenv("MENTOR_MESSAGE_STORAGE", "array")
+
+def encode_cursor(exchange: Dict) -> str:
+    """Opaque page cursor for the position just after an exchange"""
+    position = json.dumps([exchange.get("timestamp") or "", exchange.get("id") or ""])
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> tuple:
+    """(timestamp, exchange id) of a cursor; ValueError if it is malformed"""
+    try:
+        timestamp, exchange_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(timestamp), str(exchange_id)
+    except Exception:
+        raise ValueError("Invalid history cursor")
+
+def parse_timestamp(timestamp: Optional[str]) -> datetime:
+    """An exchange timestamp as an aware datetime for ordering; naive ones are server-local
+    time, and missing or unreadable ones sort before everything else"""
+    try:
+        return datetime.fromisoformat(timestamp).astimezone(timezone.utc)
+    except (TypeError, ValueError):
+        return datetime.min.replace(tzinfo=timezone.utc)
+
+def utc_timestamp(timestamp: str) -> str:
+    """An exchange timestamp as aware UTC; naive ones (older exchanges) are server-local time"""
+    return datetime.fromisoformat(timestamp).astimezone(timezone.utc).isoformat()
 
 class MentorChatModel:
-    def __init__(self, supabase_client: Client):
+    def __init__(self, supabase_client: Client, storage: str = MENTOR_MESSAGE_STORAGE,
+                 cache: Optional[ChatCache] = None):
         self.supabase = supabase_client
         self.table_name = "mentor_chats"
-        # Test the connection
-        self.test_connection()
+        self.messages_table = "mentor_messages"
+        if storage not in ("array", "rows", "rpc"):
+            raise ValueError(f"Unknown MENTOR_MESSAGE_STORAGE: {storage!r}")
+        self.storage = storage
+        # Chats recently used by this process; see utils/chat_cache.py
+        self.cache = cache or ChatCache()
+        # Result of the last connection test; tests run at startup and periodically, not per request
+        self.connection_ok = None
+        self.connection_error = None
+        self.connection_checked_at = None
     
-    def test_connection(self):
+    def test_connection(self) -> bool:
         """Test the Supabase connection and table access"""
         try:
             print("Testing Supabase connection...")
             result = self.supabase.table(self.table_name).select("id").limit(1).execute()
             print(f"Connection test successful. Table access: OK")
+            self.connection_ok, self.connection_error = True, None
         except Exception as e:
             print(f"Connection test failed: {e}")
+            self.connection_ok, self.connection_error = False, str(e)
+        self.connection_checked_at = datetime.now().isoformat()
+        return self.connection_ok
+
+    def connection_status(self) -> Dict:
+        return {
+            "ok": self.connection_ok,
+            "error": self.connection_error,
+            "checked_at": self.connection_checked_at,
+        }
     
+    def _cache_chat(self, chat: Dict):
+        """Cache a chat row read with its conversation column"""
+        # In rows mode the array is not the history, so the exchanges are left to be read
+        self.cache.put(chat, None if self.storage == "rows" else chat.get("conversation") or [])
+
     def get_chat_by_id(self, chat_id: str) -> Optional[Dict]:
-        """Get a specific chat by its ID"""
+        """Get a specific chat by its ID
+
+        Served from the cache when possible, in which case the chat comes
+        back without its conversation; use get_conversation_history for that.
+        """
+        cached = self.cache.get(chat_id)
+        if cached is not None:
+            return dict(cached["chat"])
         try:
             result = self.supabase.table(self.table_name)\
                 .select("*")\
                 .eq("id", chat_id)\
                 .execute()
             
-            return result.data[0] if result.data else None
+            if not result.data:
+                return None
+            self._cache_chat(result.data[0])
+            return result.data[0]
         except Exception as e:
             print(f"Error getting chat by ID: {e}")
             return None
     
     def get_or_create_chat(self, user_id: str, title: Optional[str] = None) -> Optional[Dict]:
-        """Get existing chat or create a new one for the user"""
+        """Get existing chat or create a new one for the user
+
+        Always asks the database: the chat picked here is the one written to,
+        and another worker may have created a newer chat since this process
+        cached the user's latest one.
+        """
         try:
             # Try to get the most recent chat for this user
             result = self.supabase.table(self.table_name)\
@@ -46,6 +121,8 @@ class MentorChatModel:
                 .execute()
             
             if result.data:
+                self._cache_chat(result.data[0])
+                self.cache.set_latest(user_id, result.data[0]["id"])
                 return result.data[0]
             else:
                 # Create new chat if none exists
@@ -82,6 +159,8 @@ class MentorChatModel:
             
             if result.data and len(result.data) > 0:
                 print(f"Successfully created chat with ID: {result.data[0]['id']}")
+                self.cache.put(result.data[0], [])
+                self.cache.set_latest(user_id, result.data[0]["id"])
                 return result.data[0]
             else:
                 print("No data returned from insert operation")
@@ -92,56 +171,160 @@ class MentorChatModel:
             print(f"Error type: {type(e)}")
             return None
     
+    @staticmethod
+    def new_exchange(user_message: str, mentor_response: str) -> Dict:
+        return {
+            "id": str(uuid.uuid4()),
+            "user_message": user_message,
+            "mentor_response": mentor_response,
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+
     def add_message_to_conversation(self, chat_id: str, user_message: str, mentor_response: str) -> bool:
         """Add a new message exchange to the conversation"""
         try:
             print(f"Adding message to chat ID: {chat_id}")
             
-            # Get current chat
-            chat_result = self.supabase.table(self.table_name)\
-                .select("*")\
-                .eq("id", chat_id)\
-                .execute()
-            
-            if not chat_result.data:
-                print(f"Chat with id {chat_id} not found")
-                return False
-            
-            chat = chat_result.data[0]
-            conversation = chat.get("conversation", [])
-            print(f"Current conversation has {len(conversation)} messages")
-            
             # Add new message exchange
-            new_exchange = {
-                "id": str(uuid.uuid4()),
-                "user_message": user_message,
-                "mentor_response": mentor_response,
-                "timestamp": datetime.now().isoformat()
-            }
-            
-            conversation.append(new_exchange)
-            print(f"Adding new exchange, conversation now has {len(conversation)} messages")
-            
-            # Update the chat with new conversation
-            update_result = self.supabase.table(self.table_name)\
-                .update({"conversation": conversation})\
-                .eq("id", chat_id)\
-                .execute()
-            
-            if update_result.data and len(update_result.data) > 0:
-                print("Successfully updated conversation in database")
-                return True
-            else:
-                print("Update operation returned no data")
-                return False
-            
+            new_exchange = self.new_exchange(user_message, mentor_response)
+            saved = self._save_exchange(chat_id, new_exchange)
         except Exception as e:
             print(f"Error adding message to conversation: {e}")
+            saved = False
+        if saved:
+            # Array mode already refreshed the cache from the conversation it wrote
+            if self.storage != "array":
+                self.cache.append(chat_id, new_exchange)
+        else:
+            # The cached chat may no longer match the database
+            self.cache.invalidate(chat_id)
+        return saved
+
+    def _save_exchange(self, chat_id: str, new_exchange: Dict) -> bool:
+        if self.storage == "rows":
+            return self._insert_exchange(chat_id, new_exchange)
+        if self.storage == "rpc":
+            result = self.supabase.rpc("append_mentor_exchange",
+                                       {"p_chat_id": chat_id, "p_exchange": new_exchange}).execute()
+            return bool(result.data)
+
+        # Always the stored conversation, never the cache: other workers may have
+        # appended since this process cached it, and the update overwrites the array
+        chat_result = self.supabase.table(self.table_name)\
+            .select("conversation")\
+            .eq("id", chat_id)\
+            .execute()
+        
+        if not chat_result.data:
+            print(f"Chat with id {chat_id} not found")
+            return False
+        
+        conversation = chat_result.data[0].get("conversation") or []
+        print(f"Current conversation has {len(conversation)} messages")
+            
+        conversation = conversation + [new_exchange]
+        print(f"Adding new exchange, conversation now has {len(conversation)} messages")
+        
+        # Update the chat with new conversation
+        update_result = self.supabase.table(self.table_name)\
+            .update({"conversation": conversation})\
+            .eq("id", chat_id)\
+            .execute()
+        
+        if update_result.data and len(update_result.data) > 0:
+            print("Successfully updated conversation in database")
+            self.cache.set_exchanges(chat_id, conversation, complete=True)
+            return True
+        else:
+            print("Update operation returned no data")
             return False
+
+    def save_exchanges(self, batch: List[Tuple[str, Dict]]) -> bool:
+        """Persist queued (chat id, exchange) pairs, oldest first; raises on failure
+
+        Used by the write-behind queue. Exchanges that are already stored
+        (same id) are skipped, so a batch can safely be sent again.
+        """
+        if self.storage == "rows":
+            # One request for the whole batch; created_at keeps the order the exchanges were made in
+            self.supabase.table(self.messages_table).upsert([{
+                "id": exchange["id"],
+                "chat_id": chat_id,
+                "user_message": exchange["user_message"],
+                "mentor_response": exchange["mentor_response"],
+                "created_at": utc_timestamp(exchange["timestamp"]),
+            } for chat_id, exchange in batch], ignore_duplicates=True).execute()
+            return True
+
+        by_chat: Dict[str, List[Dict]] = {}
+        for chat_id, exchange in batch:
+            by_chat.setdefault(chat_id, []).append(exchange)
+        for chat_id, exchanges in by_chat.items():
+            if self.storage == "rpc":
+                self.supabase.rpc("append_mentor_exchanges",
+                                  {"p_chat_id": chat_id, "p_exchanges": exchanges}).execute()
+                continue
+            chat_result = self.supabase.table(self.table_name)\
+                .select("conversation")\
+                .eq("id", chat_id)\
+                .execute()
+            if not chat_result.data:
+                print(f"Chat with id {chat_id} not found, dropping {len(exchanges)} queued exchange(s)")
+                continue
+            conversation = chat_result.data[0].get("conversation") or []
+            stored = {exchange.get("id") for exchange in conversation}
+            new = [exchange for exchange in exchanges if exchange["id"] not in stored]
+            if new:
+                self.supabase.table(self.table_name)\
+                    .update({"conversation": conversation + new})\
+                    .eq("id", chat_id)\
+                    .execute()
+        return True
+
+    def _insert_exchange(self, chat_id: str, exchange: Dict) -> bool:
+        """One insert, independent of the conversation's length"""
+        result = self.supabase.table(self.messages_table).insert({
+            "id": exchange["id"],
+            "chat_id": chat_id,
+            "user_message": exchange["user_message"],
+            "mentor_response": exchange["mentor_response"],
+            "created_at": utc_timestamp(exchange["timestamp"]),
+        }).execute()
+        return bool(result.data)
+
+    def _exchanges(self, chat_id: str, limit: Optional[int] = None) -> List[Dict]:
+        """Exchanges of a chat from mentor_messages, oldest first, in the conversation array's shape"""
+        query = self.supabase.table(self.messages_table)\
+            .select("id, user_message, mentor_response, created_at")\
+            .eq("chat_id", chat_id)
+        if limit:
+            # The newest `limit` rows, returned oldest first
+            rows = query.order("created_at", desc=True).order("id", desc=True).limit(limit).execute().data or []
+            rows.reverse()
+        else:
+            rows = query.order("created_at").order("id").execute().data or []
+        return [{"id": row["id"], "user_message": row["user_message"],
+                 "mentor_response": row["mentor_response"], "timestamp": row["created_at"]} for row in rows]
     
-    def get_conversation_history(self, user_id: str, chat_id: Optional[str] = None) -> List[Dict]:
-        """Get conversation history for a user or specific chat"""
+    def get_conversation_history(self, user_id: str, chat_id: Optional[str] = None,
+                                 limit: Optional[int] = None) -> List[Dict]:
+        """Get conversation history for a user or specific chat
+
+        limit keeps only the newest exchanges (still oldest first).
+        """
+        cached_id = chat_id or (self.cache.latest_chat(user_id) or {}).get("id")
+        cached = self.cache.exchanges(cached_id, limit) if cached_id else None
+        if cached is not None:
+            return cached
         try:
+            if self.storage == "rows":
+                chat_id = chat_id or self.latest_chat_id(user_id)
+                if not chat_id:
+                    return []
+                exchanges = self._exchanges(chat_id, limit)
+                self.cache.set_exchanges(chat_id, exchanges, complete=not limit or len(exchanges) < limit)
+                return exchanges
+
             query = self.supabase.table(self.table_name).select("*")
             
             if chat_id:
@@ -149,17 +332,87 @@ class MentorChatModel:
             else:
                 query = query.eq("user_id", user_id)
             
-            result = query.order("created_at", desc=True).execute()
+            result = query.order("created_at", desc=True).limit(1).execute()
             
             if result.data:
+                self._cache_chat(result.data[0])
+                if not chat_id:
+                    self.cache.set_latest(user_id, result.data[0]["id"])
                 # Return the conversation array from the most recent chat
-                return result.data[0].get("conversation", [])
+                conversation = result.data[0].get("conversation") or []
+                return conversation[-limit:] if limit else conversation
             return []
             
         except Exception as e:
             print(f"Error retrieving conversation history: {e}")
             return []
     
+    def latest_chat_id(self, user_id: str) -> Optional[str]:
+        """Id of the user's most recent chat, fetching nothing else"""
+        result = self.supabase.table(self.table_name)\
+            .select("id")\
+            .eq("user_id", user_id)\
+            .order("created_at", desc=True)\
+            .limit(1)\
+            .execute()
+        return result.data[0]["id"] if result.data else None
+
+    def get_history_page(self, user_id: str, chat_id: Optional[str] = None, limit: int = 20,
+                         newest_first: bool = True, cursor: Optional[str] = None) -> Dict:
+        """One page of a chat's exchanges, keyset-paginated on (timestamp, id)
+
+        cursor is the next_cursor of the previous page. Only the page's rows
+        and columns are fetched in rows mode; rpc mode slices the array in the
+        database (mentor_history_page). Array mode reads the chat's whole
+        conversation for every page and slices it here, so long chats should
+        use rows or rpc. Timestamps are compared as instants, not strings, as
+        older exchanges have naive ones and newer ones carry an offset.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        chat_id = chat_id or self.latest_chat_id(user_id)
+        if not chat_id:
+            return {"chat_id": None, "history": [], "next_cursor": None}
+
+        if self.storage == "rows":
+            query = self.supabase.table(self.messages_table)\
+                .select("id, user_message, mentor_response, created_at")\
+                .eq("chat_id", chat_id)
+            if after:
+                op = "lt" if newest_first else "gt"
+                timestamp, exchange_id = (f'"{value}"' for value in after)
+                query = query.or_(f"created_at.{op}.{timestamp},and(created_at.eq.{timestamp},id.{op}.{exchange_id})")
+            rows = query.order("created_at", desc=newest_first)\
+                .order("id", desc=newest_first)\
+                .limit(limit + 1)\
+                .execute().data or []
+            page = [{"id": row["id"], "user_message": row["user_message"],
+                     "mentor_response": row["mentor_response"], "timestamp": row["created_at"]} for row in rows]
+        elif self.storage == "rpc":
+            page = self.supabase.rpc("mentor_history_page", {
+                "p_chat_id": chat_id,
+                "p_limit": limit + 1,
+                "p_newest_first": newest_first,
+                "p_cursor_time": after[0] if after else None,
+                "p_cursor_id": after[1] if after else None,
+            }).execute().data or []
+        else:
+            result = self.supabase.table(self.table_name)\
+                .select("conversation")\
+                .eq("id", chat_id)\
+                .execute()
+            conversation = (result.data[0].get("conversation") or []) if result.data else []
+            keyed = [((parse_timestamp(exchange.get("timestamp")), exchange.get("id") or ""), exchange)
+                     for exchange in conversation]
+            keyed.sort(key=lambda pair: pair[0], reverse=newest_first)
+            if after:
+                position = (parse_timestamp(after[0]), after[1])
+                keyed = [(key, e) for key, e in keyed if (key < position if newest_first else key > position)]
+            page = [exchange for _, exchange in keyed[:limit + 1]]
+
+        # One extra row tells whether another page follows
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return {"chat_id": chat_id, "history": page[:limit], "next_cursor": next_cursor}
+
     def get_user_chats(self, user_id: str, limit: int = 10) -> List[Dict]:
         """Get all chats for a user"""
         try:
@@ -182,6 +435,7 @@ class MentorChatModel:
                 .update({"title": title})\
                 .eq("id", chat_id)\
                 .execute()
+            self.cache.invalidate(chat_id)
             
             return len(result.data) > 0
         except Exception as e:
@@ -211,6 +465,7 @@ class MentorChatModel:
                 .delete()\
                 .eq("id", chat_id)\
                 .execute()
+            self.cache.invalidate(chat_id, user_id)
             
             return len(result.data) > 0
         except Exception as e:
@@ -1,10 +1,18 @@
-from controller.generateExercise import GenerateExercise
+from controller.generateExercise import GenerateExercise, EXERCISE_CONTEXT_TOKENS, NOTES_CONTEXT_TOKENS, NO_BOOK_CONTENT_ANSWER
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Body
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
+import asyncio
+import hashlib
 import logging
+import os
 from controller import supabase
-from utils.helper import parse_mcq_text, parse_sqs_text, parse_lqs_text, parse_blanks_text, parse_true_false_text
+from utils.document_store import document_store
+from utils.ingestion_jobs import ingestion_jobs
+from utils.pregeneration import pregeneration
+from utils.helper import parse_exercise_text, is_notes_type, sse_text_stream, SSE_HEADERS
 
 router = APIRouter()
 
@@ -12,134 +20,258 @@ router = APIRouter()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+GENERATE_BATCH_MAX_ITEMS = int(os.getenv("GENERATE_BATCH_MAX_ITEMS", "100"))
+GENERATE_BATCH_CONCURRENCY = int(os.getenv("GENERATE_BATCH_CONCURRENCY", "8"))
+
 class ExerciseRequest(BaseModel):
     userId: str
     topic: str
     exercise_type: Optional[str] = "mcq"
     difficulty_level: Optional[str] = "medium"
     num_questions: Optional[int] = 5
+    document_id: Optional[str] = None
+    book_ids: Optional[List[str]] = None
+    # Skip the response cache for a new variant of a context-free request
+    fresh: Optional[bool] = False
+
+class BatchExerciseRequest(BaseModel):
+    userId: str
+    topics: List[str]
+    exercise_types: List[str] = ["mcq"]
+    difficulty_level: Optional[str] = "medium"
+    num_questions: Optional[int] = 5
+    document_id: Optional[str] = None
+    book_ids: Optional[List[str]] = None
 
 class QuestionRequest(BaseModel):
     userId: str
     question: str
+    document_id: Optional[str] = None
+    book_ids: Optional[List[str]] = None
 
-@router.post("/exercise/upload-book")
+@router.post("/exercise/upload-book", status_code=202)
 async def upload_book(userId: str = Form(...), file: UploadFile = File(...)):
-    """Upload and process a PDF book for exercise generation"""
+    """Queue a PDF book for background ingestion and return a job id to poll"""
+    if not file.filename.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF files are supported")
     try:
-        if not file.filename.endswith('.pdf'):
-            raise HTTPException(status_code=400, detail="Only PDF files are supported")
-        
-        exercise_generator = GenerateExercise(userId)
-        result = exercise_generator.upload_and_process_book(file.file)
-        
-        if result["status"] == "success":
-            return {"message": result["message"]}
-        else:
-            raise HTTPException(status_code=400, detail=result["message"])
-            
+        job = ingestion_jobs.create(userId, file.filename)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    try:
+        # Write the upload to disk for the parser processes, hashing it on the way
+        digest = hashlib.sha256()
+        out = await run_in_threadpool(open, job.path, "wb")
+        try:
+            while block := await file.read(1024 * 1024):
+                digest.update(block)
+                await run_in_threadpool(out.write, block)
+        finally:
+            await run_in_threadpool(out.close)
+    except Exception as e:
+        # Don't leave a job stuck in "queued" or a partial upload behind
+        await run_in_threadpool(ingestion_jobs.fail, job, e)
+        raise HTTPException(status_code=500, detail=str(e))
+    try:
+        job = await run_in_threadpool(ingestion_jobs.submit, job, digest.hexdigest())
+        status = job.to_dict()
+        message = status["result"]["message"] if status["result"] else "Book queued for processing"
+        return {
+            "message": message,
+            "job_id": job.job_id,
+            "status": job.status,
+            "status_url": f"/api/exercise/upload-status/{job.job_id}",
+            "document_id": status["result"]["document_id"] if status["result"] else None
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/exercise/upload-status/{job_id}")
+async def get_upload_status(job_id: str):
+    """Progress (pages parsed, chunks embedded) and result of a book ingestion job"""
+    status = ingestion_jobs.get(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+@router.get("/exercise/documents/{user_id}")
+async def list_documents(user_id: str):
+    """List the books stored for a user"""
+    try:
+        return {"documents": document_store.list_documents(user_id)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/exercise/documents/{user_id}/memory")
+async def get_library_memory(user_id: str):
+    """Bytes of vectors, chunk texts and BM25 postings per book in a user's library"""
+    try:
+        return await run_in_threadpool(document_store.memory_report, user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.delete("/exercise/documents/{user_id}/{document_id}")
+async def delete_document(user_id: str, document_id: str):
+    """Remove a book from a user; its index is deleted once no user holds it"""
+    try:
+        if not document_store.delete(user_id, document_id):
+            raise HTTPException(status_code=404, detail="Document not found")
+        return {"message": "Document removed", "document_id": document_id}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/exercise/generate")
 async def generate_exercise(request: ExerciseRequest):
     """Generate exercises based on uploaded book content"""
     try:
         logger.info(f"Received generate_exercise request: {request}")
-        exercise_generator = GenerateExercise(request.userId)
+        exercise_generator = await run_in_threadpool(GenerateExercise, request.userId, request.document_id, request.book_ids)
         
         # Handle notes generation separately
-        if request.exercise_type.lower() in ["notes generation", "notes", "note generation"]:
-            exercises = exercise_generator.generate_notes_with_context(
+        if is_notes_type(request.exercise_type):
+            exercises = await exercise_generator.generate_notes_with_context(
                 topic=request.topic,
                 num_notes=request.num_questions,
-                difficulty_level=request.difficulty_level
+                difficulty_level=request.difficulty_level,
+                fresh=request.fresh
             )
         else:
-            exercises = exercise_generator.generate_exercise_with_context(
+            exercises = await exercise_generator.generate_exercise_with_context(
                 topic=request.topic,
                 exercise_type=request.exercise_type,
                 num_questions=request.num_questions,
-                difficulty_level=request.difficulty_level
+                difficulty_level=request.difficulty_level,
+                fresh=request.fresh
             )
-            # If MCQ, parse to array
-            if request.exercise_type.lower() in ["multiple choice", "mcq", "mcqs"]:
-                if isinstance(exercises, str):
-                    exercises = parse_mcq_text(exercises)
-            # If True/False, parse to array
-            elif request.exercise_type.lower() in ["true/false", "true_false", "true false", "tf"]:
-                if isinstance(exercises, str):
-                    exercises = parse_true_false_text(exercises)
-            # If SQS, parse to array
-            elif request.exercise_type.lower() in ["short answer", "short_questions", "short question", "sqs"]:
-                if isinstance(exercises, str):
-                    exercises = parse_sqs_text(exercises)
-            # If LQS, parse to array
-            elif request.exercise_type.lower() in ["long questions", "long_questions", "long question", "lqs"]:
-                if isinstance(exercises, str):
-                    exercises = parse_lqs_text(exercises)
-            # If Fill in the Blanks, parse to array
-            elif request.exercise_type.lower() in ["fill in the blanks", "fill_blanks", "fill blank", "blanks"]:
-                if isinstance(exercises, str):
-                    exercises = parse_blanks_text(exercises)
+            exercises = parse_exercise_text(request.exercise_type, exercises)
 
         if not exercises:
             exercises = "Sorry, no exercises could be generated."
-        return {"exercises": exercises}
+        return {"exercises": exercises, "context": exercise_generator.context_report}
     except Exception as e:
         logger.error(f"Error in generate_exercise: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/exercise/generate-batch")
+async def generate_exercise_batch(request: BatchExerciseRequest):
+    """Generate exercises for many topics and exercise types in one call"""
+    topics = [topic for topic in request.topics if topic.strip()]
+    if not topics or not request.exercise_types:
+        raise HTTPException(status_code=400, detail="topics and exercise_types must not be empty")
+    if len(topics) * len(request.exercise_types) > GENERATE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400,
+                            detail=f"A batch may contain at most {GENERATE_BATCH_MAX_ITEMS} topic/type combinations")
+
+    try:
+        exercise_generator = await run_in_threadpool(GenerateExercise, request.userId, request.document_id, request.book_ids)
+        # One encode call for every topic; contexts are compacted as in the single-topic endpoints
+        contexts = {}
+        wants_notes = [is_notes_type(exercise_type) for exercise_type in request.exercise_types]
+        for notes, k, budget in ((True, 15, NOTES_CONTEXT_TOKENS), (False, 10, EXERCISE_CONTEXT_TOKENS)):
+            if notes in wants_notes:
+                contexts[notes] = await run_in_threadpool(
+                    exercise_generator.rag_processor.retrieve_context_batch, topics, k, budget,
+                    book_ids=exercise_generator.book_ids
+                )
+    except Exception as e:
+        logger.error(f"Error retrieving batch context: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    semaphore = asyncio.Semaphore(GENERATE_BATCH_CONCURRENCY)
+
+    async def generate_one(i, topic, exercise_type):
+        notes = is_notes_type(exercise_type)
+        context_chunks, report = contexts[notes][i]
+        async with semaphore:
+            try:
+                if notes:
+                    exercises = await exercise_generator.generate_notes_with_context(
+                        topic, request.num_questions, request.difficulty_level,
+                        context_chunks=context_chunks, raise_errors=True
+                    )
+                else:
+                    exercises = await exercise_generator.generate_exercise_with_context(
+                        topic, exercise_type, request.num_questions, request.difficulty_level,
+                        context_chunks=context_chunks, raise_errors=True
+                    )
+                    exercises = parse_exercise_text(exercise_type, exercises)
+                return {"topic": topic, "exercise_type": exercise_type, "exercises": exercises, "context": report}
+            except Exception as e:
+                logger.error(f"Batch generation failed for {topic!r} ({exercise_type}): {e}")
+                return {"topic": topic, "exercise_type": exercise_type, "error": str(e)}
+
+    results = await asyncio.gather(*(
+        generate_one(i, topic, exercise_type)
+        for i, topic in enumerate(topics)
+        for exercise_type in request.exercise_types
+    ))
+    return {
+        "results": results,
+        "failed": sum(1 for result in results if "error" in result)
+    }
+
 @router.post("/exercise/ask")
 async def ask_question_about_book(request: QuestionRequest):
     """Ask a question about the uploaded book"""
     try:
-        exercise_generator = GenerateExercise(request.userId)
-        answer = exercise_generator.ask_question_about_book(request.question)
-        return {"answer": answer}
+        exercise_generator = await run_in_threadpool(GenerateExercise, request.userId, request.document_id, request.book_ids)
+        answer = await exercise_generator.ask_question_about_book(request.question)
+        return {"answer": answer, "context": exercise_generator.context_report}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/exercise/ask/stream")
+async def stream_question_about_book(request: QuestionRequest):
+    """Stream the answer to a question about the uploaded book as Server-Sent Events"""
+    try:
+        exercise_generator = await run_in_threadpool(GenerateExercise, request.userId, request.document_id, request.book_ids)
+        full_prompt = await exercise_generator.question_prompt(request.question)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if full_prompt is None:
+        async def no_content():
+            yield NO_BOOK_CONTENT_ANSWER
+        pieces = no_content()
+    else:
+        pieces = exercise_generator.stream_answer(full_prompt)
+    return StreamingResponse(sse_text_stream(pieces, meta={"context": exercise_generator.context_report}),
+                             media_type="text/event-stream", headers=SSE_HEADERS)
+
 @router.post("/exercise/generate-simple")
 async def generate_simple_exercise(request: ExerciseRequest):
-    """Generate exercises without book context"""
+    """Generate exercises without book context
+
+    Popular requests are served from the pre-generated pool when it has a set ready,
+    unless the request asks for fresh exercises.
+    """
     try:
-        exercise_generator = GenerateExercise(request.userId)
+        if request.fresh:
+            pregeneration.record(request.topic, request.exercise_type, request.num_questions)
+        else:
+            pooled = pregeneration.take(request.topic, request.exercise_type, request.num_questions)
+            if pooled is not None:
+                return {"exercises": pooled, "pooled": True}
+
+        # No book context, so the user's library is never loaded
+        exercise_generator = GenerateExercise(None)
         
         # Handle notes generation separately
-        if request.exercise_type.lower() in ["notes generation", "notes", "note generation"]:
-            exercises = exercise_generator.generate_notes_without_context(
+        if is_notes_type(request.exercise_type):
+            exercises = await exercise_generator.generate_notes_without_context(
                 topic=request.topic,
-                num_notes=request.num_questions
+                num_notes=request.num_questions,
+                fresh=request.fresh
             )
         else:
-            exercises = exercise_generator.generate_exercise_without_context(
+            exercises = await exercise_generator.generate_exercise_without_context(
                 topic=request.topic,
                 exercise_type=request.exercise_type,
-                num_questions=request.num_questions
+                num_questions=request.num_questions,
+                fresh=request.fresh
             )
-            # If MCQ, parse to array
-            if request.exercise_type.lower() in ["multiple choice", "mcq", "mcqs"]:
-                if isinstance(exercises, str):
-                    exercises = parse_mcq_text(exercises)
-            # If True/False, parse to array
-            elif request.exercise_type.lower() in ["true/false", "true_false", "true false", "tf"]:
-                if isinstance(exercises, str):
-                    exercises = parse_true_false_text(exercises)
-            # If SQS, parse to array
-            elif request.exercise_type.lower() in ["short answer", "short_questions", "short question", "sqs"]:
-                if isinstance(exercises, str):
-                    exercises = parse_sqs_text(exercises)
-            # If LQS, parse to array
-            elif request.exercise_type.lower() in ["long questions", "long_questions", "long question", "lqs"]:
-                if isinstance(exercises, str):
-                    exercises = parse_lqs_text(exercises)
-            # If Fill in the Blanks, parse to array
-            elif request.exercise_type.lower() in ["fill in the blanks", "fill_blanks", "fill blank", "blanks"]:
-                if isinstance(exercises, str):
-                    exercises = parse_blanks_text(exercises)
+            exercises = parse_exercise_text(request.exercise_type, exercises)
         
-        return {"exercises": exercises}
+        return {"exercises": exercises, "pooled": False}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1,10 +1,17 @@
 from controller.mentorController import Mentor
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional
+from utils.helper import sse_text_stream, SSE_HEADERS
 
 router = APIRouter()
 
+def get_mentor(request: Request) -> Mentor:
+    """The process-wide Mentor created in the app lifespan"""
+    return request.app.state.mentor
+
 class ChatRequest(BaseModel):
     userId: str
     message: str
@@ -23,19 +30,31 @@ class DeleteChatRequest(BaseModel):
     user_id: str
 
 @router.post("/mentor/chat")
-async def chat_with_mentor(request: ChatRequest):
+async def chat_with_mentor(request: ChatRequest, mentor: Mentor = Depends(get_mentor)):
     try:
-        mentor = Mentor(request.userId)
-        response = mentor.chat_with_mentor(request.userId, request.message, request.chat_id)
+        response = await mentor.chat_with_mentor(request.userId, request.message, request.chat_id)
         return {"response": response}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/mentor/chat/stream")
+async def stream_chat_with_mentor(request: ChatRequest, mentor: Mentor = Depends(get_mentor)):
+    """Stream the mentor's answer as Server-Sent Events; the exchange is saved when the stream ends"""
+    try:
+        chat_id, full_message = await mentor.prepare_chat(request.userId, request.message, request.chat_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if chat_id is None:
+        raise HTTPException(status_code=404 if request.chat_id else 500, detail=full_message)
+    return StreamingResponse(
+        sse_text_stream(mentor.stream_chat(chat_id, request.message, full_message), meta={"chat_id": chat_id}),
+        media_type="text/event-stream", headers=SSE_HEADERS
+    )
+
 @router.post("/mentor/new-chat")
-async def create_new_chat(request: NewChatRequest):
+async def create_new_chat(request: NewChatRequest, mentor: Mentor = Depends(get_mentor)):
     try:
-        mentor = Mentor(request.userId)
-        chat = mentor.chat_model.create_new_chat(request.userId, request.title)
+        chat = await run_in_threadpool(mentor.chat_model.create_new_chat, request.userId, request.title)
         if chat:
             return {"chat": chat}
         else:
@@ -44,30 +63,40 @@ async def create_new_chat(request: NewChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/mentor/chats/{user_id}")
-async def get_user_chats(user_id: str, limit: int = 10):
+async def get_user_chats(user_id: str, limit: int = 10, mentor: Mentor = Depends(get_mentor)):
     try:
-        mentor = Mentor(user_id)
-        chats = mentor.chat_model.get_user_chats(user_id, limit)
+        chats = await run_in_threadpool(mentor.chat_model.get_user_chats, user_id, limit)
         return {"chats": chats}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/mentor/history/{user_id}")
-async def get_chat_history(user_id: str, chat_id: Optional[str] = None):
+async def get_chat_history(user_id: str, chat_id: Optional[str] = None, mentor: Mentor = Depends(get_mentor)):
     try:
-        mentor = Mentor(user_id)
-        history = mentor.chat_model.get_conversation_history(user_id, chat_id)
+        history = await run_in_threadpool(mentor.chat_model.get_conversation_history, user_id, chat_id)
         return {"history": history}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/mentor/history/{user_id}/page")
+async def get_chat_history_page(user_id: str, chat_id: Optional[str] = None,
+                                limit: int = Query(20, ge=1, le=100),
+                                order: str = Query("desc", pattern="^(asc|desc)$"),
+                                cursor: Optional[str] = None, mentor: Mentor = Depends(get_mentor)):
+    """One page of a chat's history; pass next_cursor back as cursor for the next page"""
+    try:
+        return await run_in_threadpool(mentor.chat_model.get_history_page, user_id, chat_id, limit,
+                                       order == "desc", cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.put("/mentor/rename-chat")
-async def rename_chat(request: RenameChatRequest):
+async def rename_chat(request: RenameChatRequest, mentor: Mentor = Depends(get_mentor)):
     """Rename the title of an existing chat session"""
     try:
-        # We can use any user_id for initialization since we're just updating title
-        mentor = Mentor("temp")  # Temporary user ID for initialization
-        success = mentor.chat_model.update_chat_title(request.chat_id, request.title)
+        success = await run_in_threadpool(mentor.chat_model.update_chat_title, request.chat_id, request.title)
         
         if success:
             return {"message": "Chat title updated successfully", "chat_id": request.chat_id, "new_title": request.title}
@@ -77,11 +106,10 @@ async def rename_chat(request: RenameChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/mentor/delete-chat")
-async def delete_chat(request: DeleteChatRequest):
+async def delete_chat(request: DeleteChatRequest, mentor: Mentor = Depends(get_mentor)):
     """Delete an existing chat session"""
     try:
-        mentor = Mentor(request.user_id)
-        success = mentor.chat_model.delete_chat(request.chat_id, request.user_id)
+        success = await run_in_threadpool(mentor.chat_model.delete_chat, request.chat_id, request.user_id)
         
         if success:
             return {"message": "Chat deleted successfully", "chat_id": request.chat_id}
@@ -90,6 +118,16 @@ async def delete_chat(request: DeleteChatRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/mentor/outbox/replay-dead-letters")
+async def replay_dead_letters(mentor: Mentor = Depends(get_mentor)):
+    """Queue dead-lettered exchanges again, e.g. after fixing what made them fail"""
+    if mentor.outbox is None or not mentor.outbox.running:
+        raise HTTPException(status_code=409, detail="Write-behind saving is not enabled")
+    try:
+        return {"requeued": await mentor.outbox.replay_dead_letters()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/mentor/test-db")
 async def test_database_connection():
     """Test endpoint to verify database connection"""
@@ -170,11 +208,10 @@ async def test_direct_insert():
         return {"status": "error", "message": str(e), "error_type": str(type(e))}
 
 @router.post("/mentor/test-full-flow")
-async def test_full_flow():
+async def test_full_flow(mentor: Mentor = Depends(get_mentor)):
     """Test the complete flow: create user, create chat, send message"""
     try:
         from controller import supabase
-        from controller.mentorController import Mentor
         
         # Use existing user from database
         users_result = supabase.table("users").select("id").limit(1).execute()
@@ -187,7 +224,6 @@ async def test_full_flow():
         
         # Step 1: Test chat creation directly
         try:
-            mentor = Mentor(test_user_id)
             chat = mentor.chat_model.create_new_chat(test_user_id, "Test Chat")
             if chat:
                 results["steps"].append(f"Successfully created chat: {chat['id']}")
@@ -4,9 +4,47 @@ from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from routes.mentor import router as mentor_router
 from routes.exercises import router as exercise_router
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+from utils.embedding import registry as embedding_registry
+from utils.ingestion_jobs import ingestion_jobs
+from utils.embedding_cache import embedding_cache
+from utils.query_cache import query_cache
+from utils.context_builder import context_stats
+from utils.llm_gateway import llm_gateway
+from utils.response_cache import response_cache
+from utils.single_flight import generation_flights
+from utils.prompt_builder import mentor_prompt_builder
+from utils.pregeneration import pregeneration
+from utils.write_behind import mentor_outbox, MENTOR_WRITE_BEHIND
+from controller.generateExercise import pregenerate_exercises
+from controller.mentorController import Mentor, check_connection_periodically
+from model.mentor_chats import MentorChatModel
+from controller import supabase
+import asyncio
 import os
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the embedding model once per process instead of once per request
+    await run_in_threadpool(embedding_registry.get)
+    ingestion_jobs.start()
+    pregeneration.start(pregenerate_exercises)
+    # One mentor and chat model per process; the routes get them injected
+    chat_model = MentorChatModel(supabase)
+    await run_in_threadpool(chat_model.test_connection)
+    # Exchanges are saved in the background; ones left queued by stopped workers are replayed
+    if MENTOR_WRITE_BEHIND:
+        mentor_outbox.start(chat_model.save_exchanges)
+    app.state.mentor = Mentor(chat_model, outbox=mentor_outbox if MENTOR_WRITE_BEHIND else None)
+    connection_check = asyncio.create_task(check_connection_periodically(chat_model))
+    yield
+    connection_check.cancel()
+    await mentor_outbox.stop()
+    await pregeneration.stop()
+    ingestion_jobs.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -31,4 +69,23 @@ async def read_root():
 @app.get("/test")
 async def serve_test_ui():
     """Serve the static HTML file for testing"""
-    return FileResponse('static/index.html')
\ No newline at end of file
+    return FileResponse('static/index.html')
+
+@app.get("/stats")
+async def get_stats():
+    """Runtime statistics for the shared resources of this worker"""
+    return {
+        "embedding_models": embedding_registry.stats(),
+        "ingestion_jobs": ingestion_jobs.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "query_cache": query_cache.stats(),
+        "context_compaction": context_stats.stats(),
+        "llm_gateway": llm_gateway.stats(),
+        "response_cache": response_cache.stats(),
+        "generation_coalescing": generation_flights.stats(),
+        "mentor_prompt": mentor_prompt_builder.stats(),
+        "pregeneration": pregeneration.stats(),
+        "mentor_db": app.state.mentor.chat_model.connection_status(),
+        "mentor_chat_cache": app.state.mentor.chat_model.cache.stats(),
+        "mentor_write_behind": mentor_outbox.stats()
+    }
@@ -0,0 +1,228 @@
+import re
+import uuid
+from datetime import datetime, timedelta, timezone
+import pytest
+from model.mentor_chats import MentorChatModel
+from utils.chat_cache import ChatCache
+
+USER = "5b0c5a6e-5f7e-4c1e-9a57-1f0c8d1c2a10"
+START = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class Result:
+    def __init__(self, data):
+        self.data = data
+
+
+def _compare(op, left, right):
+    return {"eq": left == right, "lt": left < right, "gt": left > right}[op]
+
+
+def _split(expression):
+    """Top-level comma separated parts of a PostgREST or/and filter"""
+    parts, depth, current = [], 0, ""
+    for char in expression:
+        if char == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += char == "("
+        depth -= char == ")"
+        current += char
+    return parts + [current]
+
+
+def _condition(expression):
+    if expression.startswith("and(") and expression.endswith(")"):
+        conditions = [_condition(part) for part in _split(expression[4:-1])]
+        return lambda row: all(condition(row) for condition in conditions)
+    column, op, value = re.fullmatch(r'(\w+)\.(eq|lt|gt)\."?(.*?)"?', expression).groups()
+    return lambda row: _compare(op, str(row[column]), value)
+
+
+class FakeQuery:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.action = "select"
+        self.payload = None
+        self.filters = []
+        self.orders = []
+        self.count = None
+
+    def select(self, columns="*"):
+        return self
+
+    def insert(self, payload):
+        self.action, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, ignore_duplicates=False):
+        self.action, self.payload = "upsert", payload
+        return self
+
+    def update(self, payload):
+        self.action, self.payload = "update", payload
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def or_(self, expression):
+        conditions = [_condition(part) for part in _split(expression)]
+        self.filters.append(lambda row: any(condition(row) for condition in conditions))
+        return self
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def execute(self):
+        rows = self.client.tables.setdefault(self.table, [])
+        if self.action in ("insert", "upsert"):
+            new = self.payload if isinstance(self.payload, list) else [self.payload]
+            stored = {row["id"] for row in rows}
+            new = [{"id": str(uuid.uuid4()), "created_at": self.client.now(), **row} for row in new]
+            new = [row for row in new if row["id"] not in stored]
+            rows.extend(new)
+            return Result([dict(row) for row in new])
+        matched = [row for row in rows if all(condition(row) for condition in self.filters)]
+        if self.action == "update":
+            for row in matched:
+                row.update(self.payload)
+        elif self.action == "delete":
+            self.client.tables[self.table] = [row for row in rows if row not in matched]
+        for column, desc in reversed(self.orders):
+            matched.sort(key=lambda row: row[column], reverse=desc)
+        if self.count is not None:
+            matched = matched[:self.count]
+        return Result([dict(row) for row in matched])
+
+
+class FakeSupabase:
+    """Just enough of the Supabase client for MentorChatModel, kept in memory"""
+
+    def __init__(self):
+        self.tables = {"users": [{"id": USER}]}
+        self.clock = START
+
+    def now(self):
+        self.clock += timedelta(seconds=1)
+        return self.clock.isoformat()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+def add_chat(client, exchanges=()):
+    chat = {"id": str(uuid.uuid4()), "user_id": USER, "title": "Chat", "created_at": client.now(),
+            "conversation": list(exchanges)}
+    client.tables.setdefault("mentor_chats", []).append(chat)
+    return chat["id"]
+
+
+def make_exchanges(count):
+    return [{"id": f"e{i:02d}", "user_message": f"question {i}", "mentor_response": f"answer {i}",
+             "timestamp": (START + timedelta(minutes=i)).isoformat()} for i in range(count)]
+
+
+def test_saves_from_two_workers_both_persist():
+    client = FakeSupabase()
+    chat_id = add_chat(client, make_exchanges(2))
+    first = MentorChatModel(client, storage="array", cache=ChatCache())
+    second = MentorChatModel(client, storage="array", cache=ChatCache())
+    # Both processes have the chat cached before either saves
+    assert len(first.get_conversation_history(USER, chat_id)) == 2
+    assert len(second.get_conversation_history(USER, chat_id)) == 2
+
+    assert first.add_message_to_conversation(chat_id, "from first", "reply")
+    assert second.add_message_to_conversation(chat_id, "from second", "reply")
+
+    stored = client.tables["mentor_chats"][0]["conversation"]
+    assert [exchange["user_message"] for exchange in stored[2:]] == ["from first", "from second"]
+    assert [exchange["user_message"] for exchange in second.get_conversation_history(USER, chat_id)] == \
+        [exchange["user_message"] for exchange in stored]
+
+
+def test_get_or_create_chat_sees_a_chat_created_by_another_worker():
+    client = FakeSupabase()
+    add_chat(client)
+    first = MentorChatModel(client, storage="array", cache=ChatCache())
+    second = MentorChatModel(client, storage="array", cache=ChatCache())
+    first.get_or_create_chat(USER)
+
+    newer = second.create_new_chat(USER, "Newer")
+    assert first.get_or_create_chat(USER)["id"] == newer["id"]
+
+
+def stored_as(client, storage, exchanges):
+    if storage == "rows":
+        chat_id = add_chat(client)
+        client.tables["mentor_messages"] = [{
+            "id": exchange["id"], "chat_id": chat_id, "user_message": exchange["user_message"],
+            "mentor_response": exchange["mentor_response"], "created_at": exchange["timestamp"],
+        } for exchange in exchanges]
+        return chat_id
+    return add_chat(client, exchanges)
+
+
+@pytest.mark.parametrize("storage", ["rows", "array"])
+@pytest.mark.parametrize("newest_first", [True, False])
+def test_history_pages_follow_the_cursor_through_every_exchange(storage, newest_first):
+    client = FakeSupabase()
+    exchanges = make_exchanges(7)
+    # Two exchanges in the same instant are ordered by id
+    exchanges[4]["timestamp"] = exchanges[3]["timestamp"]
+    chat_id = stored_as(client, storage, exchanges)
+    model = MentorChatModel(client, storage=storage, cache=ChatCache())
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        page = model.get_history_page(USER, chat_id, limit=3, newest_first=newest_first, cursor=cursor)
+        assert page["chat_id"] == chat_id
+        seen.extend(exchange["id"] for exchange in page["history"])
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    expected = [exchange["id"] for exchange in exchanges]
+    assert seen == (expected[::-1] if newest_first else expected)
+    assert pages == 3
+
+
+def test_malformed_cursor_is_rejected():
+    client = FakeSupabase()
+    chat_id = add_chat(client, make_exchanges(2))
+    model = MentorChatModel(client, storage="array", cache=ChatCache())
+    with pytest.raises(ValueError):
+        model.get_history_page(USER, chat_id, cursor="not-a-cursor")
+
+
+@pytest.mark.parametrize("newest_first", [True, False])
+def test_array_pages_order_mixed_timestamps_by_instant(newest_first):
+    client = FakeSupabase()
+    exchanges = make_exchanges(4)
+    # Naive (older exchanges), an offset that sorts wrong as a string, and UTC
+    exchanges[0]["timestamp"] = "2024-04-01T08:00:00"
+    exchanges[1]["timestamp"] = "2024-05-01T14:00:00+02:00"
+    exchanges[2]["timestamp"] = "2024-05-01T12:30:00+00:00"
+    exchanges[3]["timestamp"] = "2024-05-01T13:00:00Z"
+    chat_id = add_chat(client, exchanges[::-1])
+    model = MentorChatModel(client, storage="array", cache=ChatCache())
+
+    first = model.get_history_page(USER, chat_id, limit=2, newest_first=newest_first)
+    rest = model.get_history_page(USER, chat_id, limit=2, newest_first=newest_first, cursor=first["next_cursor"])
+    seen = [exchange["id"] for exchange in first["history"] + rest["history"]]
+    expected = ["e00", "e01", "e02", "e03"]
+    assert seen == (expected[::-1] if newest_first else expected)
+    assert rest["next_cursor"] is None
@@ -0,0 +1,43 @@
+import asyncio
+from utils.pregeneration import PregenerationScheduler, pool_key
+
+KEY = pool_key("Photosynthesis", "mcq", 5)
+
+
+def test_pooled_sets_of_a_stopped_worker_are_served_by_one_worker(tmp_path):
+    async def run():
+        path = str(tmp_path / "pregeneration.json")
+        stopped = PregenerationScheduler(path=path, ident=1)
+        stopped.start()
+        stopped.pool.put(KEY, ["pooled set"])
+        await stopped.stop()
+
+        first = PregenerationScheduler(path=path, ident=2)
+        first.start()
+        second = PregenerationScheduler(path=path, ident=3)
+        second.start()
+        assert first.take("photosynthesis", "mcq", 5) == ["pooled set"]
+        assert second.take("photosynthesis", "mcq", 5) is None
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(run())
+
+
+def test_popularity_from_several_files_adds_up(tmp_path):
+    async def run():
+        path = str(tmp_path / "pregeneration.json")
+        workers = [PregenerationScheduler(path=path, ident=ident) for ident in (1, 2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.record("Photosynthesis", "mcq", 5)
+            await worker.stop()
+
+        adopter = PregenerationScheduler(path=path, ident=3)
+        adopter.start()
+        [(key, _, score)] = adopter.tracker.hottest(1)
+        assert key == KEY and round(score) == 2
+        await adopter.stop()
+
+    asyncio.run(run())
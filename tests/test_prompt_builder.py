@@ -0,0 +1,36 @@
+from utils.context_builder import estimate_tokens
+from utils.prompt_builder import MentorPromptBuilder
+
+
+def exchanges(count, words=60):
+    return [{"id": f"e{i}", "user_message": "why " * words, "mentor_response": "because " * words}
+            for i in range(count)]
+
+
+def test_prompt_stays_within_budget_whatever_the_inputs():
+    builder = MentorPromptBuilder(budget=500, message_max_tokens=100)
+    for system, message in [("rules " * 2000, "hi"), ("short", "question " * 5000), ("rules " * 2000, "q " * 5000)]:
+        prompt, report = builder.build(system, exchanges(20), message)
+        assert estimate_tokens(prompt) <= report["prompt_tokens"] <= 500
+    assert report["system_truncated"] and report["message_truncated"]
+
+
+def test_past_messages_are_counted_once():
+    calls = []
+
+    def counter(text):
+        calls.append(text)
+        return estimate_tokens(text)
+
+    builder = MentorPromptBuilder(budget=100000, counter=counter)
+    history = exchanges(10)
+    builder.build("system", history, "first")
+    calls.clear()
+    builder.build("system", history, "second")
+    counted_history = [text for text in calls if text.startswith(("why", "because"))]
+    assert counted_history == []
+
+    # Same id, different text: counted again
+    history[-1] = {**history[-1], "user_message": "why not"}
+    builder.build("system", history, "third")
+    assert "why not" in calls
@@ -0,0 +1,154 @@
+import asyncio
+import time
+import pytest
+import utils.write_behind as write_behind
+from utils.write_behind import WriteBehindQueue
+
+
+class FakeStore:
+    """Writer that rejects exchanges of deleted chats, or everything while down"""
+
+    def __init__(self, deleted=()):
+        self.deleted = set(deleted)
+        self.down = False
+        self.rows = []
+
+    def __call__(self, batch):
+        if self.down:
+            raise RuntimeError("database unavailable")
+        if any(chat_id in self.deleted for chat_id, _ in batch):
+            raise RuntimeError("foreign key violation")
+        self.rows.extend(exchange["id"] for _, exchange in batch)
+        return True
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(write_behind, "MENTOR_OUTBOX_RETRY_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(write_behind, "MENTOR_OUTBOX_RETRY_MAX_SECONDS", 0.05)
+    monkeypatch.setattr(write_behind, "MENTOR_OUTBOX_LINGER_SECONDS", 0.01)
+    monkeypatch.setattr(write_behind, "MENTOR_OUTBOX_MAX_ATTEMPTS", 3)
+
+
+def make_queue(tmp_path, store, ident=1):
+    """A queue as process number ident would run it"""
+    return WriteBehindQueue(str(tmp_path / "outbox.jsonl"), str(tmp_path / "outbox.dead.jsonl"),
+                            writer=store, fsync=False, ident=ident)
+
+
+async def until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        await asyncio.sleep(0.01)
+
+
+def test_poisoned_exchange_does_not_hold_back_healthy_ones(tmp_path):
+    async def run():
+        store = FakeStore(deleted={"gone"})
+        queue = make_queue(tmp_path, store)
+        queue.start()
+        await queue.enqueue("gone", {"id": "poison"})
+        for i in range(5):
+            await queue.enqueue(f"chat{i}", {"id": f"ok{i}"})
+
+        await until(lambda: len(store.rows) == 5)
+        assert sorted(store.rows) == [f"ok{i}" for i in range(5)]
+
+        # The bad exchange keeps failing while others get through and is dead-lettered
+        for i in range(5, 8):
+            await queue.enqueue(f"chat{i}", {"id": f"ok{i}"})
+            await until(lambda: f"ok{i}" in store.rows)
+        await until(lambda: queue.stats()["dead_lettered"] == 1)
+        assert len(queue) == 0
+
+        store.deleted.clear()
+        assert await queue.replay_dead_letters() == 1
+        await until(lambda: "poison" in store.rows)
+        await queue.stop()
+        assert queue.load() == []
+
+    asyncio.run(run())
+
+
+def test_later_exchanges_of_a_failing_chat_keep_their_order(tmp_path):
+    async def run():
+        store = FakeStore(deleted={"gone"})
+        queue = make_queue(tmp_path, store)
+        queue.start()
+        await queue.enqueue("gone", {"id": "first"})
+        await queue.enqueue("healthy", {"id": "other"})
+        await until(lambda: "other" in store.rows)
+        await queue.enqueue("gone", {"id": "second"})
+
+        store.deleted.clear()
+        await until(lambda: len(queue) == 0)
+        assert store.rows.index("first") < store.rows.index("second")
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_outage_dead_letters_nothing(tmp_path):
+    async def run():
+        store = FakeStore()
+        store.down = True
+        queue = make_queue(tmp_path, store)
+        queue.start()
+        for i in range(4):
+            await queue.enqueue(f"chat{i}", {"id": f"ok{i}"})
+
+        await until(lambda: queue.stats()["failures"] >= 10)
+        assert queue.stats()["dead_lettered"] == 0
+        assert all(record.get("attempts", 0) == 0 for record in queue._pending)
+
+        store.down = False
+        await until(lambda: len(store.rows) == 4)
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_unwritten_exchanges_are_replayed_after_restart(tmp_path):
+    async def run():
+        store = FakeStore()
+        store.down = True
+        queue = make_queue(tmp_path, store)
+        queue.start()
+        await queue.enqueue("chat", {"id": "kept"})
+        await queue.stop(drain_seconds=0.05)
+
+        store.down = False
+        restarted = make_queue(tmp_path, store)
+        restarted.start()
+        await until(lambda: store.rows == ["kept"])
+        await restarted.stop()
+
+    asyncio.run(run())
+
+
+def test_logs_of_stopped_workers_are_adopted_and_live_ones_left_alone(tmp_path):
+    async def run():
+        store = FakeStore()
+        store.down = True
+        stopped = make_queue(tmp_path, store, ident=1)
+        stopped.start()
+        await stopped.enqueue("chat", {"id": "orphaned"})
+        await stopped.stop(drain_seconds=0.05)
+        live = make_queue(tmp_path, store, ident=2)
+        live.start()
+        await live.enqueue("other", {"id": "live"})
+
+        with pytest.raises(RuntimeError):
+            make_queue(tmp_path, store, ident=2).start()
+
+        store.down = False
+        adopter = make_queue(tmp_path, store, ident=3)
+        adopter.start()
+        await until(lambda: sorted(store.rows) == ["live", "orphaned"])
+        assert not (tmp_path / "outbox.1.jsonl").exists()
+        await live.stop()
+        await adopter.stop()
+        assert not list(tmp_path.glob("outbox.[0-9]*"))
+
+    asyncio.run(run())
@@ -0,0 +1,100 @@
+import os
+import threading
+from typing import Dict, List, Optional
+from utils.lru_cache import LRUCache
+from utils.prompt_builder import MENTOR_HISTORY_MAX_EXCHANGES
+
+# Chats kept in memory per process; 0 disables the cache
+MENTOR_CHAT_CACHE_SIZE = int(os.getenv("MENTOR_CHAT_CACHE_SIZE", "2000"))
+# Upper bound on how stale a chat can be when another worker wrote to it
+MENTOR_CHAT_CACHE_TTL_SECONDS = float(os.getenv("MENTOR_CHAT_CACHE_TTL_SECONDS", "600"))
+# Newest exchanges kept per chat; enough to build a prompt without a read
+MENTOR_CHAT_CACHE_EXCHANGES = int(os.getenv("MENTOR_CHAT_CACHE_EXCHANGES", str(MENTOR_HISTORY_MAX_EXCHANGES)))
+
+
+class ChatCache:
+    """Recently used mentor chats: metadata and the newest exchanges
+
+    Entries are filled on read and updated write-through when a message is
+    saved, so a turn on a warm chat reads nothing from the database. Rename
+    and delete invalidate the chat. Each entry is
+    {"chat": metadata, "exchanges": newest exchanges or None, "complete": bool},
+    where complete means the exchanges are the chat's whole history.
+    Entries are replaced, never changed in place, so readers always see a
+    consistent snapshot.
+    """
+
+    def __init__(self, maxsize: int = MENTOR_CHAT_CACHE_SIZE, ttl: float = MENTOR_CHAT_CACHE_TTL_SECONDS,
+                 max_exchanges: int = MENTOR_CHAT_CACHE_EXCHANGES):
+        self.chats = LRUCache(maxsize, ttl)
+        # user id -> id of the user's most recent chat
+        self.latest = LRUCache(maxsize, ttl)
+        self.max_exchanges = max_exchanges
+        self.appends = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: str) -> Optional[Dict]:
+        return self.chats.get(chat_id)
+
+    def put(self, chat: Dict, exchanges: Optional[List[Dict]] = None):
+        """Cache a chat row; exchanges, if given, are its whole history"""
+        metadata = {key: value for key, value in chat.items() if key != "conversation"}
+        entry = {"chat": metadata, "exchanges": None, "complete": False}
+        if exchanges is not None:
+            entry["exchanges"] = list(exchanges[-self.max_exchanges:])
+            entry["complete"] = len(exchanges) <= self.max_exchanges
+        self.chats.put(chat["id"], entry)
+
+    def set_exchanges(self, chat_id: str, exchanges: List[Dict], complete: bool):
+        """Store the newest exchanges of a cached chat, oldest first"""
+        with self._lock:
+            entry = self.chats.get(chat_id)
+            if entry is not None:
+                self.chats.put(chat_id, {**entry, "exchanges": list(exchanges[-self.max_exchanges:]),
+                                         "complete": complete and len(exchanges) <= self.max_exchanges})
+
+    def exchanges(self, chat_id: str, limit: Optional[int] = None) -> Optional[List[Dict]]:
+        """The newest limit exchanges (all if limit is None), or None if the cache cannot answer"""
+        entry = self.chats.get(chat_id)
+        if entry is None or entry["exchanges"] is None:
+            return None
+        cached = entry["exchanges"]
+        if entry["complete"] or (limit and limit <= len(cached)):
+            return cached[-limit:] if limit else list(cached)
+        return None
+
+    def append(self, chat_id: str, exchange: Dict):
+        """Write-through after an exchange was saved"""
+        with self._lock:
+            entry = self.chats.get(chat_id)
+            if entry is None or entry["exchanges"] is None:
+                return
+            exchanges = entry["exchanges"] + [exchange]
+            complete = entry["complete"] and len(exchanges) <= self.max_exchanges
+            self.chats.put(chat_id, {**entry, "exchanges": exchanges[-self.max_exchanges:], "complete": complete})
+            self.appends += 1
+
+    def latest_chat(self, user_id: str) -> Optional[Dict]:
+        """Cached metadata of the user's most recent chat"""
+        chat_id = self.latest.get(user_id)
+        entry = self.chats.get(chat_id) if chat_id else None
+        return entry["chat"] if entry else None
+
+    def set_latest(self, user_id: str, chat_id: str):
+        self.latest.put(user_id, chat_id)
+
+    def invalidate(self, chat_id: str, user_id: Optional[str] = None):
+        self.chats.pop(chat_id)
+        if user_id and self.latest.get(user_id) == chat_id:
+            self.latest.pop(user_id)
+        self.invalidations += 1
+
+    def stats(self) -> Dict:
+        return {
+            "chats": self.chats.stats(),
+            "latest_chat": self.latest.stats(),
+            "max_exchanges": self.max_exchanges,
+            "appends": self.appends,
+            "invalidations": self.invalidations,
+        }
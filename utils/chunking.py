@@ -0,0 +1,174 @@
+import os
+import re
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
+CHUNKER = os.getenv("CHUNKER", "sentences")  # or "words" for the original splitter
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "0"))  # 0 = the model's max_seq_length
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+CHUNK_TOKENIZE_BATCH = int(os.getenv("CHUNK_TOKENIZE_BATCH", "256"))
+
+# A sentence ends at . ! or ? (plus closing quotes/brackets) followed by whitespace
+_SENTENCE_END = re.compile(r"(?<=[.!?])[\"')\]]*\s+")
+_TERMINATED = re.compile(r"[.!?][\"')\]]*$")
+
+Chunk = Tuple[str, int, int]
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split page text into sentences; PDF line breaks inside a sentence are collapsed"""
+    text = " ".join(text.split())
+    if not text:
+        return []
+    sentences, start = [], 0
+    for match in _SENTENCE_END.finditer(text):
+        sentences.append(text[start:match.start()] + text[match.start():match.end()].rstrip())
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+class WordChunker:
+    """Fixed windows of whitespace-separated words (the original splitter)"""
+    name = "words"
+
+    def __init__(self, chunk_size: int = 300, overlap: int = 50):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    def iter_chunks(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Chunk]:
+        """Yields (chunk_text, first_page, last_page); holds one page plus one partial window"""
+        chunk_size = self.chunk_size
+        step = chunk_size - self.overlap
+        words, word_pages = [], []
+        fresh = 0  # buffered words not yet part of an emitted chunk
+        for page_number, text in pages:
+            page_words = text.split()
+            words.extend(page_words)
+            word_pages.extend([page_number] * len(page_words))
+            fresh += len(page_words)
+            while len(words) >= chunk_size:
+                yield " ".join(words[:chunk_size]), word_pages[0], word_pages[chunk_size - 1]
+                del words[:step]
+                del word_pages[:step]
+                fresh = len(words) - self.overlap
+        if fresh > 0:
+            yield " ".join(words), word_pages[0], word_pages[-1]
+
+
+class SentenceChunker:
+    """Packs whole sentences into chunks that fit the embedding model's token limit
+
+    tokenize is called like a Hugging Face tokenizer, so token counts match
+    what the embedding model sees. It is called on batches of sentences
+    spanning several pages (the fast tokenizer batches in Rust). A sentence
+    longer than the limit is cut at token boundaries using offset
+    mappings, so the chunk text stays a verbatim slice of the page. Consecutive
+    chunks share trailing sentences worth up to overlap_tokens. A sentence that
+    runs across a page break is joined with its continuation and attributed to
+    the page it started on.
+    """
+    name = "sentences"
+
+    def __init__(self, tokenize, max_tokens: int, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 batch_size: int = CHUNK_TOKENIZE_BATCH):
+        if max_tokens <= 0:
+            raise ValueError("max_tokens must be positive")
+        self.tokenize = tokenize
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        self.batch_size = batch_size
+
+    def _token_counts(self, sentences: List[str]) -> List[int]:
+        encoded = self.tokenize(sentences, add_special_tokens=False,
+                                return_attention_mask=False, return_token_type_ids=False)
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def _split_long(self, sentences: List[str]) -> List[List[Tuple[str, int]]]:
+        """Cut each oversized sentence into max_tokens windows of (text, token count)"""
+        encoded = self.tokenize(sentences, add_special_tokens=False, return_offsets_mapping=True,
+                                return_attention_mask=False, return_token_type_ids=False)
+        pieces = []
+        for sentence, offsets in zip(sentences, encoded["offset_mapping"]):
+            windows = []
+            for start in range(0, len(offsets), self.max_tokens):
+                window = offsets[start:start + self.max_tokens]
+                end = offsets[start + len(window)][0] if start + len(window) < len(offsets) else len(sentence)
+                text = sentence[window[0][0]:end].strip()
+                if text:
+                    windows.append((text, len(window)))
+            pieces.append(windows)
+        return pieces
+
+    def _sentences(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[str, int]]:
+        """(sentence, page it starts on) across the whole book"""
+        carry, carry_page = "", None
+        for page_number, text in pages:
+            sentences = split_sentences(text)
+            if not sentences:
+                continue
+            if carry:
+                sentences[0] = f"{carry} {sentences[0]}"
+            first_page = carry_page if carry else page_number
+            # Hold back an unterminated last sentence; it probably continues on the next page.
+            # Text with no punctuation at all is not carried forever.
+            if _TERMINATED.search(sentences[-1]) or len(sentences[-1]) > self.max_tokens * 8:
+                carry = ""
+            else:
+                carry_page = first_page if len(sentences) == 1 else page_number
+                carry = sentences.pop()
+            for i, sentence in enumerate(sentences):
+                yield sentence, first_page if i == 0 else page_number
+        if carry:
+            yield carry, carry_page
+
+    def _segments(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[str, int, int]]:
+        """(sentence, page, token count) with every sentence at most max_tokens"""
+        sentences = self._sentences(pages)
+        while True:
+            # Tokenize a few pages' worth of sentences per call; tiny batches are dominated by overhead
+            batch = list(islice(sentences, self.batch_size))
+            if not batch:
+                return
+            texts = [sentence for sentence, _ in batch]
+            counts = self._token_counts(texts)
+            long = [i for i, count in enumerate(counts) if count > self.max_tokens]
+            split = dict(zip(long, self._split_long([texts[i] for i in long]))) if long else {}
+            for i, ((sentence, page), count) in enumerate(zip(batch, counts)):
+                if i in split:
+                    for text, pieces_count in split[i]:
+                        yield text, page, pieces_count
+                else:
+                    yield sentence, page, count
+
+    def iter_chunks(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Chunk]:
+        """Yields (chunk_text, first_page, last_page)"""
+        buffer, total = [], 0  # [(sentence, page, tokens)]
+        for segment in self._segments(pages):
+            tokens = segment[2]
+            if buffer and total + tokens > self.max_tokens:
+                yield " ".join(s for s, _, _ in buffer), buffer[0][1], buffer[-1][1]
+                # Keep whole trailing sentences as overlap, as long as the new one still fits
+                kept, kept_total = [], 0
+                for item in reversed(buffer):
+                    if kept_total + item[2] > self.overlap_tokens or kept_total + item[2] + tokens > self.max_tokens:
+                        break
+                    kept.append(item)
+                    kept_total += item[2]
+                buffer, total = kept[::-1], kept_total
+            buffer.append(segment)
+            total += tokens
+        if buffer:
+            yield " ".join(s for s, _, _ in buffer), buffer[0][1], buffer[-1][1]
+
+
+def get_chunker(model, kind: str = CHUNKER):
+    """Chunker for an embedding model; falls back to word windows if it exposes no tokenizer"""
+    if kind == "words" or getattr(model, "tokenizer", None) is None:
+        return WordChunker()
+    # The shared model serializes tokenizer calls with encode; the fast tokenizer is not re-entrant
+    tokenize = getattr(model, "tokenize", None) or model.tokenizer
+    # Leave room for the [CLS]/[SEP] tokens the model adds around each chunk
+    max_tokens = CHUNK_MAX_TOKENS or (getattr(model, "max_seq_length", None) or 256) - 2
+    return SentenceChunker(tokenize, max_tokens)
@@ -0,0 +1,153 @@
+import numpy as np
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+# Retrieve this many times k candidates for MMR to choose from
+CONTEXT_CANDIDATE_FACTOR = float(os.getenv("CONTEXT_CANDIDATE_FACTOR", "2"))
+# A truncated last passage is only kept if at least this many tokens of it fit
+CONTEXT_MIN_PASSAGE_TOKENS = int(os.getenv("CONTEXT_MIN_PASSAGE_TOKENS", "50"))
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count (about four characters per token for English text)"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def mmr_order(vectors: np.ndarray, k: int, lambda_: float = CONTEXT_MMR_LAMBDA) -> List[int]:
+    """Indices of k rows chosen by maximal marginal relevance
+
+    Rows arrive in relevance order (the fused retrieval ranking), so relevance
+    is taken from rank rather than a query vector; redundancy is the cosine
+    similarity to the closest row already chosen.
+    """
+    n = len(vectors)
+    if n == 0 or k <= 0:
+        return []
+    relevance = 1.0 - np.arange(n, dtype=np.float32) / n
+    similarity = vectors @ vectors.T
+    chosen = [0]
+    closest = similarity[0].copy()
+    available = np.ones(n, dtype=bool)
+    available[0] = False
+    while len(chosen) < min(k, n):
+        scores = lambda_ * relevance - (1 - lambda_) * closest
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        chosen.append(best)
+        available[best] = False
+        np.maximum(closest, similarity[best], out=closest)
+    return chosen
+
+
+def merge_overlap(first: str, second: str) -> Optional[str]:
+    """first + second without the words they share at the seam, or None if they do not overlap"""
+    a, b = first.split(), second.split()
+    if not a or not b:
+        return None
+    # Try every position in a where b could start, longest overlap first
+    for start in range(max(0, len(a) - len(b)), len(a)):
+        if a[start] == b[0] and a[start:] == b[:len(a) - start]:
+            return " ".join(a + b[len(a) - start:])
+    return None
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Cut text to about `tokens` tokens, at a sentence end when one is near, else a word"""
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    sentence_end = max(cut.rfind(". "), cut.rfind("? "), cut.rfind("! "))
+    if sentence_end > limit // 2:
+        return cut[:sentence_end + 1]
+    return cut.rsplit(" ", 1)[0]
+
+
+class ContextStats:
+    """Process-wide totals of how many prompt tokens compaction saved"""
+
+    def __init__(self):
+        self.requests = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._lock = threading.Lock()
+
+    def record(self, report: Dict):
+        with self._lock:
+            self.requests += 1
+            self.tokens_before += report["tokens_before"]
+            self.tokens_after += report["tokens_after"]
+
+    def stats(self) -> Dict:
+        saved = self.tokens_before - self.tokens_after
+        return {
+            "requests": self.requests,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": saved,
+            "saved_ratio": round(saved / self.tokens_before, 4) if self.tokens_before else None,
+        }
+
+
+context_stats = ContextStats()
+
+
+def compact(texts: Sequence[str], vectors: np.ndarray, positions: Sequence, k: int, token_budget: int,
+            lambda_: float = CONTEXT_MMR_LAMBDA):
+    """Assemble prompt context from ranked candidate chunks
+
+    texts/vectors are the candidates in retrieval order and
+    positions[i] is (book, local chunk id), so neighbours in a book can be
+    detected. Returns (passages, report): up to k chunks picked by MMR,
+    neighbouring chunks merged without their shared overlap, cut to
+    token_budget. The report compares against joining the plain top k.
+    """
+    naive_tokens = sum(estimate_tokens(text) for text in texts[:k])
+    order = mmr_order(np.asarray(vectors, dtype=np.float32), k, lambda_)
+
+    # Merge chosen chunks that follow each other in the same book
+    chosen = sorted(order, key=lambda i: positions[i])
+    rank = {i: r for r, i in enumerate(order)}
+    passages = []  # [best rank, last position, text]
+    for i in chosen:
+        book, local_id = positions[i]
+        if passages and passages[-1][1] == (book, local_id - 1):
+            # Consecutive chunks are contiguous text, so they join even without a shared overlap
+            passages[-1][0] = min(passages[-1][0], rank[i])
+            passages[-1][1] = positions[i]
+            passages[-1][2] = merge_overlap(passages[-1][2], texts[i]) or f"{passages[-1][2]} {texts[i]}"
+            continue
+        passages.append([rank[i], positions[i], texts[i]])
+    merged_count = len(chosen) - len(passages)
+    passages.sort(key=lambda passage: passage[0])
+
+    selected, used, truncated = [], 0, False
+    for _, _, text in passages:
+        tokens = estimate_tokens(text)
+        if used + tokens > token_budget:
+            remaining = token_budget - used
+            if remaining >= CONTEXT_MIN_PASSAGE_TOKENS:
+                text = truncate_to_tokens(text, remaining)
+                selected.append(text)
+                used += estimate_tokens(text)
+            truncated = True
+            break
+        selected.append(text)
+        used += tokens
+
+    report = {
+        "candidates": len(texts),
+        "chunks_selected": len(order),
+        "chunks_merged": merged_count,
+        "passages": len(selected),
+        "truncated": truncated,
+        "tokens_before": naive_tokens,
+        "tokens_after": used,
+        "tokens_saved": naive_tokens - used,
+    }
+    context_stats.record(report)
+    return selected, report
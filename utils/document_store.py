@@ -0,0 +1,492 @@
+import faiss
+import numpy as np
+from array import array
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import uuid
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from filelock import FileLock
+from typing import Dict, List, Optional
+from utils.lexical_index import BM25Index
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_STORE_DIR = os.getenv("DOCUMENT_STORE_DIR", os.path.join("data", "documents"))
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", "64"))
+
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.bin"
+OFFSETS_FILE = "chunks.offsets.npy"
+PAGES_FILE = "chunks.pages.npy"
+META_FILE = "meta.json"
+HOLDERS_FILE = "holders.json"
+LATEST_FILE = "latest"
+
+_SAFE_COMPONENT = re.compile(r"^[A-Za-z0-9_.\-]{1,128}$")
+
+
+def _safe_component(value: str) -> str:
+    """Reject ids that could escape the store directory"""
+    value = str(value)
+    if not _SAFE_COMPONENT.match(value) or value in (".", ".."):
+        raise ValueError(f"Invalid identifier for document store: {value!r}")
+    return value
+
+
+def hash_file(file_obj, block_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file object's content, read in blocks; the position is restored"""
+    digest = hashlib.sha256()
+    start = file_obj.tell()
+    for block in iter(lambda: file_obj.read(block_size), b""):
+        digest.update(block)
+    file_obj.seek(start)
+    return digest.hexdigest()
+
+
+def _atomic_write_text(path: str, text: str):
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class ChunkTableWriter:
+    """Appends chunks to an on-disk chunk table without holding their texts in memory"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._file = open(os.path.join(directory, CHUNKS_FILE), "wb")
+        self._offsets = array("q", [0])
+        self._pages = array("i")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, text: str, first_page: int = 0, last_page: int = 0):
+        data = text.encode("utf-8")
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+        self._pages.extend((first_page, last_page))
+
+    def close(self):
+        self._file.close()
+        np.save(os.path.join(self.directory, OFFSETS_FILE), np.frombuffer(self._offsets, dtype=np.int64))
+        pages = np.frombuffer(self._pages, dtype=np.int32).reshape(-1, 2)
+        np.save(os.path.join(self.directory, PAGES_FILE), pages)
+
+
+class ChunkTable:
+    """Read-only, memory-mapped table of chunk texts
+
+    Texts are stored back to back as UTF-8 in one file, with a separate int64
+    offsets array (n + 1 entries), so a chunk is decoded only when it is read.
+    An (n, 2) int32 array holds the first and last page of every chunk.
+    """
+
+    def __init__(self, directory: str):
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r")
+        pages_path = os.path.join(directory, PAGES_FILE)
+        self.pages = np.load(pages_path, mmap_mode="r") if os.path.isfile(pages_path) else None
+        self._file = open(os.path.join(directory, CHUNKS_FILE), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @staticmethod
+    def write(directory: str, chunks: List[str], pages: Optional[List] = None):
+        writer = ChunkTableWriter(directory)
+        for i, chunk in enumerate(chunks):
+            first_page, last_page = pages[i] if pages else (0, 0)
+            writer.append(chunk, first_page, last_page)
+        writer.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self._data[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def page_range(self, i: int):
+        """(first_page, last_page) of a chunk, 1-based; (0, 0) when unknown"""
+        if self.pages is None:
+            return (0, 0)
+        first_page, last_page = self.pages[i]
+        return (int(first_page), int(last_page))
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+
+class StoredDocument:
+    """A persisted document whose index and chunks are mapped on first access"""
+
+    def __init__(self, directory: str, meta: Dict, version: int):
+        self.directory = directory
+        self.meta = meta
+        self.version = version
+        self._index = None
+        self._chunks = None
+        self._lexical = None
+        self._lock = threading.Lock()
+
+    @property
+    def document_id(self) -> str:
+        # Documents are content addressed, so the id is the PDF's SHA-256
+        return self.meta["content_hash"]
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = faiss.read_index(
+                        os.path.join(self.directory, INDEX_FILE),
+                        faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+                    )
+        return self._index
+
+    @property
+    def chunks(self) -> ChunkTable:
+        if self._chunks is None:
+            with self._lock:
+                if self._chunks is None:
+                    self._chunks = ChunkTable(self.directory)
+        return self._chunks
+
+    @property
+    def pages(self):
+        """(n, 2) first/last page of every chunk, or None if not recorded"""
+        return self.chunks.pages
+
+    @property
+    def lexical(self) -> Optional[BM25Index]:
+        """BM25 index over the chunks, or None for documents stored before it existed"""
+        if self._lexical is None and self.meta.get("lexical_index"):
+            with self._lock:
+                if self._lexical is None:
+                    self._lexical = BM25Index.load(self.directory)
+        return self._lexical
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+        self._chunks = None
+        self._index = None
+        self._lexical = None
+
+
+class DocumentStore:
+    """Local on-disk, content-addressed store of document indexes
+
+    Layout:
+        <root>/objects/<sha256>/{index.faiss, chunks.bin, chunks.offsets.npy, chunks.pages.npy, bm25.*,
+                                  meta.json, holders.json}
+        <root>/users/<user_id>/<sha256>.json   one reference per book the user holds
+        <root>/users/<user_id>/latest          the user's most recently uploaded document id
+        <root>/locks/                          cross-worker file locks
+
+    A document id is the SHA-256 of the uploaded PDF, so re-uploading a known
+    book only adds a reference. Each object records the users holding it and
+    is garbage collected when the last one lets go. Objects are written to a
+    temporary directory and renamed into place, so other workers never observe
+    a partially written index.
+    """
+
+    def __init__(self, root: str = DOCUMENT_STORE_DIR, cache_size: int = DOCUMENT_CACHE_SIZE):
+        self.root = root
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _object_dir(self, content_hash: str) -> str:
+        return os.path.join(self.root, "objects", _safe_component(content_hash))
+
+    def _user_dir(self, user_id: str) -> str:
+        return os.path.join(self.root, "users", _safe_component(user_id))
+
+    def _ref_path(self, user_id: str, document_id: str) -> str:
+        return os.path.join(self._user_dir(user_id), f"{_safe_component(document_id)}.json")
+
+    def _file_lock(self, name: str) -> FileLock:
+        os.makedirs(os.path.join(self.root, "locks"), exist_ok=True)
+        return FileLock(os.path.join(self.root, "locks", f"{name}.lock"))
+
+    def _latest_lock(self, user_id: str) -> FileLock:
+        """Held while a user's latest-document pointer is read and replaced or removed"""
+        return self._file_lock(f"{_safe_component(user_id)}.latest")
+
+    def ingest_lock(self, content_hash: str) -> FileLock:
+        """Held while a document is being built, so concurrent uploads of one PDF index it once"""
+        return self._file_lock(f"{_safe_component(content_hash)}.ingest")
+
+    def has_object(self, content_hash: str) -> bool:
+        return os.path.isfile(os.path.join(self._object_dir(content_hash), META_FILE))
+
+    def object_meta(self, content_hash: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self._object_dir(content_hash), META_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _read_holders(self, content_hash: str) -> List[str]:
+        try:
+            with open(os.path.join(self._object_dir(content_hash), HOLDERS_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def stage(self) -> str:
+        """Create an empty staging directory to stream a new object into"""
+        staging_dir = os.path.join(self.root, "objects", f"staging.tmp-{uuid.uuid4().hex}")
+        os.makedirs(staging_dir)
+        return staging_dir
+
+    def discard(self, staging_dir: str):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def save(self, user_id: str, content_hash: str, index, chunks: List[str],
+             metadata: Optional[Dict] = None, pages: Optional[List] = None) -> str:
+        """Persist a freshly built index as a shared object and attach it to the user"""
+        staging_dir = self.stage()
+        try:
+            ChunkTable.write(staging_dir, chunks, pages)
+        except Exception:
+            self.discard(staging_dir)
+            raise
+        return self.save_staged(user_id, content_hash, staging_dir, index, len(chunks), metadata)
+
+    def save_staged(self, user_id: str, content_hash: str, staging_dir: str, index, num_chunks: int,
+                    metadata: Optional[Dict] = None) -> str:
+        """Finish a staged object (chunk table already written) and attach it to the user"""
+        final_dir = self._object_dir(content_hash)
+        try:
+            faiss.write_index(index, os.path.join(staging_dir, INDEX_FILE))
+            meta = dict(metadata or {})
+            meta.update({
+                "content_hash": content_hash,
+                "num_chunks": num_chunks,
+                "dimension": index.d,
+                "created_at": datetime.now().isoformat(),
+            })
+            with open(os.path.join(staging_dir, META_FILE), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+
+            with self._file_lock(f"{content_hash}.refs"):
+                holders = self._read_holders(content_hash)
+                with open(os.path.join(staging_dir, HOLDERS_FILE), "w", encoding="utf-8") as f:
+                    json.dump(holders, f)
+                if os.path.exists(final_dir):
+                    old_dir = f"{final_dir}.old-{uuid.uuid4().hex}"
+                    os.rename(final_dir, old_dir)
+                    os.rename(staging_dir, final_dir)
+                    shutil.rmtree(old_dir, ignore_errors=True)
+                else:
+                    os.rename(staging_dir, final_dir)
+        except Exception:
+            self.discard(staging_dir)
+            raise
+
+        self._evict(content_hash)
+        logger.info(f"Stored document {content_hash} ({num_chunks} chunks)")
+        self.attach(user_id, content_hash, {"filename": meta.get("filename")})
+        return content_hash
+
+    def attach(self, user_id: str, content_hash: str, metadata: Optional[Dict] = None) -> Optional[str]:
+        """Give a user a reference to an existing object; returns the document id or None if unknown"""
+        user_dir = self._user_dir(user_id)
+        with self._file_lock(f"{_safe_component(content_hash)}.refs"):
+            if not self.has_object(content_hash):
+                return None
+            holders = self._read_holders(content_hash)
+            if user_id not in holders:
+                holders.append(user_id)
+                _atomic_write_text(os.path.join(self._object_dir(content_hash), HOLDERS_FILE),
+                                   json.dumps(holders))
+
+            os.makedirs(user_dir, exist_ok=True)
+            ref = dict(metadata or {})
+            ref.update({
+                "document_id": content_hash,
+                "attached_at": datetime.now().isoformat(),
+            })
+            _atomic_write_text(self._ref_path(user_id, content_hash), json.dumps(ref))
+
+        with self._latest_lock(user_id):
+            _atomic_write_text(os.path.join(user_dir, LATEST_FILE), content_hash)
+        return content_hash
+
+    def detach(self, user_id: str, document_id: str) -> bool:
+        """Drop a user's reference, deleting the object once nobody holds it"""
+        ref_path = self._ref_path(user_id, document_id)
+        with self._file_lock(f"{_safe_component(document_id)}.refs"):
+            if not os.path.isfile(ref_path):
+                return False
+            os.remove(ref_path)
+
+            holders = [h for h in self._read_holders(document_id) if h != user_id]
+            object_dir = self._object_dir(document_id)
+            if holders:
+                _atomic_write_text(os.path.join(object_dir, HOLDERS_FILE), json.dumps(holders))
+            elif os.path.isdir(object_dir):
+                trash_dir = f"{object_dir}.old-{uuid.uuid4().hex}"
+                os.rename(object_dir, trash_dir)
+                shutil.rmtree(trash_dir, ignore_errors=True)
+                self._evict(document_id)
+                logger.info(f"Garbage collected document {document_id}")
+
+        with self._latest_lock(user_id):
+            if self.latest_document_id(user_id) == document_id:
+                try:
+                    os.remove(os.path.join(self._user_dir(user_id), LATEST_FILE))
+                except FileNotFoundError:
+                    pass
+        return True
+
+    def reference_count(self, content_hash: str) -> int:
+        return len(self._read_holders(content_hash))
+
+    def latest_document_id(self, user_id: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self._user_dir(user_id), LATEST_FILE), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self, user_id: str, document_id: Optional[str] = None) -> Optional[StoredDocument]:
+        """Open a document held by the user (their latest if no id is given), or None if missing"""
+        document_id = document_id or self.latest_document_id(user_id)
+        if not document_id or not os.path.isfile(self._ref_path(user_id, document_id)):
+            return None
+
+        directory = self._object_dir(document_id)
+        meta_path = os.path.join(directory, META_FILE)
+        try:
+            # The meta file is rewritten on every save, so its mtime doubles as a version
+            version = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            self._evict(document_id)
+            return None
+
+        # Objects are shared, so users holding the same book share one mapping
+        with self._lock:
+            cached = self._cache.get(document_id)
+            if cached is not None and cached.version == version:
+                self._cache.move_to_end(document_id)
+                return cached
+
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        document = StoredDocument(directory, meta, version)
+
+        with self._lock:
+            self._cache[document_id] = document
+            self._cache.move_to_end(document_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return document
+
+    def document_ids(self, user_id: str) -> List[str]:
+        """Ids of every document a user holds"""
+        user_dir = self._user_dir(user_id)
+        if not os.path.isdir(user_dir):
+            return []
+        return [name[:-len(".json")] for name in sorted(os.listdir(user_dir)) if name.endswith(".json")]
+
+    def load_library(self, user_id: str) -> List[StoredDocument]:
+        """Every document a user holds, opened (and shared) through the document cache"""
+        documents = []
+        for document_id in self.document_ids(user_id):
+            document = self.load(user_id, document_id)
+            if document is not None:
+                documents.append(document)
+        return documents
+
+    def list_documents(self, user_id: str) -> List[Dict]:
+        """References and object metadata of every document a user holds"""
+        user_dir = self._user_dir(user_id)
+        if not os.path.isdir(user_dir):
+            return []
+        documents = []
+        for name in sorted(os.listdir(user_dir)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(user_dir, name), encoding="utf-8") as f:
+                ref = json.load(f)
+            meta = self.object_meta(ref["document_id"])
+            if meta is None:
+                continue
+            documents.append({**meta, **ref})
+        return documents
+
+    def memory_report(self, user_id: str) -> Dict:
+        """Bytes each of a user's books takes when mapped: vectors, chunk texts and BM25 postings
+
+        Objects are shared, so each book also reports the share attributed to
+        this user (bytes divided by the number of holders).
+        """
+        books = []
+        for document_id in self.document_ids(user_id):
+            directory = self._object_dir(document_id)
+            meta = self.object_meta(document_id)
+            if meta is None:
+                continue
+            sizes = {"vectors": 0, "chunks": 0, "lexical": 0}
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                size = os.path.getsize(os.path.join(directory, name))
+                if name == INDEX_FILE:
+                    sizes["vectors"] += size
+                elif name.startswith("chunks."):
+                    sizes["chunks"] += size
+                elif name.startswith("bm25."):
+                    sizes["lexical"] += size
+            total = sum(sizes.values())
+            holders = max(1, self.reference_count(document_id))
+            index = meta.get("index", {})
+            books.append({
+                "document_id": document_id,
+                "filename": meta.get("filename"),
+                "num_chunks": meta.get("num_chunks"),
+                "index_type": index.get("type"),
+                "encoding": index.get("encoding", "float32"),
+                **{f"{part}_bytes": size for part, size in sizes.items()},
+                "total_bytes": total,
+                "holders": holders,
+                "attributed_bytes": total // holders,
+            })
+        return {
+            "user_id": user_id,
+            "books": books,
+            "total_bytes": sum(book["total_bytes"] for book in books),
+            "attributed_bytes": sum(book["attributed_bytes"] for book in books),
+        }
+
+    def delete(self, user_id: str, document_id: str) -> bool:
+        return self.detach(user_id, document_id)
+
+    def _evict(self, content_hash: str):
+        with self._lock:
+            self._cache.pop(content_hash, None)
+
+
+document_store = DocumentStore()
@@ -0,0 +1,98 @@
+from sentence_transformers import SentenceTransformer
+import threading
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+
+
+class SharedEmbeddingModel:
+    """Thread-safe wrapper around a loaded SentenceTransformer"""
+
+    def __init__(self, name: str, model: SentenceTransformer, load_seconds: float):
+        self.name = name
+        self.model = model
+        self.load_seconds = load_seconds
+        self.dimension = model.get_sentence_embedding_dimension()
+        self.max_seq_length = model.max_seq_length
+        self.memory_bytes = self._measure_memory(model)
+        # The fast tokenizer is not re-entrant, so calls into the model are serialized.
+        # Torch already parallelizes a single encode across cores.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _measure_memory(model) -> int:
+        """Bytes held by the model's parameters and buffers"""
+        total = 0
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            total += tensor.numel() * tensor.element_size()
+        return total
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    def tokenize(self, texts, **kwargs):
+        """Run the model's tokenizer under the same lock as encode"""
+        with self._lock:
+            return self.model.tokenizer(texts, **kwargs)
+
+    def encode(self, sentences, **kwargs):
+        """Encode sentences; accepts the same keyword arguments as SentenceTransformer.encode"""
+        kwargs.setdefault("show_progress_bar", False)
+        with self._lock:
+            return self.model.encode(sentences, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "dimension": self.dimension,
+            "max_seq_length": self.max_seq_length,
+            "memory_bytes": self.memory_bytes,
+            "memory_mb": round(self.memory_bytes / (1024 * 1024), 2),
+            "load_seconds": round(self.load_seconds, 3),
+        }
+
+
+class EmbeddingModelRegistry:
+    """Process-wide registry so every request shares one loaded model"""
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str = EMBEDDING_MODEL_NAME) -> SharedEmbeddingModel:
+        """Return the shared model, loading it on first use"""
+        shared = self._models.get(name)
+        if shared is not None:
+            return shared
+
+        with self._lock:
+            shared = self._models.get(name)
+            if shared is None:
+                logger.info(f"Loading embedding model '{name}'")
+                start = time.perf_counter()
+                model = SentenceTransformer(name)
+                model.eval()
+                shared = SharedEmbeddingModel(name, model, time.perf_counter() - start)
+                self._models[name] = shared
+                logger.info(f"Embedding model '{name}' loaded in {shared.load_seconds:.2f}s "
+                            f"({shared.stats()['memory_mb']} MB)")
+        return shared
+
+    def is_loaded(self, name: str = EMBEDDING_MODEL_NAME) -> bool:
+        return name in self._models
+
+    def stats(self) -> list:
+        return [shared.stats() for shared in self._models.values()]
+
+
+registry = EmbeddingModelRegistry()
+
+
+def get_embedding_model(name: str = EMBEDDING_MODEL_NAME) -> SharedEmbeddingModel:
+    """Shortcut for registry.get()"""
+    return registry.get(name)
@@ -0,0 +1,149 @@
+import numpy as np
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import logging
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("data", "embedding_cache.sqlite3"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form used for cache keys: NFKC with collapsed whitespace"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def cache_key(model_name: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """Persistent (model name, normalized chunk hash) -> embedding cache
+
+    Backed by SQLite in WAL mode so every worker on the node shares it. Rows
+    carry a last-used timestamp; when the table grows past max_entries the
+    least recently used tenth is evicted. Hit and miss counts are per process.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key BLOB PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+            conn.commit()
+            self._count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype="float32")
+            if found:
+                now = time.time()
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                 [(now, key) for key in found])
+                conn.commit()
+        return found
+
+    def put_many(self, items: Dict[bytes, np.ndarray]):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype="float32").tobytes(), now) for key, vector in items.items()]
+            )
+            self._count += len(items)
+            if self._count > self.max_entries:
+                self._count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                excess = self._count - int(self.max_entries * 0.9)
+                if excess > 0:
+                    conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+                    )
+                    self._count -= excess
+                    self.evictions += excess
+            conn.commit()
+
+    def encode(self, model, texts: List[str]) -> np.ndarray:
+        """Embed texts, sending only cache misses (deduplicated) to the model"""
+        keys = [cache_key(model.name, text) for text in texts]
+        found = self.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        misses = sum(1 for key in keys if key in missing)
+        # Called from the embedding thread and request threads at once
+        with self._lock:
+            self.misses += misses
+            self.hits += len(keys) - misses
+
+        if missing:
+            vectors = np.asarray(model.encode(list(missing.values())), dtype="float32")
+            computed = dict(zip(missing.keys(), vectors))
+            self.put_many(computed)
+            found.update(computed)
+
+        return np.stack([found[key] for key in keys]) if keys else np.empty((0, 0), dtype="float32")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits, misses, entries, evictions = self.hits, self.misses, self._count, self.evictions
+        lookups = hits + misses
+        return {
+            "enabled": EMBEDDING_CACHE_ENABLED,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else None,
+            "evictions": evictions,
+        }
+
+
+embedding_cache = EmbeddingCache()
@@ -1,5 +1,9 @@
 import json
+import logging
 import re
+import time
+
+logger = logging.getLogger(__name__)
 
 #* cleans and parses the response to json, or returns plain text if not JSON
 
@@ -239,3 +243,60 @@ def parse_true_false_text(tf_text):
         })
     return questions
 
+
+NOTES_TYPES = ["notes generation", "notes", "note generation"]
+
+def is_notes_type(exercise_type):
+    return exercise_type.lower() in NOTES_TYPES
+
+def parse_exercise_text(exercise_type, exercises):
+    """
+    Parses raw generated exercise text into a list of question dicts for the
+    exercise types that have a parser; anything else is returned unchanged.
+    """
+    if not isinstance(exercises, str):
+        return exercises
+    exercise_type = exercise_type.lower()
+    if exercise_type in ["multiple choice", "mcq", "mcqs"]:
+        return parse_mcq_text(exercises)
+    if exercise_type in ["true/false", "true_false", "true false", "tf"]:
+        return parse_true_false_text(exercises)
+    if exercise_type in ["short answer", "short_questions", "short question", "sqs"]:
+        return parse_sqs_text(exercises)
+    if exercise_type in ["long questions", "long_questions", "long question", "lqs"]:
+        return parse_lqs_text(exercises)
+    if exercise_type in ["fill in the blanks", "fill_blanks", "fill blank", "blanks"]:
+        return parse_blanks_text(exercises)
+    return exercises
+
+# Keep proxies from buffering the event stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(data, event=None):
+    """One Server-Sent Events frame; data is sent as JSON so newlines survive"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+async def sse_text_stream(pieces, meta=None):
+    """SSE frames for streamed text: a meta event, a data event per piece, then done or error
+
+    The done event carries the time to first token, measured from the start
+    of the stream, so it includes queueing for a model slot.
+    """
+    start = time.perf_counter()
+    first_token_ms = None
+    if meta is not None:
+        yield sse_event(meta, "meta")
+    try:
+        async for piece in pieces:
+            if first_token_ms is None:
+                first_token_ms = round(1000 * (time.perf_counter() - start), 2)
+            yield sse_event({"text": piece})
+    except Exception as e:
+        logger.error(f"Streaming failed: {e}")
+        yield sse_event({"detail": str(e)}, "error")
+        return
+    yield sse_event({
+        "first_token_ms": first_token_ms,
+        "total_ms": round(1000 * (time.perf_counter() - start), 2),
+    }, "done")
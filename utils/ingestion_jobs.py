@@ -0,0 +1,272 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional
+from utils.pdf_pages import count_pages, extract_page_range, table_of_contents
+from utils.rag import RAGProcessor
+
+logger = logging.getLogger(__name__)
+
+INGEST_JOBS_DIR = os.getenv("INGEST_JOBS_DIR", os.path.join("data", "jobs"))
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", "2"))
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "25"))
+INGEST_JOB_RETENTION_SECONDS = int(os.getenv("INGEST_JOB_RETENTION_SECONDS", str(24 * 3600)))
+STATUS_WRITE_INTERVAL = 0.5
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+class IngestionJob:
+    """Progress of one uploaded book through parsing and embedding"""
+
+    def __init__(self, job_id: str, user_id: str, filename: str, path: str):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.filename = filename
+        self.path = path
+        self.content_hash = None
+        self.status = QUEUED
+        self.pages_total = 0
+        self.pages_parsed = 0
+        self.chunks_embedded = 0
+        self.result = None
+        self.error = None
+        self.worker_pid = os.getpid()
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (COMPLETED, FAILED)
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "filename": self.filename,
+            "status": self.status,
+            "pages_total": self.pages_total,
+            "pages_parsed": self.pages_parsed,
+            "chunks_embedded": self.chunks_embedded,
+            "result": self.result,
+            "error": self.error,
+            "worker_pid": self.worker_pid,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionJobManager:
+    """Runs book ingestion off the event loop
+
+    PDF pages are parsed in a process pool (spawned, so children never import
+    torch) in page-range tasks, with a bounded number in flight. A single
+    dedicated thread owns embedding: it consumes jobs in order and feeds the
+    parsed pages through RAGProcessor.ingest_document. Job status is mirrored
+    to <jobs_dir>/<job_id>.json so any worker can answer status polls.
+    """
+
+    def __init__(self, jobs_dir: str = INGEST_JOBS_DIR, parse_workers: int = INGEST_PARSE_WORKERS,
+                 pages_per_task: int = INGEST_PAGES_PER_TASK):
+        self.jobs_dir = jobs_dir
+        self.parse_workers = parse_workers
+        self.pages_per_task = pages_per_task
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._executor = None
+        self._thread = None
+        self._last_write = {}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self._prune()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        self._thread = threading.Thread(target=self._run, name="embedding-worker", daemon=True)
+        self._thread.start()
+
+    def shutdown(self, timeout: float = 10.0):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._thread = None
+        self._executor = None
+
+    def create(self, user_id: str, filename: str) -> IngestionJob:
+        """Register a job and reserve the path its upload should be written to"""
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        job = IngestionJob(job_id, user_id, filename, os.path.join(self.jobs_dir, f"{job_id}.pdf"))
+        self._jobs[job_id] = job
+        return job
+
+    def submit(self, job: IngestionJob, content_hash: str) -> IngestionJob:
+        """Queue a job whose upload has been written; already-indexed content completes at once"""
+        job.content_hash = content_hash
+        processor = RAGProcessor()
+        try:
+            if processor.attach_existing(job.user_id, content_hash, {"filename": job.filename}):
+                self._complete(job, processor)
+                return job
+        except Exception as e:
+            self._fail(job, e)
+            return job
+
+        self._write_status(job, force=True)
+        self._queue.put(job)
+        return job
+
+    def fail(self, job: IngestionJob, error: Exception):
+        """Fail a job that never reached the queue; its upload, if any, is removed"""
+        self._fail(job, error)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+
+        try:
+            uuid.UUID(hex=job_id)
+            with open(self._status_path(job_id), encoding="utf-8") as f:
+                status = json.load(f)
+        except (ValueError, FileNotFoundError):
+            return None
+
+        if status["status"] not in (COMPLETED, FAILED) and not _pid_alive(status["worker_pid"]):
+            status["status"] = FAILED
+            status["error"] = "Ingestion was interrupted by a server restart; please upload again"
+        return status
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize(),
+            "running": sum(1 for job in self._jobs.values() if job.status == RUNNING),
+            "parse_workers": self.parse_workers,
+        }
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._process(job)
+
+    def _process(self, job: IngestionJob):
+        job.status = RUNNING
+        job.started_at = datetime.now().isoformat()
+        self._write_status(job, force=True)
+        try:
+            processor = RAGProcessor()
+            toc = self._executor.submit(table_of_contents, job.path)
+            job.pages_total = self._executor.submit(count_pages, job.path).result()
+            self._write_status(job, force=True)
+
+            def progress(chunks_embedded):
+                job.chunks_embedded = chunks_embedded
+                self._write_status(job)
+
+            processor.ingest_document(
+                job.user_id, job.content_hash, lambda: self._parse_pages(job),
+                {"filename": job.filename, "chapters": toc.result()}, progress=progress
+            )
+            self._complete(job, processor)
+        except Exception as e:
+            logger.error(f"Ingestion job {job.job_id} failed: {e}")
+            self._fail(job, e)
+
+    def _parse_pages(self, job: IngestionJob):
+        """Yield (page_number, text) in order while the pool parses the following ranges"""
+        starts = deque(range(0, job.pages_total, self.pages_per_task))
+        pending = deque()
+        while starts or pending:
+            while starts and len(pending) < self.parse_workers * 2:
+                start = starts.popleft()
+                pending.append(self._executor.submit(extract_page_range, job.path, start,
+                                                     start + self.pages_per_task))
+            pages = pending.popleft().result()
+            job.pages_parsed += len(pages)
+            self._write_status(job)
+            yield from pages
+
+    def _complete(self, job: IngestionJob, processor):
+        job.status = COMPLETED
+        job.result = {
+            "document_id": processor.document_id,
+            "deduplicated": processor.deduplicated,
+            "message": ("Book already indexed, attached existing index" if processor.deduplicated
+                        else "Book uploaded and indexed successfully"),
+        }
+        self._finish(job)
+
+    def _fail(self, job: IngestionJob, error: Exception):
+        job.status = FAILED
+        job.error = str(error)
+        self._finish(job)
+
+    def _finish(self, job: IngestionJob):
+        job.finished_at = datetime.now().isoformat()
+        self._write_status(job, force=True)
+        self._last_write.pop(job.job_id, None)
+        # Finished jobs are served from their status file from now on
+        self._jobs.pop(job.job_id, None)
+        try:
+            os.remove(job.path)
+        except FileNotFoundError:
+            pass
+
+    def _prune(self):
+        """Delete status files and orphaned uploads older than the retention period"""
+        cutoff = time.time() - INGEST_JOB_RETENTION_SECONDS
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _status_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _write_status(self, job: IngestionJob, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_write.get(job.job_id, 0) < STATUS_WRITE_INTERVAL:
+            return
+        self._last_write[job.job_id] = now
+        path = self._status_path(job.job_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp_path, path)
+
+
+ingestion_jobs = IngestionJobManager()
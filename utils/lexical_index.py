@@ -0,0 +1,195 @@
+import numpy as np
+from array import array
+import json
+import os
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+VOCAB_FILE = "bm25.vocab.json"
+TERM_OFFSETS_FILE = "bm25.offsets.npy"
+POSTING_DOCS_FILE = "bm25.docs.npy"
+POSTING_TFS_FILE = "bm25.tfs.npy"
+DOC_LENGTHS_FILE = "bm25.doclen.npy"
+
+# Bumped whenever tokenize changes, so indexes built with the old tokens are rebuilt
+LEXICAL_FORMAT = 2
+
+_TOKEN = re.compile(r"\w+")
+# 's only at the end of a word, so quotes opening a word ('sigma') are left alone
+_POSSESSIVE = re.compile(r"(?<=\w)'s\b")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how in is it its of on or that the their "
+    "there these this to was were what when where which who why will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Case-folded word tokens with possessive 's dropped ("Ohm's law" -> ohm, law)"""
+    text = _POSSESSIVE.sub("", unicodedata.normalize("NFKC", text).casefold().replace("’", "'"))
+    return [token for token in _TOKEN.findall(text) if token not in STOPWORDS]
+
+
+class BM25Builder:
+    """Accumulates chunk term frequencies while a document is ingested
+
+    Postings are kept per term in typed arrays (4 bytes per doc id, 2 per term
+    frequency) instead of Python lists, so building stays compact for large books.
+    """
+
+    def __init__(self):
+        self._docs: Dict[str, array] = {}
+        self._tfs: Dict[str, array] = {}
+        self._lengths = array("i")
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, text: str):
+        """Index the next chunk; chunk ids are assigned in call order"""
+        doc_id = len(self._lengths)
+        counts: Dict[str, int] = {}
+        tokens = tokenize(text)
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for term, tf in counts.items():
+            docs = self._docs.get(term)
+            if docs is None:
+                docs = self._docs[term] = array("i")
+                self._tfs[term] = array("H")
+            docs.append(doc_id)
+            self._tfs[term].append(min(tf, 65535))
+        self._lengths.append(len(tokens))
+
+    def build(self) -> "BM25Index":
+        terms = sorted(self._docs)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(self._docs[term]) for term in terms], out=offsets[1:])
+        docs = np.empty(offsets[-1], dtype=np.int32)
+        tfs = np.empty(offsets[-1], dtype=np.uint16)
+        for i, term in enumerate(terms):
+            docs[offsets[i]:offsets[i + 1]] = np.frombuffer(self._docs[term], dtype=np.int32)
+            tfs[offsets[i]:offsets[i + 1]] = np.frombuffer(self._tfs[term], dtype=np.uint16)
+        lengths = np.frombuffer(self._lengths, dtype=np.int32).copy()
+        return BM25Index(terms, offsets, docs, tfs, lengths)
+
+    def save(self, directory: str) -> Dict:
+        return self.build().save(directory)
+
+
+class BM25Index:
+    """Okapi BM25 over chunks, stored as CSR-style postings arrays
+
+    offsets[t]:offsets[t + 1] is the slice of docs/tfs holding the postings of
+    the t-th term in sorted vocabulary order. The arrays are memory-mapped when
+    loaded from disk; only the vocabulary is parsed into a dict.
+    """
+
+    def __init__(self, terms: List[str], offsets: np.ndarray, docs: np.ndarray, tfs: np.ndarray,
+                 lengths: np.ndarray, k1: float = BM25_K1, b: float = BM25_B):
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        # Plain ndarray views over the mapped files; slicing np.memmap is comparatively slow
+        self.offsets = np.asarray(offsets)
+        self.docs = np.asarray(docs)
+        self.tfs = np.asarray(tfs)
+        self.lengths = lengths
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(lengths)
+        self.avg_length = float(lengths.mean()) if self.num_docs else 0.0
+        # Per-chunk length normalisation, precomputed once
+        self._norm = (k1 * (1 - b + b * lengths / self.avg_length)).astype(np.float32) \
+            if self.avg_length else np.zeros(self.num_docs, dtype=np.float32)
+
+    def __len__(self):
+        return self.num_docs
+
+    def save(self, directory: str) -> Dict:
+        with open(os.path.join(directory, VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump({"terms": self.terms, "k1": self.k1, "b": self.b}, f)
+        np.save(os.path.join(directory, TERM_OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(directory, POSTING_DOCS_FILE), self.docs)
+        np.save(os.path.join(directory, POSTING_TFS_FILE), self.tfs)
+        np.save(os.path.join(directory, DOC_LENGTHS_FILE), self.lengths)
+        return self.describe()
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["BM25Index"]:
+        """Memory-map a saved index; None if the document predates lexical indexing"""
+        vocab_path = os.path.join(directory, VOCAB_FILE)
+        if not os.path.isfile(vocab_path):
+            return None
+        with open(vocab_path, encoding="utf-8") as f:
+            vocab = json.load(f)
+
+        def array_file(name):
+            return np.load(os.path.join(directory, name), mmap_mode="r")
+
+        return cls(vocab["terms"], array_file(TERM_OFFSETS_FILE), array_file(POSTING_DOCS_FILE),
+                   array_file(POSTING_TFS_FILE), np.load(os.path.join(directory, DOC_LENGTHS_FILE)),
+                   vocab["k1"], vocab["b"])
+
+    def known_terms(self, query: str) -> List[int]:
+        return [self.term_ids[t] for t in dict.fromkeys(tokenize(query)) if t in self.term_ids]
+
+    def search(self, query: str, k: int,
+               id_ranges: Optional[List[Tuple[int, int]]] = None) -> List[Tuple[int, float]]:
+        """Top k (chunk id, score) pairs; touches only the postings of the query's terms
+
+        id_ranges restricts results to chunk ids in any of the [lo, hi) ranges.
+        """
+        term_ids = self.known_terms(query)
+        if not term_ids or k <= 0:
+            return []
+        docs_parts, score_parts = [], []
+        for t in term_ids:
+            start, end = int(self.offsets[t]), int(self.offsets[t + 1])
+            docs = self.docs[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            df = end - start
+            idf = np.log(1.0 + (self.num_docs - df + 0.5) / (df + 0.5))
+            docs_parts.append(docs)
+            score_parts.append(idf * tfs * (self.k1 + 1) / (tfs + self._norm[docs]))
+
+        if len(docs_parts) == 1:
+            docs, scores = docs_parts[0], score_parts[0]
+        else:
+            docs, inverse = np.unique(np.concatenate(docs_parts), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(score_parts)).astype(np.float32)
+        if id_ranges is not None:
+            keep = np.zeros(len(docs), dtype=bool)
+            for lo, hi in id_ranges:
+                keep |= (docs >= lo) & (docs < hi)
+            docs, scores = docs[keep], scores[keep]
+            if not len(docs):
+                return []
+
+        if len(docs) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(docs))
+        # Ties break towards the earlier chunk so results are deterministic
+        top = top[np.lexsort((docs[top], -scores[top]))]
+        return [(int(docs[i]), float(scores[i])) for i in top]
+
+    def describe(self) -> Dict:
+        return {
+            "type": "bm25",
+            "format": LEXICAL_FORMAT,
+            "chunks": self.num_docs,
+            "terms": len(self.terms),
+            "postings": int(self.offsets[-1]) if len(self.offsets) else 0,
+        }
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int, rrf_k: int = 60) -> List[int]:
+    """Merge ranked id lists by sum of 1 / (rrf_k + rank); first-seen order breaks ties"""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
@@ -0,0 +1,170 @@
+import faiss
+import numpy as np
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from utils import vector_index
+
+# (first_page, last_page), inclusive and 1-based
+PageRange = Tuple[int, int]
+
+
+class InMemoryBook:
+    """A book indexed for one request only (not persisted, never cached)"""
+    document_id = None
+    version = None
+
+    def __init__(self, index, chunks: List[str], pages: List[PageRange], lexical=None, meta: Optional[Dict] = None):
+        self.index = index
+        self.chunks = chunks
+        self.pages = np.asarray(pages, dtype=np.int32).reshape(-1, 2)
+        self.lexical = lexical
+        self.meta = meta or {}
+
+
+class Library:
+    """A user's books searched as one index
+
+    Every book keeps its own content-addressed FAISS and BM25 index, so books
+    stay shared between users. The library numbers all chunks in one id space
+    (the book's base offset plus its local chunk id). Book and page filters
+    become faiss ID selectors passed to each book's search, so excluded chunks
+    are never scored; books outside the scope are not searched at all. The
+    per-book top k lists are then merged by score.
+    """
+
+    def __init__(self, books: Iterable):
+        self.books = list(books)
+        self.bases = np.zeros(len(self.books) + 1, dtype=np.int64)
+        np.cumsum([len(book.chunks) for book in self.books], out=self.bases[1:])
+        self.positions = {book.document_id: i for i, book in enumerate(self.books)}
+        versions = [(book.document_id, book.version) for book in self.books]
+        # None disables result caching (books built in memory have no version)
+        self.version = tuple(versions) if all(v is not None for _, v in versions) else None
+
+    def __len__(self):
+        return int(self.bases[-1])
+
+    def __getitem__(self, chunk_id: int) -> str:
+        position, local_id = self.locate(chunk_id)
+        return self.books[position].chunks[local_id]
+
+    @property
+    def document_ids(self) -> List[str]:
+        return [book.document_id for book in self.books]
+
+    def locate(self, chunk_id: int) -> Tuple[int, int]:
+        """(book position, local chunk id) of a library chunk id"""
+        if chunk_id < 0 or chunk_id >= len(self):
+            raise IndexError(chunk_id)
+        position = int(np.searchsorted(self.bases, chunk_id, side="right")) - 1
+        return position, chunk_id - int(self.bases[position])
+
+    def metadata(self, chunk_id: int) -> Dict:
+        """Book id, filename, pages and chapter of a chunk"""
+        position, local_id = self.locate(chunk_id)
+        book = self.books[position]
+        first_page, last_page = (int(p) for p in book.pages[local_id]) if book.pages is not None else (0, 0)
+        return {
+            "book_id": book.document_id,
+            "filename": book.meta.get("filename"),
+            "first_page": first_page,
+            "last_page": last_page,
+            "chapter": chapter_of(book.meta.get("chapters"), first_page),
+        }
+
+    def vectors(self, chunk_ids: Sequence[int]) -> np.ndarray:
+        """Stored embeddings of library chunks, in the order given"""
+        located = [self.locate(i) for i in chunk_ids]
+        dimension = self.books[located[0][0]].index.d if located else 0
+        vectors = np.empty((len(chunk_ids), dimension), dtype=np.float32)
+        by_book: Dict[int, List[int]] = {}
+        for row, (position, _) in enumerate(located):
+            by_book.setdefault(position, []).append(row)
+        for position, rows in by_book.items():
+            vectors[rows] = vector_index.reconstruct(self.books[position].index, [located[r][1] for r in rows])
+        return vectors
+
+    def scope(self, book_ids: Optional[Sequence[str]] = None,
+              page_ranges: Optional[Sequence[PageRange]] = None) -> List[Tuple[int, Optional[List[Tuple[int, int]]]]]:
+        """(book position, local chunk id ranges or None for all) for every book a search should visit
+
+        Chunks are stored in page order, so a page range maps to one contiguous
+        range of chunk ids per book. Unknown book ids are ignored.
+        """
+        if book_ids:
+            positions = sorted({self.positions[b] for b in book_ids if b in self.positions})
+        else:
+            positions = range(len(self.books))
+        scoped = []
+        for position in positions:
+            book = self.books[position]
+            if not page_ranges:
+                scoped.append((position, None))
+                continue
+            if book.pages is None or not len(book.pages):
+                continue
+            first_pages = np.asarray(book.pages[:, 0])
+            last_pages = np.asarray(book.pages[:, 1])
+            ranges = []
+            for first_page, last_page in page_ranges:
+                lo = int(np.searchsorted(last_pages, first_page, side="left"))
+                hi = int(np.searchsorted(first_pages, last_page, side="right"))
+                if lo < hi:
+                    ranges.append((lo, hi))
+            if ranges:
+                scoped.append((position, ranges))
+        return scoped
+
+    @staticmethod
+    def _selector(ranges: Optional[List[Tuple[int, int]]]):
+        if ranges is None:
+            return None
+        if len(ranges) == 1:
+            return faiss.IDSelectorRange(*ranges[0])
+        return faiss.IDSelectorBatch(np.concatenate([np.arange(lo, hi, dtype=np.int64) for lo, hi in ranges]))
+
+    def search(self, query_vectors: np.ndarray, k: int, scope, nprobe: int = None,
+               ef_search: int = None) -> List[List[int]]:
+        """Top k library chunk ids per query vector, best first"""
+        scores, ids = [], []
+        for position, ranges in scope:
+            selector = self._selector(ranges)
+            D, I = vector_index.search(self.books[position].index, query_vectors, k,
+                                       nprobe=nprobe, ef_search=ef_search, selector=selector)
+            # Missing results (-1) sort last
+            scores.append(np.where(I >= 0, D, -np.inf))
+            ids.append(np.where(I >= 0, I + self.bases[position], -1))
+        if not ids:
+            return [[] for _ in range(len(query_vectors))]
+        scores, ids = np.hstack(scores), np.hstack(ids)
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return [[int(i) for i in row[o] if i >= 0] for row, o in zip(ids, order)]
+
+    def has_lexical(self, scope) -> bool:
+        return bool(scope) and all(self.books[position].lexical is not None for position, _ in scope)
+
+    def covers_terms(self, query: str, terms: List[str], scope) -> bool:
+        """Whether every query term occurs in at least one book in scope"""
+        found = set()
+        for position, _ in scope:
+            lexical = self.books[position].lexical
+            found.update(lexical.terms[t] for t in lexical.known_terms(query))
+        return found >= set(terms)
+
+    def lexical_search(self, query: str, k: int, scope) -> List[int]:
+        """Top k library chunk ids by BM25, merged across books by score"""
+        hits = []
+        for position, ranges in scope:
+            base = int(self.bases[position])
+            for local_id, score in self.books[position].lexical.search(query, k, ranges):
+                hits.append((score, base + local_id))
+        hits.sort(key=lambda hit: (-hit[0], hit[1]))
+        return [chunk_id for _, chunk_id in hits[:k]]
+
+
+def chapter_of(chapters: Optional[List], page: int) -> Optional[str]:
+    """Title of the chapter containing a page, from [title, start_page] pairs in page order"""
+    if not chapters or page <= 0:
+        return None
+    i = bisect_right([start for _, start in chapters], page) - 1
+    return chapters[i][0] if i >= 0 else None
@@ -0,0 +1,280 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import AsyncIterator, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# "gemini" calls the Gemini API; "fake" answers locally (tests and benchmarks)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+# Per-route caps as "route=limit" pairs, e.g. "mentor=16,exercise=24"; unlisted routes use the global cap only.
+# pregen is the background pre-generation of popular exercise sets.
+LLM_ROUTE_CONCURRENCY = os.getenv("LLM_ROUTE_CONCURRENCY", "mentor=16,exercise=24,pregen=4")
+# Covers both waiting for a slot and the model call itself
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_FAKE_LATENCY_SECONDS = float(os.getenv("LLM_FAKE_LATENCY_SECONDS", "0.05"))
+
+
+class LLMTimeoutError(TimeoutError):
+    """A generation call did not finish within the gateway timeout"""
+
+
+def parse_route_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for pair in spec.split(","):
+        if "=" in pair:
+            route, limit = pair.split("=", 1)
+            limits[route.strip()] = int(limit)
+    return limits
+
+
+class GeminiBackend:
+    """Gemini through google-generativeai's async client
+
+    The API key is configured once and one GenerativeModel is kept per model
+    name, so its gRPC channel is reused by every request of the process.
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str] = None):
+        import google.generativeai as genai
+        self._genai = genai
+        genai.configure(api_key=api_key or os.getenv("GEMINI_API_KEY"))
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _model(self, model: str):
+        generative_model = self._models.get(model)
+        if generative_model is None:
+            with self._lock:
+                generative_model = self._models.setdefault(model, self._genai.GenerativeModel(model))
+        return generative_model
+
+    async def generate(self, prompt: str, model: str) -> str:
+        response = await self._model(model).generate_content_async(prompt)
+        return response.text
+
+    async def stream(self, prompt: str, model: str) -> AsyncIterator[str]:
+        response = await self._model(model).generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+
+class FakeBackend:
+    """Local stand-in for the LLM: waits for a fixed latency and returns a canned answer
+
+    The answer is an MCQ block with an answer key (so exercise parsing has
+    something to parse) tagged with a digest of the prompt, so equal prompts
+    get equal answers.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency: float = LLM_FAKE_LATENCY_SECONDS):
+        self.latency = latency
+        self.calls = 0
+
+    def answer(self, prompt: str, model: str) -> str:
+        digest = hashlib.sha1(f"{model}\0{prompt}".encode("utf-8")).hexdigest()[:12]
+        return (f"1. Which answer does the fake model {model} give for prompt {digest}?\n"
+                "a) first\nb) second\nc) third\nd) fourth\n"
+                "Answer Key:\n1. b")
+
+    async def generate(self, prompt: str, model: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.answer(prompt, model)
+
+    async def stream(self, prompt: str, model: str) -> AsyncIterator[str]:
+        """The same answer line by line; the latency is spread over the lines"""
+        self.calls += 1
+        lines = self.answer(prompt, model).splitlines(keepends=True)
+        for line in lines:
+            await asyncio.sleep(self.latency / len(lines))
+            yield line
+
+
+BACKENDS = {"gemini": GeminiBackend, "fake": FakeBackend}
+
+
+class RouteStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.started = 0
+        self.wait_seconds = 0.0
+        self.call_seconds = 0.0
+        self.streams = 0
+        self.first_token_seconds = 0.0
+
+    def record_first_token(self, seconds: float):
+        self.streams += 1
+        self.first_token_seconds += seconds
+
+    def to_dict(self) -> Dict:
+        done = self.calls - self.in_flight - self.waiting
+        finished = self.started - self.in_flight
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "avg_wait_ms": round(1000 * self.wait_seconds / done, 2) if done else None,
+            "avg_call_ms": round(1000 * self.call_seconds / finished, 2) if finished else None,
+            "streams": self.streams,
+            "avg_first_token_ms": round(1000 * self.first_token_seconds / self.streams, 2) if self.streams else None,
+        }
+
+
+class LLMGateway:
+    """The one path from request handlers to the LLM
+
+    Calls are awaited on the event loop instead of blocking a worker thread.
+    A call takes a slot of the global limit and of its route's limit before
+    reaching the backend, and gives up after the timeout. The backend is
+    created on first use from LLM_BACKEND unless one is set explicitly.
+    """
+
+    def __init__(self, backend=None, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 route_limits: Optional[Dict[str, int]] = None, timeout: float = LLM_TIMEOUT_SECONDS):
+        self._backend = backend
+        self.max_concurrency = max_concurrency
+        self.route_limits = parse_route_limits(LLM_ROUTE_CONCURRENCY) if route_limits is None else route_limits
+        self.timeout = timeout
+        self._routes: Dict[str, RouteStats] = {}
+        # Semaphores belong to one event loop; they are recreated if the loop changes
+        self._loop = None
+        self._global = None
+        self._route_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    logger.info(f"Creating LLM backend '{LLM_BACKEND}'")
+                    self._backend = BACKENDS[LLM_BACKEND]()
+        return self._backend
+
+    def set_backend(self, backend):
+        """Swap the backend (a FakeBackend in tests and benchmarks)"""
+        self._backend = backend
+
+    def _semaphores(self, route: str):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._global = asyncio.Semaphore(self.max_concurrency)
+            self._route_semaphores = {}
+        semaphore = self._route_semaphores.get(route)
+        if semaphore is None and route in self.route_limits:
+            semaphore = self._route_semaphores[route] = asyncio.Semaphore(self.route_limits[route])
+        return self._global, semaphore
+
+    async def _acquire(self, route_semaphore, global_semaphore):
+        # Route slot first, so a saturated route queues without holding global slots
+        if route_semaphore is not None:
+            await route_semaphore.acquire()
+        try:
+            await global_semaphore.acquire()
+        except BaseException:
+            if route_semaphore is not None:
+                route_semaphore.release()
+            raise
+
+    def _deadline(self, timeout: Optional[float]) -> float:
+        return asyncio.get_running_loop().time() + (self.timeout if timeout is None else timeout)
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, route: str, deadline: float):
+        """Hold a global and a route slot for one call, with its stats"""
+        stats = self._routes.setdefault(route, RouteStats())
+        global_semaphore, route_semaphore = self._semaphores(route)
+        stats.calls += 1
+        stats.waiting += 1
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout_at(deadline):
+                await self._acquire(route_semaphore, global_semaphore)
+        except TimeoutError:
+            stats.timeouts += 1
+            raise LLMTimeoutError(f"No LLM slot free for route '{route}' within the timeout")
+        finally:
+            stats.waiting -= 1
+            stats.wait_seconds += time.perf_counter() - start
+        stats.started += 1
+        stats.in_flight += 1
+        acquired = time.perf_counter()
+        try:
+            yield stats
+        except TimeoutError:
+            stats.timeouts += 1
+            raise LLMTimeoutError(f"LLM call for route '{route}' timed out")
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+            stats.call_seconds += time.perf_counter() - acquired
+            global_semaphore.release()
+            if route_semaphore is not None:
+                route_semaphore.release()
+
+    async def generate(self, prompt: str, model: str, route: str = "default",
+                       timeout: Optional[float] = None) -> str:
+        """Text of the model's answer to prompt; raises LLMTimeoutError after the timeout"""
+        deadline = self._deadline(timeout)
+        async with self._slot(route, deadline):
+            async with asyncio.timeout_at(deadline):
+                return await self.backend.generate(prompt, model)
+
+    async def stream(self, prompt: str, model: str, route: str = "default",
+                     timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """Pieces of the model's answer as the backend produces them
+
+        The slots are held until the stream is exhausted or closed (a client
+        disconnect closes it). The timeout bounds the whole stream; it is
+        applied to each read so it never fires while the consumer holds a piece.
+        """
+        deadline = self._deadline(timeout)
+        async with self._slot(route, deadline) as stats:
+            start = time.perf_counter()
+            pieces = self.backend.stream(prompt, model).__aiter__()
+            first = True
+            try:
+                while True:
+                    async with asyncio.timeout_at(deadline):
+                        try:
+                            piece = await pieces.__anext__()
+                        except StopAsyncIteration:
+                            break
+                    if first:
+                        stats.record_first_token(time.perf_counter() - start)
+                        first = False
+                    yield piece
+            finally:
+                await pieces.aclose()
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self._backend.name if self._backend is not None else LLM_BACKEND,
+            "max_concurrency": self.max_concurrency,
+            "route_limits": self.route_limits,
+            "timeout_seconds": self.timeout,
+            "routes": {route: stats.to_dict() for route, stats in self._routes.items()},
+        }
+
+
+llm_gateway = LLMGateway()
@@ -0,0 +1,26 @@
+import fitz
+
+# Kept free of torch/faiss imports: these functions run in spawned parser processes
+
+
+def count_pages(path: str) -> int:
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+def extract_page_range(path: str, start: int, stop: int) -> list:
+    """Text of pages [start, stop) as (page_number, text) pairs with 1-based page numbers"""
+    with fitz.open(path) as doc:
+        return [(n + 1, doc[n].get_text()) for n in range(start, min(stop, doc.page_count))]
+
+
+def chapters(doc) -> list:
+    """Top-level outline entries of an open document as [title, start_page] pairs in page order"""
+    entries = [[title.strip(), page] for level, title, page, *_ in doc.get_toc(simple=True)
+               if level == 1 and page > 0]
+    return sorted(entries, key=lambda entry: entry[1])
+
+
+def table_of_contents(path: str) -> list:
+    with fitz.open(path) as doc:
+        return chapters(doc)
@@ -0,0 +1,328 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from starlette.concurrency import run_in_threadpool
+from utils.embedding_cache import normalize_text
+from utils.process_files import ProcessFile
+
+logger = logging.getLogger(__name__)
+
+PREGEN_ENABLED = os.getenv("PREGEN_ENABLED", "true").lower() == "true"
+# How many of the most requested keys are kept warm
+PREGEN_HOT_KEYS = int(os.getenv("PREGEN_HOT_KEYS", "300"))
+# Ready exercise sets per key after an off-peak fill
+PREGEN_POOL_DEPTH = int(os.getenv("PREGEN_POOL_DEPTH", "3"))
+# Decayed request count a key needs before it is pre-generated
+PREGEN_MIN_POPULARITY = float(os.getenv("PREGEN_MIN_POPULARITY", "3"))
+PREGEN_POPULARITY_HALF_LIFE_HOURS = float(os.getenv("PREGEN_POPULARITY_HALF_LIFE_HOURS", "72"))
+PREGEN_TRACKED_KEYS = int(os.getenv("PREGEN_TRACKED_KEYS", "10000"))
+# Server-local hours, "start-end" with the end excluded; may wrap midnight ("22-6")
+PREGEN_OFF_PEAK_HOURS = os.getenv("PREGEN_OFF_PEAK_HOURS", "1-6")
+# Outside off-peak hours only keys whose pool ran empty get one new set
+PREGEN_REFILL_DURING_PEAK = os.getenv("PREGEN_REFILL_DURING_PEAK", "true").lower() == "true"
+PREGEN_INTERVAL_SECONDS = float(os.getenv("PREGEN_INTERVAL_SECONDS", "300"))
+PREGEN_CONCURRENCY = int(os.getenv("PREGEN_CONCURRENCY", "4"))
+# Pooled sets older than this are discarded rather than served
+PREGEN_MAX_AGE_HOURS = float(os.getenv("PREGEN_MAX_AGE_HOURS", "72"))
+# Each process saves its own state, e.g. data/pregeneration.<pid>.json
+PREGEN_STATE_PATH = os.getenv("PREGEN_STATE_PATH", os.path.join("data", "pregeneration.json"))
+
+# (normalized topic, exercise type, number of questions)
+PoolKey = Tuple[str, str, int]
+
+
+def pool_key(topic: str, exercise_type: str, num_questions: int) -> PoolKey:
+    return normalize_text(topic).casefold(), (exercise_type or "mcq").strip().lower(), int(num_questions or 5)
+
+
+def parse_hours(spec: str) -> Tuple[int, int]:
+    start, end = spec.split("-", 1)
+    return int(start) % 24, int(end) % 24
+
+
+def in_hours(hour: int, hours: Tuple[int, int]) -> bool:
+    start, end = hours
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class PopularityTracker:
+    """Request counts per key with exponential decay, so yesterday's rush fades out"""
+
+    def __init__(self, half_life_hours: float = PREGEN_POPULARITY_HALF_LIFE_HOURS,
+                 max_keys: int = PREGEN_TRACKED_KEYS):
+        self.half_life = half_life_hours * 3600
+        self.max_keys = max_keys
+        # key -> [score, time of last update, topic as first requested]
+        self._scores: Dict[PoolKey, list] = {}
+
+    def _decayed(self, entry: list, now: float) -> float:
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life)
+
+    def record(self, key: PoolKey, topic: str, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        entry = self._scores.get(key)
+        if entry is None:
+            self._scores[key] = [1.0, now, topic.strip()]
+            if len(self._scores) > 2 * self.max_keys:
+                self._prune(now)
+        else:
+            entry[0] = self._decayed(entry, now) + 1.0
+            entry[1] = now
+
+    def _prune(self, now: float):
+        ranked = sorted(self._scores, key=lambda key: self._decayed(self._scores[key], now), reverse=True)
+        for key in ranked[self.max_keys:]:
+            del self._scores[key]
+
+    def hottest(self, n: int, min_score: float = 0.0) -> List[Tuple[PoolKey, str, float]]:
+        """(key, display topic, score) of the n most requested keys, best first"""
+        now = time.time()
+        scored = [(key, entry[2], self._decayed(entry, now)) for key, entry in self._scores.items()]
+        scored = [item for item in scored if item[2] >= min_score]
+        scored.sort(key=lambda item: item[2], reverse=True)
+        return scored[:n]
+
+    def __len__(self):
+        return len(self._scores)
+
+    def to_json(self) -> List:
+        return [[list(key), *entry] for key, entry in self._scores.items()]
+
+    def load_json(self, rows: List):
+        """Add saved counts; a key already tracked gets the decayed sum of both"""
+        now = time.time()
+        for key, score, updated, topic in rows:
+            entry = self._scores.get(tuple(key))
+            if entry is None:
+                self._scores[tuple(key)] = [score, updated, topic]
+            else:
+                entry[0] = self._decayed(entry, now) + self._decayed([score, updated], now)
+                entry[1] = now
+
+
+class ExercisePool:
+    """Ready, parsed exercise sets per key; each set is served once"""
+
+    def __init__(self, max_age_hours: float = PREGEN_MAX_AGE_HOURS):
+        self.max_age = max_age_hours * 3600
+        # key -> deque of (created at, exercises)
+        self._sets: Dict[PoolKey, deque] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def take(self, key: PoolKey):
+        """A pooled exercise set for key, or None"""
+        sets = self._sets.get(key)
+        cutoff = time.time() - self.max_age
+        while sets:
+            created_at, exercises = sets.popleft()
+            if created_at >= cutoff:
+                self.hits += 1
+                return exercises
+            self.expired += 1
+        self.misses += 1
+        return None
+
+    def put(self, key: PoolKey, exercises, created_at: Optional[float] = None):
+        self._sets.setdefault(key, deque()).append((time.time() if created_at is None else created_at, exercises))
+
+    def depth(self, key: PoolKey) -> int:
+        return len(self._sets.get(key) or ())
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "keys": sum(1 for sets in self._sets.values() if sets),
+            "sets": sum(len(sets) for sets in self._sets.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "expired": self.expired,
+        }
+
+    def to_json(self) -> List:
+        return [[list(key), created_at, exercises]
+                for key, sets in self._sets.items() for created_at, exercises in sets]
+
+    def load_json(self, rows: List):
+        for key, created_at, exercises in rows:
+            self.put(tuple(key), exercises, created_at)
+
+
+# Generates one parsed exercise set for (topic, exercise type, number of questions)
+Generator = Callable[[str, str, int], Awaitable]
+
+
+class PregenerationScheduler:
+    """Keeps the most requested context-free exercise sets ready in a pool
+
+    Popularity comes from the requests recorded by the generate-simple
+    endpoint. Every interval, during off-peak hours the hottest keys are
+    filled up to the pool depth; at other times only keys whose pool ran
+    empty get one new set. Popularity and pooled sets are saved to a JSON
+    file so a restart starts warm.
+
+    Each worker keeps its own pool and counts, saved to its own file (see
+    utils/process_files.py), so a pooled set is served at most once. On
+    start a worker takes over the files of workers that have stopped.
+    """
+
+    def __init__(self, generator: Optional[Generator] = None, path: str = PREGEN_STATE_PATH,
+                 ident: Optional[int] = None):
+        self.generator = generator
+        self._owner = ProcessFile(path, ident)
+        self.tracker = PopularityTracker()
+        self.pool = ExercisePool()
+        self.off_peak_hours = parse_hours(PREGEN_OFF_PEAK_HOURS)
+        self.generated = 0
+        self.failed = 0
+        self.runs = 0
+        self.last_run = None
+        self._task = None
+
+    @property
+    def path(self) -> str:
+        """This process's state file"""
+        return self._owner.path
+
+    def record(self, topic: str, exercise_type: str, num_questions: int) -> PoolKey:
+        key = pool_key(topic, exercise_type, num_questions)
+        self.tracker.record(key, topic)
+        return key
+
+    def take(self, topic: str, exercise_type: str, num_questions: int):
+        """Record the request and return a pooled set for it, or None"""
+        key = self.record(topic, exercise_type, num_questions)
+        return self.pool.take(key) if PREGEN_ENABLED else None
+
+    def is_off_peak(self, now: Optional[datetime] = None) -> bool:
+        return in_hours((now or datetime.now()).hour, self.off_peak_hours)
+
+    def plan(self, off_peak: bool) -> List[Tuple[PoolKey, str, int]]:
+        """(key, topic, sets to generate) for this round"""
+        todo = []
+        for key, topic, _ in self.tracker.hottest(PREGEN_HOT_KEYS, PREGEN_MIN_POPULARITY):
+            depth = self.pool.depth(key)
+            if off_peak:
+                missing = PREGEN_POOL_DEPTH - depth
+            else:
+                missing = 1 if PREGEN_REFILL_DURING_PEAK and depth == 0 else 0
+            if missing > 0:
+                todo.append((key, topic, missing))
+        return todo
+
+    async def run_once(self, off_peak: Optional[bool] = None) -> int:
+        """Generate this round's sets; returns how many were added to the pool"""
+        if self.generator is None:
+            return 0
+        off_peak = self.is_off_peak() if off_peak is None else off_peak
+        jobs = [(key, topic) for key, topic, missing in self.plan(off_peak) for _ in range(missing)]
+        semaphore = asyncio.Semaphore(PREGEN_CONCURRENCY)
+
+        async def fill(key, topic):
+            async with semaphore:
+                try:
+                    exercises = await self.generator(topic, key[1], key[2])
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning(f"Pre-generation failed for {key}: {e}")
+                    return 0
+            if not exercises:
+                self.failed += 1
+                return 0
+            self.pool.put(key, exercises)
+            self.generated += 1
+            return 1
+
+        added = sum(await asyncio.gather(*(fill(key, topic) for key, topic in jobs)))
+        self.runs += 1
+        self.last_run = time.time()
+        if jobs:
+            logger.info(f"Pre-generated {added}/{len(jobs)} exercise sets (off-peak: {off_peak})")
+            await self.save()
+        return added
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(PREGEN_INTERVAL_SECONDS)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Pre-generation round failed: {e}")
+
+    def start(self, generator: Optional[Generator] = None):
+        if generator is not None:
+            self.generator = generator
+        if not self._owner.claimed:
+            self._owner.claim(self._adopt)
+        if PREGEN_ENABLED and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._owner.claimed:
+            await self.save()
+            # The file is kept, so the pool survives a restart
+            self._owner.release()
+
+    def _adopt(self, paths: List[str]):
+        """Load this process's saved state and merge in what stopped processes left"""
+        for path in [self.path, *paths]:
+            self.load(path)
+        if paths:
+            self._write(self._state())
+
+    def load(self, path: Optional[str] = None):
+        path = path or self.path
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.tracker.load_json(state.get("popularity", []))
+            self.pool.load_json(state.get("pool", []))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load pre-generation state from {path}: {e}")
+
+    def _state(self) -> Dict:
+        return {"popularity": self.tracker.to_json(), "pool": self.pool.to_json()}
+
+    async def save(self):
+        await run_in_threadpool(self._write, self._state())
+
+    def _write(self, state: Dict):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": PREGEN_ENABLED,
+            "off_peak_now": self.is_off_peak(),
+            "tracked_keys": len(self.tracker),
+            "hot_keys": len(self.tracker.hottest(PREGEN_HOT_KEYS, PREGEN_MIN_POPULARITY)),
+            "pool": self.pool.stats(),
+            "generated": self.generated,
+            "failed": self.failed,
+            "runs": self.runs,
+            "last_run": self.last_run,
+        }
+
+
+pregeneration = PregenerationScheduler()
@@ -0,0 +1,107 @@
+import glob
+import logging
+import os
+import re
+from typing import Callable, List, Optional
+from filelock import FileLock, Timeout
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessFile:
+    """A state file owned by one server process, next to a configured path
+
+    With several workers, data/state.json becomes data/state.<pid>.json for
+    each of them, locked for as long as the process runs. When a process
+    claims its file it adopts the files of processes that are gone (their
+    lock is free), and the unnumbered file written by older versions, so
+    nothing they left behind is lost or read by two workers.
+    """
+
+    def __init__(self, path: str, ident: Optional[int] = None):
+        self.base_path = path
+        stem, ext = os.path.splitext(path)
+        self._stem, self._ext = stem, ext
+        self._ident = ident
+        # Held from claim to release; created on claim, since the pid of a forked worker differs from the parent's
+        self._lock = None
+        # Serializes claiming and releasing, so a lock file is never removed while someone opens it
+        self._registry = FileLock(f"{path}.lock", thread_local=False)
+
+    @property
+    def path(self) -> str:
+        """This process's file"""
+        return f"{self._stem}.{self._ident if self._ident is not None else os.getpid()}{self._ext}"
+
+    @property
+    def claimed(self) -> bool:
+        return self._lock is not None and self._lock.is_locked
+
+    def _numbered(self) -> List[str]:
+        """Files of every process, including ones that left only a lock file"""
+        pattern = re.compile(re.escape(self._stem) + r"\.\d+" + re.escape(self._ext))
+        paths = {path[:-len(".lock")] if path.endswith(".lock") else path
+                 for path in glob.glob(f"{glob.escape(self._stem)}.*{glob.escape(self._ext)}*")}
+        return sorted(path for path in paths if pattern.fullmatch(path))
+
+    def claim(self, adopt: Callable[[List[str]], None]):
+        """Lock this process's file, then call adopt with the orphaned files (maybe none)
+
+        adopt must have saved their contents into this process's file when it
+        returns; they are deleted afterwards. Raises RuntimeError if another
+        live process already owns the file.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._registry:
+            # Not thread-local: the owner may be released from another thread
+            self._lock = FileLock(f"{self.path}.lock", thread_local=False)
+            try:
+                self._lock.acquire(timeout=0)
+            except Timeout:
+                raise RuntimeError(f"{self.path} is in use by another process")
+            orphans, locks = [], []
+            try:
+                for path in self._numbered():
+                    if path == self.path:
+                        continue
+                    lock = FileLock(f"{path}.lock", thread_local=False)
+                    try:
+                        lock.acquire(timeout=0)
+                    except Timeout:
+                        continue  # its process is still running
+                    locks.append((path, lock))
+                    if os.path.isfile(path):
+                        orphans.append(path)
+                if os.path.isfile(self.base_path):
+                    orphans.append(self.base_path)
+                if orphans:
+                    logger.info(f"Adopting {len(orphans)} file(s) left by stopped processes: {orphans}")
+                adopt(orphans)
+                for path in orphans:
+                    os.remove(path)
+            except BaseException:
+                self._lock.release()
+                raise
+            finally:
+                for path, lock in locks:
+                    lock.release()
+                    self._remove(f"{path}.lock")
+
+    def release(self, remove: bool = False):
+        """Unlock this process's file, deleting it first if remove is set"""
+        if not self.claimed:
+            return
+        with self._registry:
+            if remove:
+                self._remove(self.path)
+            self._lock.release()
+            self._remove(f"{self.path}.lock")
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
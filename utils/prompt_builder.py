@@ -0,0 +1,130 @@
+import hashlib
+import os
+import threading
+from typing import Callable, Dict, List, Tuple
+from utils.context_builder import estimate_tokens, truncate_to_tokens
+from utils.lru_cache import LRUCache
+
+# Whole mentor prompt: system instruction, history and the new message
+MENTOR_PROMPT_TOKENS = int(os.getenv("MENTOR_PROMPT_TOKENS", "6000"))
+# A single past message is cut to this many tokens in the prompt
+MENTOR_MESSAGE_MAX_TOKENS = int(os.getenv("MENTOR_MESSAGE_MAX_TOKENS", "800"))
+# Never look further back than this, whatever the budget
+MENTOR_HISTORY_MAX_EXCHANGES = int(os.getenv("MENTOR_HISTORY_MAX_EXCHANGES", "50"))
+# The system instruction is cut to this, and to at most half the budget
+MENTOR_SYSTEM_MAX_TOKENS = int(os.getenv("MENTOR_SYSTEM_MAX_TOKENS", "2000"))
+# Past messages whose token counts are remembered
+MENTOR_TOKEN_CACHE_SIZE = int(os.getenv("MENTOR_TOKEN_CACHE_SIZE", "100000"))
+
+TRUNCATION_MARK = " [...]"
+# Text the prompt adds around the history and the new message, and around each exchange
+PROMPT_FRAMING = "\n\nPrevious conversation:\n\n\nUser: "
+EXCHANGE_FRAMING = "User: \nAssistant: \n"
+
+
+class MentorPromptBuilder:
+    """Builds mentor chat prompts that fit a token budget
+
+    The system instruction is counted first and cut to system_max_tokens
+    (at most half the budget), then the new message is cut to what is left,
+    so the prompt never exceeds the budget. History fills the rest, newest
+    exchange first, so older exchanges are not even counted once it is
+    full. Past messages longer than message_max_tokens are cut. Token counts
+    of past messages are cached by exchange id and a hash of the text, so a
+    tokenizer-backed counter runs once per message rather than once per turn.
+    """
+
+    def __init__(self, budget: int = MENTOR_PROMPT_TOKENS, message_max_tokens: int = MENTOR_MESSAGE_MAX_TOKENS,
+                 max_exchanges: int = MENTOR_HISTORY_MAX_EXCHANGES, counter: Callable[[str], int] = estimate_tokens,
+                 system_max_tokens: int = MENTOR_SYSTEM_MAX_TOKENS, cache_size: int = MENTOR_TOKEN_CACHE_SIZE):
+        self.budget = budget
+        self.message_max_tokens = message_max_tokens
+        self.max_exchanges = max_exchanges
+        self.counter = counter
+        self.system_max_tokens = min(system_max_tokens, budget // 2)
+        self.token_counts = LRUCache(cache_size)
+        self.prompts = 0
+        self.prompt_tokens = 0
+        self.truncated_messages = 0
+        self.dropped_exchanges = 0
+        self._lock = threading.Lock()
+
+    def exchange_tokens(self, exchange: Dict) -> Tuple[int, int]:
+        """(user message tokens, mentor response tokens) of a stored exchange"""
+        user_message = exchange.get("user_message", "") or ""
+        mentor_response = exchange.get("mentor_response", "") or ""
+        # The hash keeps a reused or missing id from returning another text's counts
+        digest = hashlib.blake2b(f"{user_message}\0{mentor_response}".encode("utf-8"), digest_size=16).digest()
+        key = (exchange.get("id"), digest)
+        counts = self.token_counts.get(key)
+        if counts is None:
+            counts = (self.counter(user_message), self.counter(mentor_response))
+            self.token_counts.put(key, counts)
+        return counts
+
+    def _fit(self, text: str, tokens: int, limit: int) -> Tuple[str, int, bool]:
+        """(text, tokens, cut) with text cut to at most limit tokens, mark included"""
+        if tokens <= limit:
+            return text, tokens, False
+        room = limit - self.counter(TRUNCATION_MARK)
+        if room <= 0:
+            return "", 0, True
+        text = truncate_to_tokens(text, room) + TRUNCATION_MARK
+        return text, self.counter(text), True
+
+    def build(self, system_instruction: str, history: List[Dict], message: str) -> Tuple[str, Dict]:
+        """(prompt, report) for a new message given the chat's exchanges, oldest first"""
+        system_instruction, system_tokens, system_cut = self._fit(
+            system_instruction, self.counter(system_instruction), self.system_max_tokens)
+        fixed_tokens = system_tokens + self.counter(PROMPT_FRAMING)
+        message, message_tokens, message_cut = self._fit(message, self.counter(message),
+                                                         max(self.budget - fixed_tokens, 0))
+        remaining = self.budget - fixed_tokens - message_tokens
+        exchange_framing = self.counter(EXCHANGE_FRAMING)
+        selected: List[str] = []
+        truncated = 0
+        recent = history[-self.max_exchanges:] if self.max_exchanges else []
+        for exchange in reversed(recent):
+            user_tokens, mentor_tokens = self.exchange_tokens(exchange)
+            user_text, user_tokens, user_cut = self._fit(exchange.get("user_message", "") or "", user_tokens,
+                                                         self.message_max_tokens)
+            mentor_text, mentor_tokens, mentor_cut = self._fit(exchange.get("mentor_response", "") or "",
+                                                               mentor_tokens, self.message_max_tokens)
+            cost = user_tokens + mentor_tokens + exchange_framing
+            if cost > remaining:
+                break
+            remaining -= cost
+            truncated += user_cut + mentor_cut
+            selected.append(f"User: {user_text}\nAssistant: {mentor_text}")
+
+        context_text = "\n".join(reversed(selected))
+        prompt = f"{system_instruction}\n\nPrevious conversation:\n{context_text}\n\nUser: {message}"
+        report = {
+            "exchanges_total": len(history),
+            "exchanges_included": len(selected),
+            "truncated_messages": truncated,
+            "system_truncated": system_cut,
+            "message_truncated": message_cut,
+            "prompt_tokens": self.budget - remaining,
+            "budget": self.budget,
+        }
+        with self._lock:
+            self.prompts += 1
+            self.prompt_tokens += report["prompt_tokens"]
+            self.truncated_messages += truncated
+            self.dropped_exchanges += len(history) - len(selected)
+        return prompt, report
+
+    def stats(self) -> Dict:
+        return {
+            "budget": self.budget,
+            "message_max_tokens": self.message_max_tokens,
+            "prompts": self.prompts,
+            "avg_prompt_tokens": round(self.prompt_tokens / self.prompts, 1) if self.prompts else None,
+            "truncated_messages": self.truncated_messages,
+            "dropped_exchanges": self.dropped_exchanges,
+            "token_count_cache": self.token_counts.stats(),
+        }
+
+
+mentor_prompt_builder = MentorPromptBuilder()
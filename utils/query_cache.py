@@ -0,0 +1,68 @@
+import numpy as np
+import os
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+from utils.embedding_cache import normalize_text
+from utils.lru_cache import LRUCache
+from utils import vector_index
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "10000"))
+QUERY_RESULT_CACHE_SIZE = int(os.getenv("QUERY_RESULT_CACHE_SIZE", "50000"))
+
+
+class QueryCache:
+    """Two-level cache in front of retrieval
+
+    Level 1 maps (model, normalized query) to its unit-length embedding, so a
+    repeated query never reaches torch. Level 2 maps (index version, query, k,
+    search params) to chunk ids. The index version changes whenever a
+    document's index is rebuilt, so stale results are never served; they just
+    age out of the LRU.
+    """
+
+    def __init__(self, embedding_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+                 result_size: int = QUERY_RESULT_CACHE_SIZE):
+        self.embeddings = LRUCache(embedding_size)
+        self.results = LRUCache(result_size)
+
+    def embed(self, model, query: str) -> np.ndarray:
+        return self.embed_many(model, [query])
+
+    def embed_many(self, model, queries: List[str]) -> np.ndarray:
+        """(len(queries), dim) matrix of query embeddings; misses are encoded in one batch"""
+        keys = [(model.name, normalize_text(query)) for query in queries]
+        vectors = [self.embeddings.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = vector_index.normalize(model.encode([queries[i] for i in missing]))
+            for row, i in enumerate(missing):
+                vector = encoded[row:row + 1].copy()
+                vector.setflags(write=False)
+                self.embeddings.put(keys[i], vector)
+                vectors[i] = vector
+        return np.vstack(vectors)
+
+    def search(self, index_version: Optional[Hashable], query: str, k: int, params: Tuple,
+               compute: Callable[[], Tuple[int, ...]]) -> Tuple[int, ...]:
+        """Chunk ids for a query, from cache when this index version has seen it"""
+        return self.search_many(index_version, [query], k, params, lambda queries: [compute()])[0]
+
+    def search_many(self, index_version: Optional[Hashable], queries: List[str], k: int, params: Tuple,
+                    compute_many: Callable[[List[str]], List[Tuple[int, ...]]]) -> List[Tuple[int, ...]]:
+        """Chunk ids per query; compute_many is called once with only the uncached queries"""
+        if index_version is None:
+            return compute_many(queries)
+        keys = [(index_version, normalize_text(query), k, params) for query in queries]
+        results = [self.results.get(key) for key in keys]
+        missing = [i for i, ids in enumerate(results) if ids is None]
+        if missing:
+            computed = compute_many([queries[i] for i in missing])
+            for i, ids in zip(missing, computed):
+                self.results.put(keys[i], ids)
+                results[i] = ids
+        return results
+
+    def stats(self) -> Dict:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
+
+
+query_cache = QueryCache()
@@ -1,79 +1,322 @@
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
 import fitz
 import os
+import shutil
+import tempfile
+from itertools import islice
+from utils.embedding import get_embedding_model
+from utils.document_store import document_store, hash_file, ChunkTableWriter
+from utils import vector_index
+from utils.embedding_cache import embedding_cache, EMBEDDING_CACHE_ENABLED
+from utils.query_cache import query_cache
+from utils.chunking import get_chunker
+from utils.lexical_index import BM25Builder, LEXICAL_FORMAT, reciprocal_rank_fusion, tokenize as lexical_tokenize
+from utils.library import Library, InMemoryBook
+from utils.pdf_pages import chapters as pdf_chapters
+from utils.context_builder import compact, CONTEXT_CANDIDATE_FACTOR
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# hybrid (BM25 + vectors, fused by reciprocal rank), vector or lexical
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+RRF_K = int(os.getenv("RRF_K", "60"))
+RRF_CANDIDATES = int(os.getenv("RRF_CANDIDATES", "50"))
+# Queries of at most this many keywords, all present in the books searched, skip the embedding model
+LEXICAL_FAST_PATH_MAX_TERMS = int(os.getenv("LEXICAL_FAST_PATH_MAX_TERMS", "3"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
 
 class RAGProcessor:
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.chunks = []
-        self.faiss_index = None
-    
+    def __init__(self, model=None, store=None):
+        # The embedding model is shared process-wide; only per-document state lives here
+        self.model = model or get_embedding_model()
+        self.store = store or document_store
+        self.embedding_cache = embedding_cache if EMBEDDING_CACHE_ENABLED else None
+        self.chunker = get_chunker(self.model)
+        # The books retrieval searches; chunk ids are library-wide
+        self.library = Library([])
+        self.document_id = None
+        self.deduplicated = False
+        # Outline of the last PDF read by iter_pages
+        self.chapters = []
+
+    @property
+    def chunks(self):
+        return self.library
+
+    @property
+    def index_version(self):
+        """Identifies the current index contents for the retrieval cache; None disables caching"""
+        return self.library.version
+
+    def iter_pages(self, pdf_file):
+        """Yield (page_number, text) for each page, one page in memory at a time"""
+        path = getattr(pdf_file, "name", None)
+        spooled = not (isinstance(path, str) and os.path.isfile(path))
+        if spooled:
+            # Let MuPDF read from disk instead of parsing one big in-memory bytes object
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+                shutil.copyfileobj(pdf_file, tmp, 1024 * 1024)
+                path = tmp.name
+        try:
+            with fitz.open(path) as doc:
+                self.chapters = pdf_chapters(doc)
+                for page_number, page in enumerate(doc, start=1):
+                    yield page_number, page.get_text()
+        finally:
+            if spooled:
+                os.remove(path)
+
     def extract_text_from_pdf(self, pdf_file):
         """Extract text from PDF file"""
-        doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        return text
-    
-    def chunk_text(self, text, chunk_size=300, overlap=50):
-        """Split text into chunks with overlap"""
-        words = text.split()
-        chunks = []
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = " ".join(words[i:i + chunk_size])
-            chunks.append(chunk)
-        return chunks
-    
+        return "".join(text for _, text in self.iter_pages(pdf_file))
+
+    def iter_chunks(self, pages):
+        """Stream (chunk_text, first_page, last_page) from (page_number, text) pairs"""
+        return self.chunker.iter_chunks(pages)
+
+    @staticmethod
+    def iter_batches(items, batch_size):
+        """Group an iterable into lists of at most batch_size items"""
+        items = iter(items)
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                return
+            yield batch
+
     def embed_chunks(self, chunks):
-        """Generate embeddings for chunks"""
-        return self.model.encode(chunks, show_progress_bar=True)
-    
+        """Generate unit-length embeddings for chunks, encoding only chunks not seen before"""
+        if self.embedding_cache is not None:
+            return vector_index.normalize(self.embedding_cache.encode(self.model, chunks))
+        return vector_index.normalize(self.model.encode(chunks))
+
+    def new_faiss_index(self, dimension):
+        """Create an empty FAISS index that vectors are added to incrementally"""
+        return vector_index.new_flat_index(dimension)
+
     def create_faiss_index(self, vectors):
-        """Create FAISS index for vector search"""
-        dimension = vectors.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        index.add(vectors)
-        return index
-    
-    def retrieve_top_chunks(self, query, k=5):
-        """Retrieve top k relevant chunks for a query"""
-        if not self.faiss_index or not self.chunks:
-            return []
-        
-        query_vec = self.model.encode([query])
-        D, I = self.faiss_index.search(query_vec, k)
-        return [self.chunks[i] for i in I[0]]
-    
-    def process_document(self, pdf_file):
-        """Process PDF document and create searchable index"""
-        try:
-            # Extract text
-            text = self.extract_text_from_pdf(pdf_file)
-            
-            if not text.strip():
-                raise ValueError("No text content found in PDF")
-            
-            # Create chunks
-            self.chunks = self.chunk_text(text)
-            
-            if not self.chunks:
-                raise ValueError("No chunks created from text")
-            
-            # Generate embeddings
-            vectors = self.embed_chunks(self.chunks)
-            vectors = np.array(vectors)
-            
+        """Create FAISS index for vector search, choosing its type by corpus size"""
+        return vector_index.build_index(vector_index.normalize(vectors))
+
+    def ingest_pages(self, pages, add_chunk, batch_size=EMBED_BATCH_SIZE, progress=None):
+        """pages -> chunks -> fixed-size embedding batches -> incremental index adds
+
+        add_chunk(text, first_page, last_page) receives every chunk in index order,
+        and progress(chunks_embedded) is called after each batch.
+        Returns (index, number_of_chunks).
+        """
+        index = None
+        num_chunks = 0
+        for batch in self.iter_batches(self.iter_chunks(pages), batch_size):
+            vectors = self.embed_chunks([text for text, _, _ in batch])
             if vectors.ndim != 2:
                 raise ValueError(f"Invalid embedding shape: {vectors.shape}")
-            
-            # Create FAISS index
-            self.faiss_index = self.create_faiss_index(vectors)
-            
-            return True
-            
+            if index is None:
+                index = self.new_faiss_index(vectors.shape[1])
+            index.add(vectors)
+            for text, first_page, last_page in batch:
+                add_chunk(text, first_page, last_page)
+            num_chunks += len(batch)
+            if progress:
+                progress(num_chunks)
+        if index is not None:
+            # Large books switch from the exact flat index to ANN once the size is known
+            index = vector_index.finalize_index(index)
+        return index, num_chunks
+
+    def retrieve_top_chunks(self, query, k=5, nprobe=None, ef_search=None, mode=None,
+                            book_ids=None, page_ranges=None):
+        """Retrieve top k relevant chunks for a query
+
+        nprobe (IVF) and ef_search (HNSW) trade recall for latency; they are
+        ignored by exact flat indexes. book_ids and page_ranges ([(first, last)])
+        limit the search to part of the library. A short keyword query found
+        verbatim in the books may return fewer than k chunks: it is answered by
+        BM25 alone.
+        """
+        return self.retrieve_top_chunks_batch([query], k, nprobe, ef_search, mode, book_ids, page_ranges)[0]
+
+    def retrieve_top_chunks_batch(self, queries, k=5, nprobe=None, ef_search=None, mode=None,
+                                  book_ids=None, page_ranges=None):
+        """Top k chunks for each query, with one encode call and one matrix search per book for the uncached ones
+
+        mode is hybrid, vector or lexical (RETRIEVAL_MODE by default); hybrid and
+        lexical need BM25 indexes and fall back to vector without them.
+        """
+        ids = self.search_chunk_ids(queries, k, nprobe, ef_search, mode, book_ids, page_ranges)
+        return [[self.library[i] for i in row] for row in ids]
+
+    def retrieve_top_chunk_records(self, query, k=5, **filters):
+        """Like retrieve_top_chunks, with each chunk's book id, filename, pages and chapter"""
+        ids = self.search_chunk_ids([query], k, **filters)[0]
+        return [{"text": self.library[i], **self.library.metadata(i)} for i in ids]
+
+    def retrieve_context(self, query, k=5, token_budget=CONTEXT_TOKEN_BUDGET, **filters):
+        """Compacted prompt context for a query: (passages, report)
+
+        See retrieve_context_batch.
+        """
+        return self.retrieve_context_batch([query], k, token_budget, **filters)[0]
+
+    def retrieve_context_batch(self, queries, k=5, token_budget=CONTEXT_TOKEN_BUDGET, **filters):
+        """(passages, report) per query, ready to join into a prompt
+
+        Retrieves extra candidates, picks k of them by maximal marginal relevance
+        over their stored vectors, merges neighbouring chunks so their overlap
+        appears once, and trims the result to token_budget. The report says how
+        many prompt tokens that saved over joining the plain top k.
+        """
+        depth = max(k, int(k * CONTEXT_CANDIDATE_FACTOR))
+        results = []
+        for ids in self.search_chunk_ids(queries, depth, **filters):
+            ids = list(ids)
+            texts = [self.library[i] for i in ids]
+            vectors = self.library.vectors(ids)
+            passages, report = compact(texts, vectors, [self.library.locate(i) for i in ids], k, token_budget)
+            results.append((passages, report))
+        return results
+
+    def search_chunk_ids(self, queries, k=5, nprobe=None, ef_search=None, mode=None,
+                         book_ids=None, page_ranges=None):
+        """Library chunk ids of the top k chunks for each query"""
+        library = self.library
+        scope = library.scope(book_ids, page_ranges)
+        if not scope:
+            return [() for _ in queries]
+        mode = mode or RETRIEVAL_MODE
+        if not library.has_lexical(scope):
+            mode = "vector"
+
+        def search(pending):
+            results = {}
+            if mode != "vector":
+                for query in pending:
+                    if mode == "lexical" or self.is_keyword_query(query, scope):
+                        results[query] = tuple(library.lexical_search(query, k, scope))
+            dense = [query for query in dict.fromkeys(pending) if query not in results]
+            if dense:
+                depth = k if mode == "vector" else max(k, RRF_CANDIDATES)
+                query_vecs = query_cache.embed_many(self.model, dense)
+                rows = library.search(query_vecs, depth, scope, nprobe=nprobe, ef_search=ef_search)
+                for query, ids in zip(dense, rows):
+                    if mode != "vector":
+                        ids = reciprocal_rank_fusion([ids, library.lexical_search(query, depth, scope)], k, RRF_K)
+                    results[query] = tuple(ids[:k])
+            return [results[query] for query in pending]
+
+        filters = (tuple(sorted(book_ids)) if book_ids else None,
+                   tuple(map(tuple, page_ranges)) if page_ranges else None)
+        return query_cache.search_many(self.index_version, queries, k, (nprobe, ef_search, mode, filters), search)
+
+    def is_keyword_query(self, query, scope):
+        """Short queries whose every term occurs in the books searched are answered from BM25 alone"""
+        terms = lexical_tokenize(query)
+        return 0 < len(terms) <= LEXICAL_FAST_PATH_MAX_TERMS and self.library.covers_terms(query, terms, scope)
+
+    def load_library(self, user_id):
+        """Attach every book the user holds"""
+        self.library = Library(self.store.load_library(user_id))
+        return len(self.library.books) > 0
+
+    def load_document(self, user_id, document_id=None):
+        """Attach a single stored document (the user's latest by default)"""
+        document = self.store.load(user_id, document_id)
+        if document is None:
+            return False
+        self.library = Library([document])
+        self.document_id = document.document_id
+        return True
+
+    def process_document(self, pdf_file, user_id=None, metadata=None):
+        """Process PDF document and create searchable index"""
+        try:
+            if not user_id:
+                return self._build_index(pdf_file)
+
+            # Identical PDFs share one index: a known hash only needs a new reference
+            content_hash = hash_file(pdf_file)
+            return self.ingest_document(user_id, content_hash, lambda: self.iter_pages(pdf_file), metadata)
+
         except Exception as e:
             print(f"Error processing document: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    def ingest_document(self, user_id, content_hash, pages_factory, metadata=None, progress=None):
+        """Index a document into the store, or attach the existing index for its content
+
+        pages_factory() returns the (page_number, text) iterator and is only called
+        if the content actually has to be indexed. Raises on failure.
+        """
+        if self.attach_existing(user_id, content_hash, metadata):
+            return True
+
+        with self.store.ingest_lock(content_hash):
+            # Another request may have finished indexing the same PDF while we waited
+            if self.attach_existing(user_id, content_hash, metadata):
+                return True
+
+            # Chunks stream straight into the stored chunk table instead of a list,
+            # and into the BM25 postings built alongside the vector index
+            staging_dir = self.store.stage()
+            try:
+                writer = ChunkTableWriter(staging_dir)
+                lexical = BM25Builder()
+
+                def add_chunk(text, first_page, last_page):
+                    writer.append(text, first_page, last_page)
+                    lexical.add(text)
+
+                index, num_chunks = self.ingest_pages(pages_factory(), add_chunk, progress=progress)
+                writer.close()
+                if not num_chunks:
+                    raise ValueError("No text content found in PDF")
+                lexical_meta = lexical.save(staging_dir)
+            except Exception:
+                self.store.discard(staging_dir)
+                raise
+
+            # Persist so later requests (and other workers) can retrieve without re-embedding
+            object_meta = dict(metadata or {})
+            object_meta.setdefault("chapters", self.chapters)
+            object_meta["embedding_model"] = self.model.name
+            object_meta["index_format"] = vector_index.INDEX_FORMAT
+            object_meta["chunker"] = self.chunker.name
+            object_meta["index"] = vector_index.describe(index)
+            object_meta["lexical_index"] = lexical_meta
+            self.document_id = self.store.save_staged(
+                user_id, content_hash, staging_dir, index, num_chunks, metadata=object_meta
+            )
+            self.load_document(user_id, self.document_id)
+
+        return True
+
+    def is_indexed(self, content_hash):
+        """Whether a stored index built with the current model exists for this content"""
+        meta = self.store.object_meta(content_hash)
+        return (bool(meta) and meta.get("embedding_model") == self.model.name
+                and meta.get("index_format") == vector_index.INDEX_FORMAT
+                and meta.get("chunker", "words") == self.chunker.name
+                and (meta.get("lexical_index") or {}).get("format") == LEXICAL_FORMAT)
+
+    def attach_existing(self, user_id, content_hash, metadata):
+        """Reuse a stored index for this content if it was built with the current model"""
+        if not self.is_indexed(content_hash):
+            return False
+        if not self.store.attach(user_id, content_hash, metadata):
+            return False
+        self.deduplicated = self.load_document(user_id, content_hash)
+        return self.deduplicated
+
+    def _build_index(self, pdf_file):
+        """Run the ingestion pipeline into in-memory chunks (no persistence)"""
+        chunks, pages = [], []
+        lexical = BM25Builder()
+
+        def add_chunk(text, first_page, last_page):
+            chunks.append(text)
+            pages.append((first_page, last_page))
+            lexical.add(text)
+
+        index, num_chunks = self.ingest_pages(self.iter_pages(pdf_file), add_chunk)
+        if not num_chunks:
+            raise ValueError("No text content found in PDF")
+        self.library = Library([InMemoryBook(index, chunks, pages, lexical.build(), {"chapters": self.chapters})])
+        return True
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import logging
+from typing import Dict, Optional
+from utils.embedding_cache import normalize_text
+from utils.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# "memory" (per process), "sqlite" (on disk, shared by the workers of a node) or "off"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", os.path.join("data", "response_cache.sqlite3"))
+
+
+def response_key(model: str, prompt: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{normalize_text(prompt)}".encode("utf-8")).digest()
+
+
+class MemoryResponseStore:
+    """LRU of answers in this process; expired entries are dropped on lookup"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, ttl: float):
+        self._cache = LRUCache(max_entries, ttl)
+
+    def get(self, key: bytes) -> Optional[str]:
+        return self._cache.get(key)
+
+    def put(self, key: bytes, text: str):
+        self._cache.put(key, text)
+
+    def stats(self) -> Dict:
+        stats = self._cache.stats()
+        return {"entries": stats["entries"], "evictions": stats["evictions"]}
+
+
+class SQLiteResponseStore:
+    """Answers in a SQLite file (WAL mode), so every worker on the node shares them
+
+    Rows carry an expiry time and a last-used time. Expired rows are never
+    returned; past max_entries, expired rows and then the least recently used
+    are deleted down to 90% of the limit.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, max_entries: int, ttl: float, path: str = RESPONSE_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.evictions = 0
+        self._count = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key BLOB PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)")
+            conn.commit()
+            self._count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: bytes) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT text FROM responses WHERE key = ? AND expires_at > ?",
+                               (key, now)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+        return row[0]
+
+    def put(self, key: bytes, text: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO responses (key, text, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                         (key, text, now + self.ttl, now))
+            self._count += 1
+            if self._count > self.max_entries:
+                conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                self._count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                excess = self._count - int(self.max_entries * 0.9)
+                if excess > 0:
+                    conn.execute(
+                        "DELETE FROM responses WHERE key IN "
+                        "(SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,)
+                    )
+                    self._count -= excess
+                    self.evictions += excess
+            conn.commit()
+
+    def stats(self) -> Dict:
+        return {"entries": self._count, "evictions": self.evictions}
+
+
+STORES = {"memory": MemoryResponseStore, "sqlite": SQLiteResponseStore}
+
+
+class ResponseCache:
+    """(model, normalized prompt) -> generated text, for prompts without book context
+
+    Only context-free prompts are cached: their answer depends on nothing but
+    the prompt (which includes the system instruction) and the model.
+    """
+
+    def __init__(self, backend: str = RESPONSE_CACHE_BACKEND, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._store = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != "off"
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = STORES[self.backend](self.max_entries, self.ttl)
+        return self._store
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        text = self.store.get(response_key(model, prompt))
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    def put(self, model: str, prompt: str, text: str):
+        if self.enabled and text:
+            self.store.put(response_key(model, prompt), text)
+
+    def record_bypass(self):
+        """Count a request that asked for a fresh answer"""
+        self.bypassed += 1
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "backend": self.backend,
+            "ttl_seconds": self.ttl,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "fresh_requests": self.bypassed,
+        }
+        if self.enabled and self._store is not None:
+            stats.update(self._store.stats())
+        return stats
+
+
+response_cache = ResponseCache()
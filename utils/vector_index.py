@@ -0,0 +1,178 @@
+import faiss
+import numpy as np
+import math
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever stored indexes become incompatible with the current retrieval code
+INDEX_FORMAT = 2
+
+ANN_INDEX_TYPE = os.getenv("ANN_INDEX_TYPE", "auto")  # auto, flat, hnsw, ivf, ivfpq
+ANN_FLAT_MAX_VECTORS = int(os.getenv("ANN_FLAT_MAX_VECTORS", "20000"))
+ANN_USE_PQ = os.getenv("ANN_USE_PQ", "false").lower() == "true"
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv("ANN_HNSW_EF_CONSTRUCTION", "80"))
+ANN_EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", "64"))
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+ANN_PQ_SUBVECTOR_DIMS = int(os.getenv("ANN_PQ_SUBVECTOR_DIMS", "8"))
+# How flat, HNSW and IVF indexes store vectors: float32, float16 or int8 (scalar quantized)
+ANN_VECTOR_ENCODING = os.getenv("ANN_VECTOR_ENCODING", "float32")
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+SQ_TYPES = {
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+ENCODINGS = ("float32",) + tuple(SQ_TYPES)
+
+
+def normalize(vectors) -> np.ndarray:
+    """Unit-length float32 copy, so inner product equals cosine similarity"""
+    vectors = np.array(vectors, dtype="float32", order="C", copy=True)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def choose_index_type(num_vectors: int, requested: str = ANN_INDEX_TYPE) -> str:
+    """Exact search for small corpora, graph or inverted-file ANN for large ones"""
+    if requested in INDEX_TYPES:
+        return requested
+    if num_vectors <= ANN_FLAT_MAX_VECTORS:
+        return "flat"
+    return "ivfpq" if ANN_USE_PQ else "hnsw"
+
+
+def new_flat_index(dimension: int):
+    return faiss.IndexFlatIP(dimension)
+
+
+def build_index(vectors: np.ndarray, index_type: str = None, encoding: str = None):
+    """Build an inner-product index over already-normalized vectors
+
+    encoding float16 halves and int8 quarters the bytes per stored vector
+    (faiss scalar quantizers); IVFPQ is already compressed and ignores it.
+    """
+    num_vectors, dimension = vectors.shape
+    index_type = choose_index_type(num_vectors, index_type or ANN_INDEX_TYPE)
+    encoding = encoding or ANN_VECTOR_ENCODING
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown vector encoding '{encoding}', expected one of {ENCODINGS}")
+    qtype = SQ_TYPES.get(encoding)
+    if index_type == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(dimension, ANN_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, qtype, ANN_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ANN_HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = ANN_EF_SEARCH
+    elif index_type in ("ivf", "ivfpq"):
+        # Rule of thumb: ~4*sqrt(n) lists, but at least 39 training points per list
+        nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == "ivfpq" and dimension % ANN_PQ_SUBVECTOR_DIMS == 0:
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist,
+                                     dimension // ANN_PQ_SUBVECTOR_DIMS, 8, faiss.METRIC_INNER_PRODUCT)
+        elif qtype is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, qtype, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = ANN_NPROBE
+    elif qtype is not None:
+        index = faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = new_flat_index(dimension)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def finalize_index(index):
+    """Swap an incrementally built flat float32 index for the type and encoding its final size calls for"""
+    index_type = choose_index_type(index.ntotal)
+    if not isinstance(index, faiss.IndexFlat) or (index_type == "flat" and ANN_VECTOR_ENCODING == "float32"):
+        return index
+    logger.info(f"Building {index_type} index ({ANN_VECTOR_ENCODING}) over {index.ntotal} vectors")
+    return build_index(index.reconstruct_n(0, index.ntotal), index_type)
+
+
+def index_type_of(index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def encoding_of(index) -> str:
+    """float32, float16, int8 or pq"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    sq = getattr(index, "sq", None)
+    if sq is None:
+        return "float32"
+    for encoding, qtype in SQ_TYPES.items():
+        if sq.qtype == qtype:
+            return encoding
+    return f"sq{sq.qtype}"
+
+
+_direct_map_lock = threading.Lock()
+
+
+def reconstruct(index, ids) -> np.ndarray:
+    """Stored (decoded) vectors for ids; IVF indexes get their id -> list map built on first use"""
+    ids = np.asarray(ids, dtype=np.int64)
+    if index_type_of(index) in ("ivf", "ivfpq"):
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            with _direct_map_lock:
+                if ivf.direct_map.type == faiss.DirectMap.NoMap:
+                    ivf.make_direct_map()
+    return index.reconstruct_batch(ids)
+
+
+def search_params(index, nprobe: int = None, ef_search: int = None, selector=None):
+    """faiss SearchParameters for an index, or None when the defaults apply"""
+    index_type = index_type_of(index)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=ef_search or ANN_EF_SEARCH, sel=selector)
+    if index_type in ("ivf", "ivfpq"):
+        return faiss.SearchParametersIVF(nprobe=nprobe or ANN_NPROBE, sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def search(index, query_vectors: np.ndarray, k: int, nprobe: int = None, ef_search: int = None,
+           selector=None):
+    """Search with per-call tunables; queries are normalized for inner-product indexes"""
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        query_vectors = normalize(query_vectors)
+    params = search_params(index, nprobe, ef_search, selector)
+    if params is None:
+        return index.search(query_vectors, k)
+    return index.search(query_vectors, k, params=params)
+
+
+def describe(index) -> dict:
+    info = {"type": index_type_of(index), "encoding": encoding_of(index),
+            "vectors": int(index.ntotal), "dimension": int(index.d)}
+    downcast = faiss.downcast_index(index)
+    if info["type"] == "hnsw":
+        info["ef_search_default"] = ANN_EF_SEARCH
+    elif info["type"] in ("ivf", "ivfpq"):
+        info["nlist"] = int(downcast.nlist)
+        info["nprobe_default"] = ANN_NPROBE
+    return info
@@ -0,0 +1,393 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+from filelock import FileLock
+from starlette.concurrency import run_in_threadpool
+from utils.process_files import ProcessFile
+
+logger = logging.getLogger(__name__)
+
+MENTOR_WRITE_BEHIND = os.getenv("MENTOR_WRITE_BEHIND", "true").lower() == "true"
+# Append-only log of queued exchanges; each process writes its own, e.g. data/mentor_outbox.<pid>.jsonl
+MENTOR_OUTBOX_PATH = os.getenv("MENTOR_OUTBOX_PATH", os.path.join("data", "mentor_outbox.jsonl"))
+# Exchanges that kept failing are moved here instead of blocking the queue; shared by all processes
+MENTOR_OUTBOX_DEAD_PATH = os.getenv("MENTOR_OUTBOX_DEAD_PATH", os.path.join("data", "mentor_outbox.dead.jsonl"))
+# fsync every queued exchange, so it survives a crash of the machine and not only of the process
+MENTOR_OUTBOX_FSYNC = os.getenv("MENTOR_OUTBOX_FSYNC", "true").lower() == "true"
+MENTOR_OUTBOX_BATCH_SIZE = int(os.getenv("MENTOR_OUTBOX_BATCH_SIZE", "50"))
+# How long a flush waits for more exchanges before writing a partial batch
+MENTOR_OUTBOX_LINGER_SECONDS = float(os.getenv("MENTOR_OUTBOX_LINGER_SECONDS", "0.2"))
+MENTOR_OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("MENTOR_OUTBOX_RETRY_BASE_SECONDS", "0.5"))
+MENTOR_OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("MENTOR_OUTBOX_RETRY_MAX_SECONDS", "60"))
+# Failed attempts of a single exchange before it is dead-lettered (about 15 minutes of retries).
+# Only failures while other exchanges were written count, so an outage never dead-letters anything.
+MENTOR_OUTBOX_MAX_ATTEMPTS = int(os.getenv("MENTOR_OUTBOX_MAX_ATTEMPTS", "20"))
+# How long shutdown waits for the queue to drain; the rest is flushed on the next start
+MENTOR_OUTBOX_DRAIN_SECONDS = float(os.getenv("MENTOR_OUTBOX_DRAIN_SECONDS", "20"))
+
+# Single-exchange failures in a row, with nothing written, that mean the database is down
+ISOLATE_PROBES = 3
+
+# Persists a batch of (chat id, exchange), oldest first; raises or returns False on failure.
+# It must be idempotent per exchange id: a batch that failed half-way is sent again.
+Writer = Callable[[List[Tuple[str, Dict]]], bool]
+
+
+def retry_delay(attempt: int) -> float:
+    return min(MENTOR_OUTBOX_RETRY_MAX_SECONDS, MENTOR_OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+
+
+def read_log(path: str) -> List[Dict]:
+    """Unacked records of a log file, oldest first"""
+    if not os.path.isfile(path):
+        return []
+    records, acked = {}, set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash; it was never acknowledged to anyone
+                continue
+            if entry.get("op") == "put":
+                records[entry["seq"]] = entry
+            elif entry.get("op") == "ack":
+                acked.add(entry["seq"])
+    return [record for seq, record in sorted(records.items()) if seq not in acked]
+
+
+class WriteBehindQueue:
+    """Durable write-behind queue for mentor exchanges
+
+    enqueue returns once the exchange is appended to a local log file, and a
+    background task writes the queue to the database in batches. When a
+    batch fails its exchanges are written one at a time. An exchange that
+    fails while others get through backs off on its own, holding back only
+    later exchanges of its chat, and is dead-lettered after max attempts;
+    replay_dead_letters queues those again. When nothing gets through the
+    whole queue backs off. Each written exchange gets an ack line in the log.
+
+    Every process keeps its own log, locked while it runs (see
+    utils/process_files.py). On start the unacked exchanges of its log, and
+    of logs left by stopped processes, are queued again. On shutdown the
+    queue is drained for up to drain_seconds.
+    """
+
+    def __init__(self, path: str = MENTOR_OUTBOX_PATH, dead_path: str = MENTOR_OUTBOX_DEAD_PATH,
+                 writer: Optional[Writer] = None, fsync: bool = MENTOR_OUTBOX_FSYNC,
+                 ident: Optional[int] = None):
+        self._owner = ProcessFile(path, ident)
+        self.dead_path = dead_path
+        self.writer = writer
+        self.fsync = fsync
+        self.batch_size = MENTOR_OUTBOX_BATCH_SIZE
+        self.enqueued = 0
+        self.persisted = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.flush_lag_seconds = 0.0
+        self.last_flush_lag = None
+        self.last_error = None
+        self._pending = deque()
+        self._seq = 0
+        # Records written to the log and not acked yet; guarded by the file lock
+        self._unacked = 0
+        # Passes in a row in which nothing could be written, and when to try again
+        self._outage_passes = 0
+        self._retry_at = 0.0
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._dead_lock = threading.Lock()
+        self._wake = None
+        self._task = None
+
+    @property
+    def path(self) -> str:
+        """This process's log"""
+        return self._owner.path
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _write_lines(self, lines: List[Dict]):
+        """Append JSON lines to the log; the caller holds the file lock"""
+        self._file.write("".join(json.dumps(line) + "\n" for line in lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _put(self, chat_id: str, exchange: Dict) -> Dict:
+        with self._file_lock:
+            self._seq += 1
+            self._unacked += 1
+            record = {"op": "put", "seq": self._seq, "chat_id": chat_id,
+                      "exchange": exchange, "queued_at": time.time()}
+            self._write_lines([record])
+        return record
+
+    def _dead_lock_file(self) -> FileLock:
+        """Held while the dead-letter file, shared with other processes, is appended to or taken"""
+        return FileLock(f"{self.dead_path}.lock")
+
+    def _dead_letter(self, record: Dict):
+        with self._dead_lock, self._dead_lock_file():
+            with open(self.dead_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    async def enqueue(self, chat_id: str, exchange: Dict):
+        """Durably queue an exchange; raises OSError if the log cannot be written"""
+        record = await run_in_threadpool(self._put, chat_id, exchange)
+        self._pending.append(record)
+        self.enqueued += 1
+        self._wake.set()
+
+    def _take_dead_letters(self) -> List[Dict]:
+        """Move dead-lettered exchanges back into the log; they are only removed once queued"""
+        with self._dead_lock, self._dead_lock_file():
+            if not os.path.isfile(self.dead_path):
+                return []
+            with open(self.dead_path, encoding="utf-8") as f:
+                dead = [json.loads(line) for line in f if line.strip()]
+            records = [self._put(record["chat_id"], record["exchange"]) for record in dead]
+            os.remove(self.dead_path)
+        return records
+
+    async def replay_dead_letters(self) -> int:
+        """Queue every dead-lettered exchange again, e.g. after fixing what made it fail"""
+        if not self.running:
+            raise RuntimeError("The write-behind queue is not running")
+        records = await run_in_threadpool(self._take_dead_letters)
+        self._pending.extend(records)
+        if records:
+            logger.info(f"Requeued {len(records)} dead-lettered mentor exchange(s)")
+            self._wake.set()
+        return len(records)
+
+    def _acked(self, records: List[Dict]):
+        with self._file_lock:
+            self._unacked -= len(records)
+            if self._unacked == 0:
+                # Nothing is waiting, so the log can start over
+                self._file.truncate(0)
+                self._file.seek(0)
+            else:
+                self._write_lines([{"op": "ack", "seq": record["seq"]} for record in records])
+
+    async def _write(self, batch: List[Dict]) -> bool:
+        try:
+            if await run_in_threadpool(self.writer, [(r["chat_id"], r["exchange"]) for r in batch]) is False:
+                raise RuntimeError("writer reported failure")
+            return True
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logger.warning(f"Writing {len(batch)} queued mentor exchange(s) failed: {e}")
+            return False
+
+    def _eligible(self, now: float) -> List[Dict]:
+        """The next batch: records not backing off, and none behind an earlier record of its chat"""
+        batch, blocked = [], set()
+        for record in self._pending:
+            if record["chat_id"] in blocked:
+                continue
+            if record.get("retry_at", 0) > now:
+                # Exchanges of a chat are written in order
+                blocked.add(record["chat_id"])
+                continue
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                break
+        return batch
+
+    async def _isolate(self, batch: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """(written, failed) after writing a failed batch one exchange at a time
+
+        Chats whose exchanges never failed go first, so healthy ones get
+        through before a bad one is retried. A chat stops at its first
+        failure. After ISOLATE_PROBES failures with no success the database
+        is presumed down and the rest is left for the next pass.
+        """
+        chats: Dict[str, List[Dict]] = {}
+        for record in batch:
+            chats.setdefault(record["chat_id"], []).append(record)
+        written, failed = [], []
+        for records in sorted(chats.values(), key=lambda records: (records[0].get("failures", 0), records[0]["seq"])):
+            for record in records:
+                if not await self._write([record]):
+                    failed.append(record)
+                    break
+                written.append(record)
+            if not written and len(failed) >= ISOLATE_PROBES:
+                break
+        return written, failed
+
+    async def flush_once(self) -> int:
+        """Write the next batch; returns how many exchanges left the queue"""
+        now = time.time()
+        if now < self._retry_at:
+            return 0
+        batch = self._eligible(now)
+        if not batch:
+            return 0
+        if await self._write(batch):
+            written, failed = batch, []
+        elif len(batch) == 1:
+            written, failed = [], batch
+        else:
+            written, failed = await self._isolate(batch)
+
+        dead = []
+        for record in failed:
+            record["failures"] = record.get("failures", 0) + 1
+        if failed and not written:
+            # Nothing got through, so the database is the likely problem, not
+            # these exchanges: back off as a whole and count no attempts
+            self._outage_passes += 1
+            self._retry_at = now + retry_delay(self._outage_passes)
+        else:
+            self._outage_passes = 0
+            # Others were written in this pass, so these failures are the exchanges' own
+            for record in failed:
+                record["attempts"] = record.get("attempts", 0) + 1
+                if record["attempts"] < MENTOR_OUTBOX_MAX_ATTEMPTS:
+                    record["retry_at"] = now + retry_delay(record["attempts"])
+                    continue
+                logger.error(f"Dead-lettering mentor exchange {record['exchange'].get('id')} "
+                             f"for chat {record['chat_id']} after {record['attempts']} attempts")
+                await run_in_threadpool(self._dead_letter, record)
+                self.dead_lettered += 1
+                dead.append(record)
+
+        if written:
+            self.persisted += len(written)
+            self.batches += 1
+            done_at = time.time()
+            self.last_flush_lag = done_at - min(record["queued_at"] for record in written)
+            self.flush_lag_seconds += sum(done_at - record["queued_at"] for record in written)
+        done = written + dead
+        if done:
+            finished = {record["seq"] for record in done}
+            self._pending = deque(record for record in self._pending if record["seq"] not in finished)
+            await run_in_threadpool(self._acked, done)
+        return len(done)
+
+    def _next_attempt(self) -> float:
+        """Seconds until a pending record can be tried again"""
+        due = min((record.get("retry_at", 0) for record in self._pending), default=0)
+        return max(due, self._retry_at) - time.time()
+
+    async def _loop(self):
+        while True:
+            if not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+            if len(self._pending) < self.batch_size:
+                await asyncio.sleep(MENTOR_OUTBOX_LINGER_SECONDS)
+            try:
+                flushed = await self.flush_once()
+            except Exception as e:
+                logger.error(f"Mentor write-behind flush failed: {e}")
+                flushed = 0
+            if not flushed and self._pending:
+                # Everything is backing off; sleep until the next retry or a new exchange
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(),
+                                           max(self._next_attempt(), MENTOR_OUTBOX_LINGER_SECONDS))
+                except asyncio.TimeoutError:
+                    pass
+
+    def load(self) -> List[Dict]:
+        """Unacked records of this process's log, oldest first"""
+        return read_log(self.path)
+
+    def _rewrite(self, pending: List[Dict]):
+        """Replace the log with only the pending records, renumbered from 1"""
+        for seq, record in enumerate(pending, 1):
+            record["seq"] = seq
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(record) + "\n" for record in pending)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _adopt(self, paths: List[str]):
+        """Compact this process's log, adding the unacked exchanges of logs left by stopped processes"""
+        adopted = [record for path in paths for record in read_log(path)]
+        if adopted:
+            logger.info(f"Adopting {len(adopted)} queued mentor exchange(s) from {paths}")
+        self._rewrite(sorted(self.load() + adopted, key=lambda record: record["queued_at"]))
+
+    def start(self, writer: Optional[Writer] = None):
+        """Claim this process's log, adopt orphaned ones and start flushing
+
+        Raises RuntimeError if another running process owns the log.
+        """
+        if writer is not None:
+            self.writer = writer
+        if self._task is not None:
+            return
+        self._owner.claim(self._adopt)
+        pending = self.load()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._seq = self._unacked = len(pending)
+        self._pending = deque(pending)
+        if pending:
+            logger.info(f"Replaying {len(pending)} queued mentor exchange(s) from {self.path}")
+        self._wake = asyncio.Event()
+        self._wake.set()
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self, drain_seconds: float = MENTOR_OUTBOX_DRAIN_SECONDS):
+        if self._task is None:
+            return
+        deadline = time.monotonic() + drain_seconds
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._pending:
+            logger.warning(f"{len(self._pending)} mentor exchange(s) left in {self.path}; they are written on the next start")
+        with self._file_lock:
+            self._file.close()
+            self._file = None
+        # An empty log is removed; one with exchanges left is adopted by the next process to start
+        self._owner.release(remove=not self._pending)
+
+    def stats(self) -> Dict:
+        oldest = self._pending[0]["queued_at"] if self._pending else None
+        return {
+            "enabled": self.running,
+            "depth": len(self._pending),
+            "oldest_pending_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "enqueued": self.enqueued,
+            "persisted": self.persisted,
+            "batches": self.batches,
+            "avg_batch_size": round(self.persisted / self.batches, 2) if self.batches else None,
+            "avg_flush_lag_ms": round(self.flush_lag_seconds / self.persisted * 1000, 1) if self.persisted else None,
+            "last_flush_lag_ms": round(self.last_flush_lag * 1000, 1) if self.last_flush_lag is not None else None,
+            "failures": self.failures,
+            "backing_off": sum(1 for record in self._pending if record.get("retry_at", 0) > time.time()),
+            "outage_passes": self._outage_passes,
+            "dead_lettered": self.dead_lettered,
+            "last_error": self.last_error,
+        }
+
+
+mentor_outbox = WriteBehindQueue()